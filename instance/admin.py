@@ -28,6 +28,7 @@ from instance.models.instance import InstanceReference
 from instance.models.openedx_instance import OpenEdXInstance
 from instance.models.openedx_appserver import OpenEdXAppServer
 from instance.models.log_entry import LogEntry
+from instance.models.playbook_event import PlaybookEvent
 from instance.models.server import OpenStackServer
 
 
@@ -37,6 +38,12 @@ class LogEntryAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
     list_display = ('created', 'level', 'text', 'modified')
 
 
+class PlaybookEventAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
+    list_display = ('started', 'appserver', 'role', 'task', 'status', 'duration')
+    list_filter = ('status', )
+    search_fields = ('role', 'task')
+
+
 class OpenStackServerAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
     list_display = ('openstack_id', 'status', 'created', 'modified')
     # TODO: Is there a way to link back to the owning AppServer? (efficiently)
@@ -58,6 +65,7 @@ class OpenEdXAppServerAdmin(admin.ModelAdmin): #pylint: disable=missing-docstrin
 
 
 admin.site.register(LogEntry, LogEntryAdmin)
+admin.site.register(PlaybookEvent, PlaybookEventAdmin)
 admin.site.register(OpenStackServer, OpenStackServerAdmin)
 admin.site.register(InstanceReference, InstanceReferenceAdmin)
 admin.site.register(OpenEdXInstance, OpenEdXInstanceAdmin)
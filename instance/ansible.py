@@ -22,9 +22,14 @@ Ansible - Helper functions
 
 # Imports #####################################################################
 
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 from tempfile import mkdtemp, NamedTemporaryFile
@@ -38,6 +43,19 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+# Directory of the callback plugin writing the structured events of playbook runs (see `run_playbook`)
+CALLBACK_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_callbacks')
+
+# Inventory variable holding the variables specific to each host, for batched playbook runs
+BATCH_VARS_NAME = 'opencraft_batch_vars'
+
+# File created in a cached venv once all its requirements are installed. Its mtime is the last time
+# the venv was used, for the eviction of the least recently used venvs.
+VENV_READY_MARKER = '.ready'
+
+
 # Functions ###################################################################
 
 def yaml_merge(yaml_str1, yaml_str2):
@@ -92,49 +110,262 @@ def create_temp_dir():
             shutil.rmtree(temp_dir)
 
 
-def render_sandbox_creation_command(
-        requirements_path, inventory_path, vars_path, playbook_name, remote_username, venv_path):
+def get_venv_cache_key(requirements_path):
     """
-    Renders the shell command used to create the sandbox
+    Return the key of the cached venv to use for the given requirements file
+
+    The key is a hash of the content of the requirements file and of the Python interpreter path, so
+    a new venv is built whenever either of them changes.
     """
+    digest = hashlib.sha256(settings.ANSIBLE_PYTHON_PATH.encode())
+    digest.update(b'\0')
+    with open(requirements_path, 'rb') as requirements_file:
+        digest.update(requirements_file.read())
+    return digest.hexdigest()
 
-    venv_python_path = os.path.join(venv_path, 'bin/python')
+
+def get_directory_size(path):
+    """
+    Return the total size in bytes of the files in the given directory tree
+    """
+    size = 0
+    for dir_path, dummy, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass  # The file was removed in the meantime
+    return size
+
+
+def evict_venv_cache(keep_path=None):
+    """
+    Remove the least recently used venvs from the cache, until the other cached venvs use less than
+    ANSIBLE_VENV_CACHE_MAX_SIZE bytes. Venvs being used or built (i.e. locked) are left alone.
+    """
+    cache_dir = settings.ANSIBLE_VENV_CACHE_DIR
+    venvs = []
+    for name in os.listdir(cache_dir):
+        venv_path = os.path.join(cache_dir, name)
+        if venv_path == keep_path or not os.path.isdir(venv_path):
+            continue
+        try:
+            last_used = os.path.getmtime(os.path.join(venv_path, VENV_READY_MARKER))
+        except OSError:
+            last_used = 0  # Incomplete venv
+        venvs.append((last_used, venv_path, get_directory_size(venv_path)))
+
+    total_size = sum(size for dummy, dummy, size in venvs)
+    for dummy, venv_path, size in sorted(venvs):
+        if total_size <= settings.ANSIBLE_VENV_CACHE_MAX_SIZE:
+            break
+        with open(venv_path + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            logger.info('Evicting cached venv %s (%d bytes)', venv_path, size)
+            shutil.rmtree(venv_path, ignore_errors=True)
+        total_size -= size
+
+
+def build_venv(requirements_path, venv_path):
+    """
+    Create a venv at `venv_path`, install the given requirements in it, and mark it as ready to use
+
+    The output of the build is logged. If the build fails, the half-built venv is removed, and
+    `subprocess.CalledProcessError` is raised.
+    """
+    shutil.rmtree(venv_path, ignore_errors=True)  # Leftovers of an interrupted build
+    cmd = render_venv_creation_command(requirements_path, venv_path)
+    logger.info('Building venv: %s', cmd)
+    try:
+        output = subprocess.check_output(
+            cmd, shell=True, stderr=subprocess.STDOUT, timeout=settings.ANSIBLE_GLOBAL_TIMEOUT,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
+        logger.error('Failed to build venv %s:\n%s', venv_path, (exc.output or b'').decode('utf-8', errors='replace'))
+        shutil.rmtree(venv_path, ignore_errors=True)
+        raise
+    logger.info('Built venv %s:\n%s', venv_path, output.decode('utf-8', errors='replace'))
+    open(os.path.join(venv_path, VENV_READY_MARKER), 'w').close()
+
+
+@contextmanager
+def cached_venv(requirements_path):
+    """
+    A context manager that returns the path of the cached venv for the given requirements file,
+    building it first if needed, and locks it while it's in use.
+
+    The venv is built under an exclusive lock, so that only one caller builds it, while the others
+    wait to reuse it. The lock is then downgraded to a shared lock, so that several playbooks can
+    run from the venv at once, while it can't be evicted.
+    """
+    cache_dir = settings.ANSIBLE_VENV_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    venv_path = os.path.join(cache_dir, get_venv_cache_key(requirements_path))
+    ready_marker_path = os.path.join(venv_path, VENV_READY_MARKER)
+
+    with open(venv_path + '.lock', 'a') as lock_file:
+        while True:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(ready_marker_path):
+                evict_venv_cache(keep_path=venv_path)
+                build_venv(requirements_path, venv_path)
+            # Converting the lock isn't atomic, so check that the venv wasn't evicted in the meantime:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            if os.path.exists(ready_marker_path):
+                os.utime(ready_marker_path)
+                yield venv_path
+                return
+
+
+def render_venv_creation_command(requirements_path, venv_path):
+    """
+    Renders the shell command used to create a venv and install the given requirements in it
+    """
     create_venv_cmd = 'virtualenv -p {python_path} {venv_path}'.format(
         python_path=settings.ANSIBLE_PYTHON_PATH,
         venv_path=venv_path,
     )
 
     install_requirements_cmd = '{python} -u {pip} install -r {requirements_path}'.format(
-        python=venv_python_path,
+        python=os.path.join(venv_path, 'bin/python'),
         pip=os.path.join(venv_path, 'bin/pip'),
         requirements_path=requirements_path,
     )
 
-    run_playbook_cmd = '{python} -u {ansible} -i {inventory_path} -e @{vars_path} -u {user} {playbook}'.format(
+    return ' && '.join([create_venv_cmd, install_requirements_cmd])
+
+
+def render_sandbox_creation_command(
+        requirements_path, inventory_path, vars_path, playbook_name, remote_username, venv_path, create_venv=True,
+        forks=None):
+    """
+    Renders the shell command used to create the sandbox
+
+    If `create_venv` is False, the venv at `venv_path` is assumed to be ready, and is used as is.
+    `forks` sets the number of hosts ansible configures in parallel.
+    """
+
+    venv_python_path = os.path.join(venv_path, 'bin/python')
+    create_venv_cmd = render_venv_creation_command(requirements_path, venv_path)
+    mark_venv_ready_cmd = 'touch {}'.format(os.path.join(venv_path, VENV_READY_MARKER))
+
+    run_playbook_cmd = '{python} -u {ansible} -i {inventory_path} -e @{vars_path}{options} -u {user} {playbook}'.format(
         python=venv_python_path,
         ansible=os.path.join(venv_path, 'bin/ansible-playbook'),
         inventory_path=inventory_path,
         vars_path=vars_path,
+        options=' --forks {}'.format(forks) if forks else '',
         user=remote_username,
         playbook=playbook_name,
     )
 
-    return ' && '.join([create_venv_cmd, install_requirements_cmd, run_playbook_cmd])
+    if not create_venv:
+        return run_playbook_cmd
+    return ' && '.join([create_venv_cmd, mark_venv_ready_cmd, run_playbook_cmd])
 
 
 @contextmanager
-def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, playbook_name, username='root'):
+def get_venv(requirements_path, temp_dir):
+    """
+    A context manager that returns a tuple of the path of the venv to run ansible from, and whether
+    it is ready to use.
+
+    The venv is taken from the cache when ANSIBLE_VENV_CACHE_DIR is set (see `cached_venv`), or
+    created in `temp_dir` by the playbook command otherwise.
+    """
+    if settings.ANSIBLE_VENV_CACHE_DIR:
+        with cached_venv(requirements_path) as venv_path:
+            yield venv_path, True
+    else:
+        yield os.path.join(temp_dir, 'venv'), False
+
+
+def get_batch_key(vars_str):
+    """
+    Return a key identifying the hosts whose variables, given as a YAML string, can be passed to the
+    same playbook run (see `write_batch_inventory`)
+
+    The hosts of a batch must define the same variables. Their values can differ, except for numbers
+    and nulls, since the values which differ are resolved with templates, whose results are strings,
+    or lists, dicts and booleans once ansible converts them back.
+    """
+    variables = yaml.safe_load(vars_str) or {}
+    return (
+        frozenset(variables),
+        frozenset(
+            (name, value) for name, value in variables.items() if not isinstance(value, (str, bool, list, dict))
+        ),
+    )
+
+
+def write_batch_inventory(inventory_str, host_vars, root_dir):
+    """
+    Store an inventory and the extra vars of a playbook run against several hosts in a new directory of
+    `root_dir`, and return the paths of the inventory and extra vars files
+
+    `host_vars` is a dict of the variables of each host, as YAML strings with the same batch key (see
+    `get_batch_key`). The values shared by all hosts are passed as they are in the extra vars. The other
+    ones are stored in the BATCH_VARS_NAME inventory variable of each host, and resolved by templates in
+    the extra vars. This way, all the variables keep the precedence of extra vars, as in a playbook run
+    of their own, over the variables of the roles, `include_vars` and `set_fact`.
+    """
+    host_vars = {host: yaml.safe_load(vars_str) or {} for host, vars_str in host_vars.items()}
+    first_host_vars = next(iter(host_vars.values()))
+    extra_vars = {}
+    batch_vars = {host: {} for host in host_vars}
+    for name, value in first_host_vars.items():
+        if all(variables[name] == value for variables in host_vars.values()):
+            extra_vars[name] = value
+            continue
+        extra_vars[name] = '{{{{ {}[{}] }}}}'.format(BATCH_VARS_NAME, json.dumps(name))
+        for host, variables in host_vars.items():
+            batch_vars[host][name] = variables[name]
+
+    inventory_dir = mkdtemp(dir=root_dir)
+    os.mkdir(os.path.join(inventory_dir, 'host_vars'))
+    for host, variables in batch_vars.items():
+        with open(os.path.join(inventory_dir, 'host_vars', '{}.yml'.format(host)), 'w') as f:
+            f.write(yaml.safe_dump({BATCH_VARS_NAME: variables}, default_flow_style=False))
+    inventory_path = os.path.join(inventory_dir, 'hosts')
+    with open(inventory_path, 'w') as f:
+        f.write(inventory_str)
+    vars_path = os.path.join(inventory_dir, 'vars.yml')
+    with open(vars_path, 'w') as f:
+        f.write(yaml.safe_dump(extra_vars, default_flow_style=False))
+    return inventory_path, vars_path
+
+
+@contextmanager
+def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, playbook_name, username='root',
+                 host_vars=None, forks=None):
     """
     Runs ansible-playbook in a dedicated venv
 
     Ansible only supports Python 2 - so we have to run it as a separate command, in its own venv
+
+    To run the playbook against several hosts at once, pass the variables of each host in the
+    `host_vars` dict (in which case `vars_str` must be None), and the number of hosts to configure in
+    parallel as `forks`. The variables of each host keep the precedence of extra vars (see
+    `write_batch_inventory`). See `PlaybookOutputSplitter` to split the output per host.
+
+    Besides its output, the process has an `events` pipe, on which the `opencraft_events` callback
+    plugin writes a JSON line for the result of each task on each host (see `parse_playbook_event`).
+    Events are dropped when the pipe is full, so it should be read along with the output.
     """
 
-    with create_temp_dir() as ansible_tmp_dir:
+    with ExitStack() as stack:
+        ansible_tmp_dir = stack.enter_context(create_temp_dir())
+        venv_path, venv_ready = stack.enter_context(get_venv(requirements_path, ansible_tmp_dir))
 
-        vars_path = string_to_file_path(vars_str, root_dir=ansible_tmp_dir)
-        inventory_path = string_to_file_path(inventory_str, root_dir=ansible_tmp_dir)
-        venv_path = os.path.join(ansible_tmp_dir, 'venv')
+        if host_vars:
+            assert vars_str is None
+            inventory_path, vars_path = write_batch_inventory(inventory_str, host_vars, root_dir=ansible_tmp_dir)
+        else:
+            inventory_path = string_to_file_path(inventory_str, root_dir=ansible_tmp_dir)
+            vars_path = string_to_file_path(vars_str, root_dir=ansible_tmp_dir)
 
         cmd = render_sandbox_creation_command(
             requirements_path=requirements_path,
@@ -142,7 +373,9 @@ def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, play
             vars_path=vars_path,
             playbook_name=playbook_name,
             remote_username=username,
-            venv_path=venv_path
+            venv_path=venv_path,
+            create_venv=not venv_ready,
+            forks=forks,
         )
 
         logger.info('Running: %s', cmd)
@@ -152,12 +385,95 @@ def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, play
         env = dict(os.environ)
         env['TMPDIR'] = ansible_tmp_dir
 
-        yield subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1, # Buffer one line at a time
-            cwd=playbook_path,
-            shell=True,
-            env=env,
-        )
+        events_read_fd, events_write_fd = os.pipe()
+        os.set_blocking(events_write_fd, False)
+        env['ANSIBLE_CALLBACK_PLUGINS'] = CALLBACK_PLUGINS_DIR
+        env['OPENCRAFT_ANSIBLE_EVENTS_FD'] = str(events_write_fd)
+        with open(events_read_fd, 'rb', buffering=0) as events:
+            try:
+                process = subprocess.Popen(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    bufsize=0, # Unbuffered: poll_streams() reads the output in chunks, as soon as it is available
+                    cwd=playbook_path,
+                    shell=True,
+                    env=env,
+                    pass_fds=(events_write_fd,),
+                )
+            finally:
+                # Only the ansible process keeps the pipe open for writing, so it's closed when it exits
+                os.close(events_write_fd)
+            process.events = events
+            yield process
+
+
+def parse_playbook_event(line):
+    """
+    Parse a line written on the `events` pipe of a playbook run (see `run_playbook`)
+
+    Returns a dict with the `task` and `role` names, the `host`, the `status` ('ok', 'changed',
+    'skipped', 'failed' or 'unreachable'), the `started` (aware datetime) and `duration` (seconds) of
+    the task, and a `result` summary dict; or None if the line isn't a valid event.
+    """
+    try:
+        fields = json.loads(line.decode('utf-8'))
+        event = {field: fields[field] for field in ('task', 'role', 'host', 'status', 'duration', 'result')}
+        event['started'] = datetime.fromtimestamp(fields['started'], timezone.utc)
+    except (ValueError, KeyError, TypeError):
+        logger.warning('Invalid playbook event: %r', line)
+        return None
+    return event
+
+
+# Classes #####################################################################
+
+class PlaybookOutputSplitter:
+    """
+    Split the output of a playbook run against several hosts into the log of each host
+
+    The results of a task and the play recap of a host mention it, e.g. `ok: [10.0.0.1]`, and are
+    attributed to that host, along with the lines that follow them (multi-line results). Headers of
+    plays and tasks, and lines that can't be attributed to a single host, belong to all the hosts.
+    """
+    HEADER_PREFIXES = ('PLAY', 'TASK', 'RUNNING HANDLER', 'GATHERING FACTS', 'NOTIFIED')
+    HOST_PATTERN = re.compile(r'\[([^\]\s]+)(?: -> [^\]]+)?\]')
+    RECAP_PATTERN = re.compile(r'^(\S+)\s+:\s+ok=\d+\s+changed=\d+\s+unreachable=(\d+)\s+failed=(\d+)')
+
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.current_host = None
+        # Number of failed and unreachable tasks of each host, from the play recap
+        self.num_failures = {}
+
+    def split(self, line):
+        """
+        Return the list of hosts that the given line of output belongs to
+        """
+        recap_match = self.RECAP_PATTERN.match(line)
+        if recap_match and recap_match.group(1) in self.hosts:
+            host = recap_match.group(1)
+            self.num_failures[host] = int(recap_match.group(2)) + int(recap_match.group(3))
+            self.current_host = None
+            return [host]
+        if line.startswith(self.HEADER_PREFIXES):
+            self.current_host = None
+            return self.hosts
+        for host in self.HOST_PATTERN.findall(line):
+            if host in self.hosts:
+                self.current_host = host
+                return [host]
+        if self.current_host is not None:
+            return [self.current_host]
+        return self.hosts
+
+    def get_returncode(self, host, process_returncode):
+        """
+        Return the exit code of the playbook run for the given host: the exit code of the process,
+        unless the play recap shows that the playbook succeeded for that host
+        """
+        if self.num_failures.get(host) == 0:
+            return 0
+        if host in self.num_failures:
+            return process_returncode or 2
+        return process_returncode
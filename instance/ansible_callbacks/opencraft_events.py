@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Ansible callback plugin - Structured task events
+
+Loaded by ansible-playbook from ANSIBLE_CALLBACK_PLUGINS (see `instance.ansible.run_playbook`), so this
+module runs in the Python 2 ansible venv, and must work with both Ansible 1.9 and 2.x. It writes one
+JSON line per task result to the file descriptor in OPENCRAFT_ANSIBLE_EVENTS_FD, with the task name, role,
+host, status, start time, duration and a summary of the result.
+"""
+
+# Imports #####################################################################
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import fcntl
+import json
+import os
+import time
+
+try:
+    from ansible.plugins.callback import CallbackBase
+except ImportError:  # Ansible 1.x
+    CallbackBase = object
+
+try:
+    STRING_TYPES = (basestring, )  # pylint: disable=undefined-variable
+except NameError:  # Python 3
+    STRING_TYPES = (str, )
+
+
+# Constants ###################################################################
+
+# Events are written with a single write(), which is atomic on a pipe up to PIPE_BUF (4096) bytes, so that
+# the events of the worker processes forked by Ansible 1.x aren't interleaved
+MAX_EVENT_SIZE = 4000
+
+# Maximum length of the strings of the result summary
+MAX_RESULT_LENGTH = 1000
+
+
+# Classes #####################################################################
+
+class CallbackModule(CallbackBase):
+    """
+    Write the result of each task on each host as a JSON event
+    """
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'opencraft_events'
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        events_fd = os.environ.get('OPENCRAFT_ANSIBLE_EVENTS_FD')
+        self.events_fd = int(events_fd) if events_fd else None
+        if self.events_fd is not None:
+            # The worker processes forked by ansible share the pipe, but the commands they run (e.g. a
+            # persistent ssh master) mustn't keep it open once the playbook has finished
+            flags = fcntl.fcntl(self.events_fd, fcntl.F_GETFD)
+            fcntl.fcntl(self.events_fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.task_name = None
+        self.role_name = ''
+        self.task_started = None
+
+    def _task_start(self, task_name, role_name):
+        """
+        Remember the task being started, to attach it to its results
+        """
+        self.task_name = task_name
+        self.role_name = role_name or ''
+        self.task_started = time.time()
+
+    def _task_result(self, host, status, result):
+        """
+        Write the event of a task result
+        """
+        if self.events_fd is None or self.task_name is None:
+            return
+        summary = {}
+        if status in ('failed', 'unreachable') and isinstance(result, dict):
+            for key in ('msg', 'rc', 'stderr'):
+                value = result.get(key)
+                if isinstance(value, STRING_TYPES):
+                    value = value[-MAX_RESULT_LENGTH:]
+                if value is not None and value != '':
+                    summary[key] = value
+        event = {
+            'task': self.task_name,
+            'role': self.role_name,
+            'host': host,
+            'status': status,
+            'started': self.task_started,
+            'duration': round(time.time() - self.task_started, 3),
+            'result': summary,
+        }
+        line = (json.dumps(event) + '\n').encode('utf-8')
+        if len(line) > MAX_EVENT_SIZE:
+            event['result'] = {'truncated': True}
+            line = (json.dumps(event) + '\n').encode('utf-8')
+        try:
+            os.write(self.events_fd, line)
+        except OSError as exc:
+            # Never block or break the playbook run: events are dropped if nobody reads them
+            if exc.errno not in (errno.EAGAIN, errno.EPIPE, errno.EBADF):
+                raise
+
+    # Ansible 2.x #############################################################
+
+    def v2_playbook_on_task_start(self, task, is_conditional):  # pylint: disable=unused-argument
+        """ A task starts """
+        role = getattr(task, '_role', None)
+        self._task_start(task.get_name(), role.get_name() if role else '')
+
+    def v2_playbook_on_handler_task_start(self, task):
+        """ A handler starts """
+        self.v2_playbook_on_task_start(task, False)
+
+    def v2_runner_on_ok(self, result):
+        """ A task succeeded on a host """
+        status = 'changed' if result._result.get('changed') else 'ok'  # pylint: disable=protected-access
+        self._task_result(result._host.get_name(), status, result._result)  # pylint: disable=protected-access
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):  # pylint: disable=unused-argument
+        """ A task failed on a host """
+        self._task_result(result._host.get_name(), 'failed', result._result)  # pylint: disable=protected-access
+
+    def v2_runner_on_skipped(self, result):
+        """ A task was skipped on a host """
+        self._task_result(result._host.get_name(), 'skipped', result._result)  # pylint: disable=protected-access
+
+    def v2_runner_on_unreachable(self, result):
+        """ A host couldn't be reached """
+        self._task_result(result._host.get_name(), 'unreachable', result._result)  # pylint: disable=protected-access
+
+    # Ansible 1.x #############################################################
+
+    def playbook_on_task_start(self, name, is_conditional):  # pylint: disable=unused-argument
+        """ A task starts - Ansible 1.x names the tasks of roles "<role> | <task>" """
+        role, dummy, dummy = name.rpartition(' | ')
+        self._task_start(name, role)
+
+    def runner_on_ok(self, host, res):
+        """ A task succeeded on a host """
+        self._task_result(host, 'changed' if res.get('changed') else 'ok', res)
+
+    def runner_on_failed(self, host, res, ignore_errors=False):  # pylint: disable=unused-argument
+        """ A task failed on a host """
+        self._task_result(host, 'failed', res)
+
+    def runner_on_skipped(self, host, item=None):  # pylint: disable=unused-argument
+        """ A task was skipped on a host """
+        self._task_result(host, 'skipped', {})
+
+    def runner_on_unreachable(self, host, res):
+        """ A host couldn't be reached """
+        self._task_result(host, 'unreachable', res)
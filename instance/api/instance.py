@@ -22,10 +22,13 @@ Instance API
 
 # Imports #####################################################################
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import detail_route
+from rest_framework.response import Response
 
 from instance.models.instance import InstanceReference
 from instance.serializers.instance import InstanceReferenceBasicSerializer, InstanceReferenceDetailedSerializer
+from instance.serializers.logentry import LogEntryPageQuerySerializer, serialize_log_entries_page
 
 
 # Views - API #################################################################
@@ -73,3 +76,17 @@ class InstanceViewSet(viewsets.ReadOnlyModelViewSet):
         if self.action == 'retrieve':
             suffix = "Details"
         return "Instance {}".format(suffix)
+
+    @detail_route(methods=['get'])
+    def logs(self, request, pk):
+        """
+        Get the log entries of this instance, one page at a time, starting with the latest ones.
+
+        Accepts the optional `limit`, `levels` and `before` parameters - pass the `log_entries_before`
+        value returned with a page as `before` to get the previous page.
+        """
+        serializer = LogEntryPageQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        instance = self.get_object().instance
+        return Response(serialize_log_entries_page(*instance.get_log_entries_page(**serializer.validated_data)))
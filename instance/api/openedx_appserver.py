@@ -32,6 +32,7 @@ from instance.models.instance import InstanceReference
 from instance.models.openedx_appserver import OpenEdXAppServer
 from instance.models.openedx_instance import OpenEdXInstance
 from instance.serializers.appserver import AppServerBasicSerializer
+from instance.serializers.logentry import LogEntryPageQuerySerializer, serialize_log_entries_page
 from instance.serializers.openedx_appserver import OpenEdXAppServerSerializer, SpawnAppServerSerializer
 from instance.tasks import spawn_appserver
 
@@ -100,3 +101,18 @@ class OpenEdXAppServerViewSet(viewsets.ReadOnlyModelViewSet):
             )
         app_server.instance.set_appserver_active(app_server.pk)
         return Response({'status': 'App server updated.'})
+
+    @detail_route(methods=['get'])
+    def logs(self, request, pk):
+        """
+        Get the log entries of this AppServer and of its VM, one page at a time, starting with the latest ones.
+
+        Accepts the optional `limit`, `levels` and `before` parameters - pass the `log_entries_before`
+        value returned with a page as `before` to get the previous page. New log entries are pushed
+        to the browsers by websocket.
+        """
+        serializer = LogEntryPageQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        app_server = self.get_object()
+        return Response(serialize_log_entries_page(*app_server.get_log_entries_page(**serializer.validated_data)))
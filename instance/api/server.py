@@ -27,6 +27,7 @@ from rest_framework.permissions import IsAuthenticated
 
 from instance.models.server import OpenStackServer
 from instance.serializers.server import OpenStackServerSerializer
+from instance.tasks import refresh_server_statuses
 
 
 # Views #######################################################################
@@ -39,6 +40,14 @@ class OpenStackServerViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = OpenStackServerSerializer
     permission_classes = [IsAuthenticated]
 
+    def list(self, request, *args, **kwargs):
+        """
+        List the servers - pass `?refresh=1` to queue a refresh of their statuses, in a single task
+        """
+        if request.query_params.get('refresh') == '1':
+            refresh_server_statuses(list(self.filter_queryset(self.get_queryset()).values_list('pk', flat=True)))
+        return super().list(request, *args, **kwargs)
+
     def get_view_name(self):
         """
         Get the verbose name for each view
@@ -30,7 +30,7 @@ import logging
 from django.conf import settings
 
 from instance.models.openedx_instance import OpenEdXInstance
-from instance.tasks import spawn_appserver
+from instance.tasks import spawn_appserver, spawn_appservers
 
 logger = logging.getLogger(__name__)
 
@@ -92,13 +92,16 @@ class InstanceUpgrade(object):
         """
         pass
 
-    def upgrade_instances(self):
+    def upgrade_instances(self, batch=False):
         """
         Main upgrade method:
         1. Obtains list of instances to upgrade
         2. Updates instances' fields
         3. Saves updated instances to DB
         4. Schedules jobs to spawn new appservers with new instance settings
+
+        With `batch=True`, a single job spawns the new appservers of all the instances, running each
+        playbook once against all of them rather than once per instance.
         """
         instances = self.get_instances_to_upgrade()
 
@@ -107,7 +110,11 @@ class InstanceUpgrade(object):
             logger.info("Upgrading instance %s to %s ...", instance, self.TARGET_RELEASE)
             self.upgrade_instance(instance)
             instance.save()
-            spawn_appserver(instance.ref.pk, mark_active_on_success=True, num_attempts=1)
+            if not batch:
+                spawn_appserver(instance.ref.pk, mark_active_on_success=True, num_attempts=1)
+
+        if batch and instances:
+            spawn_appservers([instance.ref.pk for instance in instances], mark_active_on_success=True)
 
         # TODO: schedule clean_up_after_upgrade after instances are updated (huey task with conditional?)
 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Log archives - Compressed storage of log entries, on Swift or on the local filesystem
+"""
+
+# Imports #####################################################################
+
+import gzip
+import json
+import os
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_datetime
+
+from instance import openstack
+from instance.models.log_entry import LogEntry
+
+
+# Functions ###################################################################
+
+def _get_chunk_url(archive_url, index):
+    """
+    Return the URL of the chunk number `index` of the archive at `archive_url`
+    """
+    return '{}/{:05d}.jsonl.gz'.format(archive_url, index)
+
+
+def _parse_chunk_url(url):
+    """
+    Return the URL of the archive of the chunk at `url`, and the number of the chunk
+    """
+    archive_url, chunk_name = url.rsplit('/', 1)
+    return archive_url, int(chunk_name.split('.', 1)[0])
+
+
+def _get_chunk_urls(url):
+    """
+    Return the URLs of all the chunks of the archive whose latest chunk is at `url`, oldest first
+    """
+    archive_url, last_index = _parse_chunk_url(url)
+    return [_get_chunk_url(archive_url, index) for index in range(last_index + 1)]
+
+
+def _write_blob(url, data):
+    """
+    Store `data` (bytes) at `url`, replacing any previous blob
+    """
+    url = urlparse(url)
+    if url.scheme == 'swift':
+        openstack.upload_to_swift_container(url.netloc, url.path.lstrip('/'), data)
+    elif url.scheme == 'file':
+        os.makedirs(os.path.dirname(url.path), exist_ok=True)
+        # Write to a temporary file first, so that the blob is replaced atomically
+        with open(url.path + '.tmp', 'wb') as archive_file:
+            archive_file.write(data)
+        os.replace(url.path + '.tmp', url.path)
+    else:
+        raise ValueError('Unknown log archive URL: {}'.format(url.geturl()))
+
+
+def _read_blob(url):
+    """
+    Return the contents (bytes) of the blob at `url`
+    """
+    url = urlparse(url)
+    if url.scheme == 'swift':
+        return openstack.download_from_swift_container(url.netloc, url.path.lstrip('/'))
+    elif url.scheme == 'file':
+        with open(url.path, 'rb') as archive_file:
+            return archive_file.read()
+    raise ValueError('Unknown log archive URL: {}'.format(url.geturl()))
+
+
+def append_to_log_archive(url, name, log_entries):
+    """
+    Store the given log entries in a new gzip-compressed chunk of the archive whose latest chunk
+    is at `url`, without rewriting the previous chunks. If `url` is empty, a new archive called
+    `name` is created, using the storage configured by LOG_ARCHIVE_STORAGE ('swift' or 'local').
+
+    Returns the URL of the new chunk, to pass to `read_log_archive` and to the next call.
+    Until it replaces `url`, writing the same chunk again overwrites it.
+    """
+    if url:
+        archive_url, last_index = _parse_chunk_url(url)
+        chunk_url = _get_chunk_url(archive_url, last_index + 1)
+    elif settings.LOG_ARCHIVE_STORAGE == 'swift':
+        chunk_url = _get_chunk_url('swift://{}/{}'.format(settings.LOG_ARCHIVE_SWIFT_CONTAINER, name), 0)
+    elif settings.LOG_ARCHIVE_STORAGE == 'local':
+        archive_path = os.path.abspath(os.path.join(settings.LOG_ARCHIVE_LOCAL_DIR, name))
+        chunk_url = _get_chunk_url('file://{}'.format(archive_path), 0)
+    else:
+        raise ImproperlyConfigured('Unknown LOG_ARCHIVE_STORAGE: {!r}'.format(settings.LOG_ARCHIVE_STORAGE))
+
+    lines = (json.dumps({
+        'id': log_entry.pk,
+        'content_type_id': log_entry.content_type_id,
+        'object_id': log_entry.object_id,
+        'level': log_entry.level,
+        'text': log_entry.text,
+        'created': log_entry.created.isoformat(),
+    }) for log_entry in log_entries)
+    _write_blob(chunk_url, gzip.compress('\n'.join(lines).encode()))
+    return chunk_url
+
+
+def read_log_archive(url):
+    """
+    Return the list of (unsaved) log entries stored in the archive whose latest chunk is at `url`,
+    oldest first.
+
+    The URL is the one returned by `append_to_log_archive`, so archives remain readable if the
+    LOG_ARCHIVE_STORAGE setting changes.
+    """
+    log_entries = []
+    for chunk_url in _get_chunk_urls(url):
+        for line in gzip.decompress(_read_blob(chunk_url)).decode().splitlines():
+            fields = json.loads(line)
+            fields['created'] = parse_datetime(fields['created'])
+            log_entries.append(LogEntry(**fields))
+    # Entries written late (e.g. retried by the database log handler) can be older than the previous chunks
+    log_entries.sort(key=lambda log_entry: (log_entry.created, log_entry.pk))
+    return log_entries
+
+
+def delete_log_archive(url):
+    """
+    Delete all the chunks of the archive whose latest chunk is at `url`
+    """
+    chunk_urls = _get_chunk_urls(url)
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 'swift':
+        openstack.delete_from_swift_container(
+            parsed_url.netloc, [urlparse(chunk_url).path.lstrip('/') for chunk_url in chunk_urls],
+        )
+    elif parsed_url.scheme == 'file':
+        for chunk_url in chunk_urls:
+            try:
+                os.remove(urlparse(chunk_url).path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(parsed_url.path))
+        except OSError:
+            pass  # The directory holds other files, or is already gone
+    else:
+        raise ValueError('Unknown log archive URL: {}'.format(url))
@@ -59,7 +59,7 @@ class AppServerLoggerAdapter(logging.LoggerAdapter):
         msg, kwargs = super().process(msg, kwargs)
 
         app_server = self.extra['obj']
-        if app_server.instance:
+        if app_server and app_server.instance:
             msg = '{},{} | {}'.format(format_instance(app_server.instance), format_appserver(app_server), msg)
         return msg, kwargs
 
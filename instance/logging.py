@@ -22,12 +22,20 @@ Instance app - Logging utils
 
 # Imports #####################################################################
 
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from datetime import timedelta
 from functools import wraps
 import logging
+import os
+import queue
+import threading
+import time
 import traceback
 
 from django.apps import apps
-from django.db import connection, models, ProgrammingError
+from django.db import connection, models, IntegrityError, ProgrammingError
+from django.db.models.signals import post_delete, post_migrate
+from django.utils import timezone
 from swampdragon.pubsub_providers.data_publisher import publish_data
 
 from instance.serializers.logentry import LogEntrySerializer
@@ -35,11 +43,130 @@ from instance.serializers.logentry import LogEntrySerializer
 
 # Logging #####################################################################
 
+# Errors of the DBHandler itself: this logger must not be sent to the DBHandler (see `settings.LOGGING`)
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+LogShippingStats = namedtuple('LogShippingStats', ['queue_depth', 'max_queue_depth', 'written', 'dropped', 'orphaned'])
+
+# Types of objects which have their own log channel, by order of precedence
+LOG_CHANNEL_OBJECT_TYPES = ('appserver', 'server', 'instance')
+
+# Number of objects remembered to exist, and seconds after which they are checked again, since
+# objects deleted by other processes are only forgotten once they expire
+EXISTING_OBJECTS_CACHE_SIZE = 10000
+EXISTING_OBJECTS_CACHE_TIMEOUT = 300
+
+
+# Caches ######################################################################
+
+# Content type IDs of the models which log entries are attached to, by model class
+_content_type_ids = {}
+
+# (content_type_id, object_id) of the objects which log entries have been attached to, and which
+# still exist, by least recently used: further log entries can be attached to them without checking
+# that they exist, until the time they are mapped to
+_existing_objects = OrderedDict()
+_existing_objects_lock = threading.Lock()
+
+
 # Functions ###################################################################
 
+def get_log_channel(object_type, object_id):
+    """
+    Return the name of the pub/sub channel where the log entries of an object are published,
+    e.g. 'log:instance:12' (see `routers.LogRouter`)
+    """
+    return 'log:{}:{}'.format(object_type, object_id)
+
+
+def get_event_log_channel(event_context):
+    """
+    Return the log channel of the object described by an `event_context` dict, or None
+
+    AppServer contexts also include the ID of their instance, so they are checked first.
+    """
+    for object_type in LOG_CHANNEL_OBJECT_TYPES:
+        object_id = event_context.get('{}_id'.format(object_type))
+        if object_id is not None:
+            return get_log_channel(object_type, object_id)
+    return None
+
+
+def get_content_type_id(model):
+    """
+    Return the ID of the content type of a model class, memoized per class
+    """
+    try:
+        return _content_type_ids[model]
+    except KeyError:
+        content_type = apps.get_model('contenttypes', 'ContentType').objects.get_for_model(model)
+        _content_type_ids[model] = content_type.pk
+        return content_type.pk
+
+
+def is_existing_object(key):
+    """
+    Return whether the (content_type_id, object_id) `key` is known to exist, without having expired
+    """
+    with _existing_objects_lock:
+        expires = _existing_objects.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            del _existing_objects[key]
+            return False
+        _existing_objects.move_to_end(key)
+        return True
+
+
+def remember_existing_objects(keys):
+    """
+    Remember that the objects of the (content_type_id, object_id) `keys` exist, evicting the least
+    recently used objects beyond `EXISTING_OBJECTS_CACHE_SIZE`
+    """
+    expires = time.time() + EXISTING_OBJECTS_CACHE_TIMEOUT
+    with _existing_objects_lock:
+        for key in keys:
+            _existing_objects[key] = expires
+            _existing_objects.move_to_end(key)
+        while len(_existing_objects) > EXISTING_OBJECTS_CACHE_SIZE:
+            _existing_objects.popitem(last=False)
+
+
+def forget_existing_objects(keys):
+    """
+    Forget the objects of the (content_type_id, object_id) `keys`, so they are checked again
+    """
+    with _existing_objects_lock:
+        for key in keys:
+            _existing_objects.pop(key, None)
+
+
+def forget_deleted_object(sender, instance, **kwargs):
+    """
+    Signal handler - log entries attached to a deleted object must be checked again before being written
+    """
+    content_type_id = _content_type_ids.get(sender)
+    if content_type_id is not None:
+        forget_existing_objects([(content_type_id, instance.pk)])
+
+
+def clear_caches(**kwargs):
+    """
+    Signal handler - content types and objects may have been re-created after a migration or a flush
+    """
+    _content_type_ids.clear()
+    with _existing_objects_lock:
+        _existing_objects.clear()
+
+
+post_delete.connect(forget_deleted_object)
+post_migrate.connect(clear_caches)
+
+
 def log_exception(method):
     """
     Decorator to log uncaught exceptions on methods
@@ -60,38 +187,408 @@ def log_exception(method):
 class DBHandler(logging.Handler):
     """
     Records log messages in database models
+
+    Records are buffered, and written in batches using a single INSERT query. A batch is
+    written when it holds `capacity` records, `flush_interval` seconds after its oldest record,
+    as soon as a record of level `flush_level` or above is added to it, and when the handler is
+    flushed or closed (e.g. by `logging.shutdown()` on exit).
+
+    In synchronous mode, `flush_interval` is only checked when a record is emitted, since the
+    batch must be written from the thread which logged it, with its database connection: the
+    records of a logger which goes quiet stay buffered until it logs again, or until the handler
+    is flushed or closed. The writer thread applies `flush_interval` on its own in asynchronous mode.
+
+    With `asynchronous=True`, the records are passed to a background writer thread through a
+    queue holding at most `queue_size` records, so that logging never waits for the database.
+    When the writer can't keep up, DEBUG records are dropped once the queue is half full, and INFO
+    records once it is full. Records of level `flush_level` or above, and flushes, wait up to
+    `queue_timeout` seconds for room in the queue instead. DEBUG records only reach the handler if
+    its level lets them through; the `db` handler of the settings is at LOG_DB_LEVEL (INFO by default).
+
+    The number of written and dropped records, and the depth of the queue (see `get_stats()`), are
+    logged by the `instance.logging` logger at most every `stats_interval` seconds, after a batch is
+    written.
+
+    The writer thread uses its own database connection, so it can't see the objects created in a
+    transaction which isn't committed yet, e.g. an AppServer logging from `transaction.atomic()`.
+    The entries attached to objects which can't be found are retried with the next batches, for
+    up to `RETRY_TIMEOUT` seconds, and dropped after that. In synchronous mode, they are dropped
+    right away.
+
+    Dropped records are counted by level (see `get_stats()`), and reported by a warning log entry
+    written with the next batch.
     """
+    # Marker put in the queue, along with an event to set once written, to make the writer thread write
+    # its current batch right away
+    FLUSH = object()
+
+    # Seconds during which the writer thread retries the entries attached to objects it can't find
+    RETRY_TIMEOUT = 60
+
+    def __init__(self, level=logging.NOTSET, capacity=100, flush_interval=1, flush_level=logging.WARNING,
+                 asynchronous=False, queue_size=10000, queue_timeout=5, stats_interval=300):
+        super().__init__(level=level)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.buffer = []
+        self.buffer_started = None
+        self.asynchronous = asynchronous
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        self.max_queue_depth = 0
+        self.written = 0
+        self.dropped = Counter()
+        self.unreported_drops = Counter()
+        self.orphaned = Counter()
+        self.unreported_orphans = Counter()
+        self.drops_lock = threading.Lock()
+        self.stats_interval = stats_interval
+        self.stats_logged = time.time()
+
+    def handle(self, record):
+        """
+        Leave the records logged by the writer thread itself (e.g. by the database or pub/sub clients)
+        to the other handlers: queuing them could make the writer wait for the handler lock, held by a
+        thread waiting for room in the queue, or feed the queue with each batch it writes
+        """
+        if self.asynchronous and threading.current_thread() is self.writer:
+            return False
+        return super().handle(record)
+
     def emit(self, record):
         """
-        Handles an emitted log entry and stores it in the database, optionally linking it to the
-        model object `obj`
+        Handles an emitted log entry and buffers it, to be stored in the database, optionally
+        linking it to the model object `obj`
         """
         obj = record.__dict__.get('obj', None)
 
         if obj is None or not isinstance(obj, models.Model) or obj.pk is None:
-            content_type, object_id = None, None
+            content_type_id, object_id, event_context = None, None, None
         else:
-            content_type = apps.get_model('contenttypes', 'ContentType').objects.get_for_model(obj)
+            content_type_id = get_content_type_id(type(obj))
             object_id = obj.pk
+            event_context = getattr(obj, 'event_context', None)
+
+        log_entry = apps.get_model('instance', 'LogEntry')(
+            level=record.levelname,
+            text=self.format(record),
+            content_type_id=content_type_id,
+            object_id=object_id,
+            created=timezone.now(),
+        )
+        if self.asynchronous:
+            self._enqueue(record.levelno, (log_entry, event_context))
+            return
 
+        if not self.buffer:
+            self.buffer_started = time.time()
+        self.buffer.append((log_entry, event_context))
+
+        if (len(self.buffer) >= self.capacity or record.levelno >= self.flush_level or
+                time.time() - self.buffer_started >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the buffered log entries to the database, and publish them
+
+        In asynchronous mode, wait until the writer thread has written all the queued entries, for up
+        to `queue_timeout` seconds to queue the flush, and as much to write them.
+        """
+        if self.asynchronous:
+            if (self.writer is not None and self.writer_pid == os.getpid() and self.writer.is_alive() and
+                    threading.current_thread() is not self.writer):
+                flushed = threading.Event()
+                try:
+                    # Don't wait forever, in case the writer thread is stuck
+                    self.queue.put((self.FLUSH, flushed), timeout=self.queue_timeout)
+                except queue.Full:
+                    logger.warning('Could not flush the log entries, since the queue is full')
+                    return
+                if not flushed.wait(self.queue_timeout):
+                    logger.warning('Timed out waiting for the log entries to be written')
+            return
+
+        self.acquire()
+        try:
+            entries, self.buffer = self.buffer, []
+            written = self._write_batch(entries)
+            self._count_orphans([
+                entry for entry in entries if id(entry[0]) not in written and entry[0].content_type_id
+            ])
+            self._write_batch(self._get_drops_report())
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        Flush the buffered log entries before closing the handler
+        """
+        try:
+            self.flush()
+        finally:
+            super().close()
+
+    def get_stats(self):
+        """
+        Return statistics about the log entries handled in this process
+        """
+        with self.drops_lock:
+            dropped = dict(self.dropped)
+            orphaned = dict(self.orphaned)
+        return LogShippingStats(
+            queue_depth=self.queue.qsize() if self.queue is not None else 0,
+            max_queue_depth=self.max_queue_depth,
+            written=self.written,
+            dropped=dropped,
+            orphaned=orphaned,
+        )
+
+    def _enqueue(self, levelno, entry):
+        """
+        Pass a log entry to the writer thread, applying the backpressure policy when the queue is filling up
+        """
+        self._start_writer()
+        try:
+            if levelno >= self.flush_level:
+                # Don't wait forever, in case the writer thread is stuck
+                self.queue.put((levelno, entry), timeout=self.queue_timeout)
+            elif levelno <= logging.DEBUG and self.queue.qsize() >= self.queue_size // 2:
+                raise queue.Full
+            else:
+                self.queue.put_nowait((levelno, entry))
+        except queue.Full:
+            level = logging.getLevelName(levelno)
+            with self.drops_lock:
+                self.dropped[level] += 1
+                self.unreported_drops[level] += 1
+        else:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def _start_writer(self):
+        """
+        Start the writer thread, if it isn't running in this process yet (e.g. after a fork)
+        """
+        if self.writer is not None and self.writer_pid == os.getpid():
+            return
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.writer_pid = os.getpid()
+        self.writer = threading.Thread(target=self._run_writer, args=(self.queue, ), name='DBHandler', daemon=True)
+        self.writer.start()
+
+    def _run_writer(self, entries_queue):
+        """
+        Writer thread: collect the queued (levelno, entry) items in batches, and write them
+
+        Flushes are queued as (FLUSH, event) items, whose event is set once the batch is written.
+        The entries which couldn't be written because their object wasn't found are retried with
+        the next batch, which is written after `flush_interval` seconds at most while there are any.
+        """
+        retries = []
+        while True:
+            batch = self._get_batch(entries_queue, timeout=self.flush_interval if retries else None)
+            entries = retries + [entry for levelno, entry in batch if levelno is not self.FLUSH]
+            try:
+                written = self._write_batch(entries + self._get_drops_report())
+            except Exception: # pylint: disable=broad-except
+                # Don't let the writer thread die, and make sure to reconnect for the next batch.
+                logger.exception('Could not write %d log entries to the database', len(entries))
+                connection.close()
+                retries = []
+            else:
+                retries = self._get_retries(entries, written)
+            for levelno, flushed in batch:
+                if levelno is self.FLUSH:
+                    flushed.set()
+
+    def _get_batch(self, entries_queue, timeout=None):
+        """
+        Wait for the next queued items and return them, or return an empty batch after `timeout` seconds
+        """
         try:
-            log_entry = apps.get_model('instance', 'LogEntry').objects.create(
-                level=record.levelname, text=self.format(record), content_type=content_type, object_id=object_id
+            batch = [entries_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.capacity and batch[-1][0] is not self.FLUSH and batch[-1][0] < self.flush_level:
+            try:
+                batch.append(entries_queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _get_retries(self, entries, written):
+        """
+        Return the entries attached to an object which weren't written, and which are recent enough to be
+        retried. The older ones are dropped.
+        """
+        oldest = timezone.now() - timedelta(seconds=self.RETRY_TIMEOUT)
+        retries = []
+        orphans = []
+        for log_entry, event_context in entries:
+            if id(log_entry) not in written and log_entry.content_type_id:
+                (retries if log_entry.created >= oldest else orphans).append((log_entry, event_context))
+        self._count_orphans(orphans)
+        return retries
+
+    def _count_orphans(self, entries):
+        """
+        Count the entries dropped because the object they are attached to doesn't exist
+        """
+        with self.drops_lock:
+            for log_entry, dummy in entries:
+                self.orphaned[log_entry.level] += 1
+                self.unreported_orphans[log_entry.level] += 1
+
+    def _get_drops_report(self):
+        """
+        Return log entries summarizing the records dropped since the last report, if any
+        """
+        with self.drops_lock:
+            drops, self.unreported_drops = self.unreported_drops, Counter()
+            orphans, self.unreported_orphans = self.unreported_orphans, Counter()
+        text = '{name:<25.25s} | Dropped {total} log entries, {reason} ({levels})'
+        reports = []
+        for counts, reason in ((drops, 'because they were logged faster than stored'),
+                               (orphans, "because the objects they are attached to don't exist")):
+            if not counts:
+                continue
+            log_entry = apps.get_model('instance', 'LogEntry')(
+                level='WARNING',
+                text=text.format(
+                    name=__name__,
+                    total=sum(counts.values()),
+                    reason=reason,
+                    levels=', '.join('{}: {}'.format(level, count) for level, count in sorted(counts.items())),
+                ),
+                created=timezone.now(),
             )
+            reports.append((log_entry, None))
+        return reports
+
+    def _write_batch(self, entries):
+        """
+        Write and publish a batch of (log_entry, event_context) tuples
+
+        Returns the `id()` of the log entries which have been written.
+        """
+        if not entries:
+            return set()
+        written = {id(log_entry) for log_entry in self._write([log_entry for log_entry, _ in entries])}
+        self.written += len(written)
+        self._publish([entry for entry in entries if id(entry[0]) in written])
+        self._log_stats()
+        return written
+
+    def _log_stats(self):
+        """
+        Log the statistics of the handler, if they haven't been logged for `stats_interval` seconds
+
+        They are logged by the `instance.logging` logger, which isn't sent to this handler.
+        """
+        now = time.time()
+        if now - self.stats_logged < self.stats_interval:
+            return
+        self.stats_logged = now
+        stats = self.get_stats()
+        def format_counts(counts):
+            """ Format the given counts by level """
+            return ', '.join('{}: {}'.format(level, count) for level, count in sorted(counts.items())) or 0
+        logger.info(
+            'Log entries written: %d, queued: %d (at most %d), dropped: %s, orphaned: %s',
+            stats.written, stats.queue_depth, stats.max_queue_depth,
+            format_counts(stats.dropped), format_counts(stats.orphaned),
+        )
+
+    @staticmethod
+    def _write(log_entries, retry=True):
+        """
+        Insert a batch of log entries, using one INSERT query
+
+        Log entries are created internally, so they aren't validated one by one. The objects they
+        are attached to are checked to exist, since this constraint isn't enforced by the database,
+        but only when they aren't remembered to exist, with one query per type of object.
+
+        If the INSERT fails because a content type doesn't exist anymore, e.g. after a flush, the
+        cached objects and content types are forgotten, and the batch is checked and written again,
+        unless this would run in a transaction which the error has broken.
+
+        Returns the log entries which have been written.
+        """
+        log_entry_model = apps.get_model('instance', 'LogEntry')
+        invalid_objects = DBHandler._get_invalid_objects(log_entries)
+
+        # Entries attached to objects which don't exist (anymore) would not pass validation
+        valid_entries = [
+            log_entry for log_entry in log_entries
+            if (log_entry.content_type_id, log_entry.object_id) not in invalid_objects
+        ]
+        try:
+            log_entry_model.objects.bulk_create(valid_entries)
         except ProgrammingError:
             # This can occur if django tries to log something before migrations have created the log table.
             # Make sure that is actually what happened:
             assert 'instance_logentry' not in connection.introspection.table_names()
+            return []
+        except IntegrityError:
+            forget_existing_objects((log_entry.content_type_id, log_entry.object_id) for log_entry in valid_entries)
+            _content_type_ids.clear()
+            apps.get_model('contenttypes', 'ContentType').objects.clear_cache()
+            if not retry or connection.in_atomic_block:
+                raise
+            return DBHandler._write(log_entries, retry=False)
+        return valid_entries
+
+    @staticmethod
+    def _get_invalid_objects(log_entries):
+        """
+        Return the (content_type_id, object_id) of the objects which log entries are attached to,
+        and which don't exist, checking the objects which aren't remembered to exist
+        """
+        content_type_model = apps.get_model('contenttypes', 'ContentType')
+        object_ids = defaultdict(set)
+        for log_entry in log_entries:
+            if log_entry.content_type_id and not is_existing_object((log_entry.content_type_id, log_entry.object_id)):
+                object_ids[log_entry.content_type_id].add(log_entry.object_id)
+
+        invalid_objects = set()
+        for content_type_id, ids in object_ids.items():
+            try:
+                content_type = content_type_model.objects.get_for_id(content_type_id)
+            except content_type_model.DoesNotExist:
+                invalid_objects.update((content_type_id, object_id) for object_id in ids)
+                continue
+            existing_ids = set(content_type.get_all_objects_for_this_type(pk__in=ids).values_list('pk', flat=True))
+            invalid_objects.update((content_type_id, object_id) for object_id in ids - existing_ids)
+            remember_existing_objects((content_type_id, object_id) for object_id in existing_ids)
+        return invalid_objects
+
+    @staticmethod
+    def _publish(entries):
+        """
+        Send notice of entries related to any resource, on the log channel of that resource.
+        Skip generic log entries that occur in debug mode, like "GET /static/img/favicon/favicon-96x96.png"
+
+        The entries of each object are coalesced into a single `object_log_lines` event per batch,
+        so a busy provisioning run sends a few events per second rather than one per line.
+        """
+        log_events = OrderedDict()
+        for log_entry, event_context in entries:
+            channel = get_event_log_channel(event_context) if event_context else None
+            if channel is None:
+                continue
+            if channel not in log_events:
+                log_events[channel] = {
+                    'type': 'object_log_lines',
+                    'log_entries': [],
+                }
+                log_events[channel].update(event_context)
+            log_events[channel]['log_entries'].append(LogEntrySerializer(log_entry).data)
 
-        # Send notice of entries related to any resource. Skip generic log entries that occur
-        # in debug mode, like "GET /static/img/favicon/favicon-96x96.png":
-        if content_type:
-            log_event = {
-                'type': 'object_log_line',
-                'log_entry': LogEntrySerializer(log_entry).data
-            }
-            if hasattr(obj, 'event_context'):
-                log_event.update(obj.event_context)
+        for channel, log_event in log_events.items():
             # TODO: Filter out log entries for which the user doesn't have view rights
-            # TODO: More targetted events - only emit events for what the user is looking at
-            publish_data('log', log_event)
+            publish_data(channel, log_event)
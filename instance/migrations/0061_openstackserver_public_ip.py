@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0060_mark_successful_instances'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openstackserver',
+            name='_public_ip',
+            field=models.GenericIPAddressField(blank=True, db_column='public_ip', null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 11:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0061_openstackserver_public_ip'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openstackserver',
+            name='status_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
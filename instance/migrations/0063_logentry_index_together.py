@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0062_openstackserver_status_checked_at'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='logentry',
+            index_together=set([('content_type', 'object_id', 'created')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 15:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0063_logentry_index_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openedxappserver',
+            name='log_archive',
+            field=models.CharField(blank=True, help_text='URL of the compressed archive holding the older log entries of this AppServer and its VM.', max_length=255),
+        ),
+    ]
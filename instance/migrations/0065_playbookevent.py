@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 16:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields.json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0064_openedxappserver_log_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaybookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('playbook', models.CharField(help_text='Path of the playbook within its repository.', max_length=255)),
+                ('role', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('task', models.CharField(db_index=True, max_length=255)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('changed', 'Changed'), ('skipped', 'Skipped'), ('failed', 'Failed'), ('unreachable', 'Unreachable')], max_length=11)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Duration of the task on this host, in seconds.')),
+                ('result', django_extensions.db.fields.json.JSONField(blank=True, default={}, help_text='Summary of the result of failed tasks.')),
+                ('appserver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='playbook_events', to='instance.OpenEdXAppServer')),
+            ],
+            options={
+                'ordering': ('started', 'id'),
+            },
+        ),
+    ]
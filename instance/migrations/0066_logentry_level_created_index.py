@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-10-17 18:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0065_playbookevent'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='logentry',
+            index_together=set([('content_type', 'object_id', 'created'), ('level', 'created')]),
+        ),
+    ]
@@ -26,13 +26,15 @@ import logging
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
 from django.db.models import Q
 from django_extensions.db.models import TimeStampedModel
 
+from instance.log_archive import append_to_log_archive, delete_log_archive, read_log_archive
 from instance.logger_adapter import AppServerLoggerAdapter
 from .instance import InstanceReference
-from .log_entry import LogEntry
+from .log_entry import LogEntry, parse_log_cursor
 from .server import OpenStackServer
 from .utils import ModelResourceStateDescriptor, ResourceState, ValidateModelMixin
 
@@ -162,6 +164,17 @@ class AppServer(ValidateModelMixin, TimeStampedModel):
     server = models.OneToOneField(OpenStackServer, on_delete=models.CASCADE, related_name='+')
     # The Instance that owns this. InstanceReference has related_name accessors like 'openedxappserver_set'
     owner = models.ForeignKey(InstanceReference, on_delete=models.CASCADE, related_name='%(class)s_set')
+    # Older log entries are moved to a compressed archive - see archive_log_entries()
+    log_archive = models.CharField(
+        max_length=255, blank=True,
+        help_text='URL of the compressed archive holding the older log entries of this AppServer and its VM.',
+    )
+
+    # AppServers which are done, and won't log much anymore, whose logs can be archived:
+    ARCHIVABLE_STATUSES = (Status.ConfigurationFailed, Status.Error, Status.Terminated)
+
+    # Logger of the class methods, replaced by an instance logger in __init__()
+    logger = AppServerLoggerAdapter(logger, {'obj': None})
 
     class Meta:
         abstract = True
@@ -170,6 +183,7 @@ class AppServer(ValidateModelMixin, TimeStampedModel):
         super().__init__(*args, **kwargs)
 
         self.logger = AppServerLoggerAdapter(logger, {'obj': self})
+        self._archived_log_entries = None
 
     def __str__(self):
         return self.name
@@ -210,13 +224,10 @@ class AppServer(ValidateModelMixin, TimeStampedModel):
         if self.status == Status.Running:
             self._status_to_terminated()
 
-    def _get_log_entries(self, level_list=None, limit=None):
+    def _get_log_entries_queryset(self, level_list=None):
         """
-        Return the list of log entry instances for this AppServer and the server it manages,
-        optionally filtering by logging level. If a limit is given, only the latest records are
-        returned.
-
-        Returns oldest entries first.
+        Return a queryset of the log entries for this AppServer and the server it manages,
+        optionally filtering by logging level.
         """
         # TODO: Filter out log entries for which the user doesn't have view rights
         appserver_type = ContentType.objects.get_for_model(self)
@@ -227,11 +238,106 @@ class AppServer(ValidateModelMixin, TimeStampedModel):
         )
         if level_list:
             entries = entries.filter(level__in=level_list)
+        return entries
+
+    def _get_archived_log_entries(self, level_list=None):
+        """
+        Return the list of log entries moved to the archive of this AppServer, oldest first,
+        optionally filtering by logging level.
+        """
+        if not self.log_archive:
+            return []
+        if self._archived_log_entries is None:
+            self._archived_log_entries = read_log_archive(self.log_archive)
+        if level_list:
+            return [entry for entry in self._archived_log_entries if entry.level in level_list]
+        return self._archived_log_entries
+
+    def _get_log_entries(self, level_list=None, limit=None):
+        """
+        Return the list of log entry instances for this AppServer and the server it manages,
+        optionally filtering by logging level. If a limit is given, only the latest records are
+        returned.
+
+        Archived entries are included. Returns oldest entries first.
+        """
+        entries = self._get_log_entries_queryset(level_list=level_list)
         if limit:
             # Apply the limit at the SQL/DB level while sorted by descending date, then reverse.
             # Otherwise, we'd have to retrieve all rows and then apply the limit using python.
-            return reversed(list(entries[:limit]))
-        return entries.order_by('created')
+            entries = list(entries[:limit])
+            entries.reverse()
+            missing = limit - len(entries)
+            archived_entries = self._get_archived_log_entries(level_list=level_list)[-missing:] if missing else []
+        else:
+            entries = list(entries.order_by('created'))
+            archived_entries = self._get_archived_log_entries(level_list=level_list)
+        # Archived entries are always older than the entries left in the database
+        return archived_entries + entries
+
+    def get_log_entries_page(self, before=None, limit=None, level_list=None):
+        """
+        Return a page of log entries for this AppServer and the server it manages, optionally
+        filtering by logging level, and the cursor of the previous page. See `LogEntryQuerySet.page`.
+
+        Once the entries left in the database are exhausted, pages are read from the archive.
+        """
+        if limit is None:
+            limit = settings.LOG_PAGE_SIZE
+        entries, previous_page = self._get_log_entries_queryset(level_list=level_list).page(before=before, limit=limit)
+        if previous_page or not self.log_archive:
+            return entries, previous_page
+
+        archived_entries = self._get_archived_log_entries(level_list=level_list)
+        if before:
+            before = parse_log_cursor(before)
+            archived_entries = [entry for entry in archived_entries if (entry.created, entry.pk) < before]
+        missing = limit - len(entries)
+        page_entries = archived_entries[-missing:] if missing else []
+        entries = page_entries + entries
+        if entries and len(archived_entries) > len(page_entries):
+            previous_page = entries[0].cursor
+        return entries, previous_page
+
+    def archive_log_entries(self, before):
+        """
+        Move the log entries of this AppServer and the server it manages which were created
+        before the given date into a new chunk of the compressed archive of this AppServer.
+
+        Returns the number of archived entries.
+        """
+        entries = self._get_log_entries_queryset().filter(created__lt=before)
+        new_entries = list(entries.order_by('created', 'pk'))
+        if not new_entries:
+            return 0
+
+        archive_name = '{}-{}'.format(self._meta.model_name, self.pk)
+        log_archive = append_to_log_archive(self.log_archive, archive_name, new_entries)
+        # If this fails, the next run overwrites the chunk, so the entries aren't archived twice
+        with transaction.atomic():
+            # AppServers are immutable, so this field is updated without calling save()
+            type(self).objects.filter(pk=self.pk).update(log_archive=log_archive)
+            # Entries logged meanwhile with an older date (e.g. retries) have higher ids, and are kept
+            entries.filter(pk__lte=max(entry.pk for entry in new_entries)).delete_in_chunks()
+        self.log_archive = log_archive
+        self._archived_log_entries = None
+        return len(new_entries)
+
+    @staticmethod
+    def on_post_delete(sender, instance, using, **kwargs):
+        """
+        Whenever an AppServer is deleted, delete its log archive once the transaction is committed
+        """
+        if not isinstance(instance, AppServer) or not instance.log_archive:
+            return
+
+        def delete_archive():
+            """ Delete the archive, without failing the deletion of the AppServer """
+            try:
+                delete_log_archive(instance.log_archive)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Could not delete the log archive %s of %s', instance.log_archive, instance)
+        transaction.on_commit(delete_archive, using=using)
 
     @property
     def log_entries(self):
@@ -247,3 +353,6 @@ class AppServer(ValidateModelMixin, TimeStampedModel):
         server it manages
         """
         return self._get_log_entries(level_list=['ERROR', 'CRITICAL'])
+
+
+post_delete.connect(AppServer.on_post_delete)
@@ -118,6 +118,9 @@ class Instance(ValidateModelMixin, models.Model):
     # in a query, e.g. to do .select_related('ref_set')
     ref_set = GenericRelation(InstanceReference, content_type_field='instance_type', object_id_field='instance_id')
 
+    # Logger of the class methods, replaced by an instance logger in __init__()
+    logger = InstanceLoggerAdapter(logger, {'obj': None})
+
     class Meta:
         abstract = True
 
@@ -185,6 +188,19 @@ class Instance(ValidateModelMixin, models.Model):
         """
         return {'instance_id': self.ref.pk, 'instance_type': self.__class__.__name__}
 
+    def _get_log_entries_queryset(self, level_list=None):
+        """
+        Return a queryset of the log entries for this Instance, optionally filtering by logging level.
+
+        Does NOT include log entries of associated AppServers or Servers (VMs)
+        """
+        instance_type = ContentType.objects.get_for_model(self)
+        # TODO: Filter out log entries for which the user doesn't have view rights
+        entries = LogEntry.objects.filter(content_type=instance_type, object_id=self.pk)
+        if level_list:
+            entries = entries.filter(level__in=level_list)
+        return entries
+
     @property
     def log_entries(self):
         """
@@ -193,11 +209,14 @@ class Instance(ValidateModelMixin, models.Model):
         Does NOT include log entries of associated AppServers or Servers (VMs)
         """
         limit = settings.LOG_LIMIT
+        return reversed(list(self._get_log_entries_queryset()[:limit]))
 
-        instance_type = ContentType.objects.get_for_model(self)
-        entries = LogEntry.objects.filter(content_type=instance_type, object_id=self.pk)
-        # TODO: Filter out log entries for which the user doesn't have view rights
-        return reversed(list(entries[:limit]))
+    def get_log_entries_page(self, before=None, limit=None, level_list=None):
+        """
+        Return a page of log entries for this Instance, optionally filtering by logging level,
+        and the cursor of the previous page. See `LogEntryQuerySet.page`.
+        """
+        return self._get_log_entries_queryset(level_list=level_list).page(before=before, limit=limit)
 
     def delete(self, *args, **kwargs):
         """
@@ -22,13 +22,21 @@ Instance app models - LogEntry
 
 # Imports #####################################################################
 
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
 import logging
+import operator
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.db.models.signals import post_delete
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_extensions.db.models import TimeStampedModel
 
 from .utils import ValidateModelMixin
@@ -38,9 +46,143 @@ from .utils import ValidateModelMixin
 logger = logging.getLogger(__name__)
 
 
+# Functions ###################################################################
+
+
+def parse_log_cursor(cursor):
+    """
+    Parse a log entry cursor, as returned by `LogEntry.cursor`, into a (created, pk) tuple.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    created, dummy, pk = cursor.rpartition(',')
+    created = parse_datetime(created)
+    if created is None or not pk.isdigit():
+        raise ValueError('Invalid log cursor: {!r}'.format(cursor))
+    if timezone.is_naive(created):
+        created = timezone.make_aware(created, timezone.utc)
+    return created, int(pk)
+
+
+# Classes #####################################################################
+
+
+class PendingLogDeletion:
+    """
+    Log entries of the objects deleted in a transaction, to be deleted in bulk once it's committed
+
+    Instances are registered as `on_commit` callbacks, one per transaction (or savepoint), so the
+    pending deletions are dropped along with the callback if the transaction is rolled back.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.object_ids = defaultdict(set)
+
+    @classmethod
+    def add(cls, using, content_type, object_id):
+        """
+        Schedule the deletion of the log entries of the given object, when the current transaction
+        is committed (or immediately, in autocommit mode)
+        """
+        connection = transaction.get_connection(using)
+        # Reuse the callback registered by a previous deletion in the same transaction & savepoint
+        savepoint_ids = set(connection.savepoint_ids)
+        for callback_savepoint_ids, callback in reversed(connection.run_on_commit):
+            if isinstance(callback, cls) and callback_savepoint_ids == savepoint_ids:
+                callback.object_ids[content_type.pk].add(object_id)
+                return
+        pending_log_deletion = cls(using)
+        pending_log_deletion.object_ids[content_type.pk].add(object_id)
+        transaction.on_commit(pending_log_deletion, using=using)
+
+    def __call__(self):
+        """
+        Delete the log entries of all the objects, with one query per content type
+        """
+        for content_type_id, object_ids in self.object_ids.items():
+            log_entries = LogEntry.objects.using(self.using).filter(
+                content_type_id=content_type_id, object_id__in=object_ids,
+            )
+            # Skip the collector, which would fetch the entries to send post_delete signals:
+            num_deleted = log_entries._raw_delete(self.using)  # pylint: disable=protected-access
+            if num_deleted > 0:
+                logger.info(
+                    'Deleted %d log entries for %d deleted %s instance(s)',
+                    num_deleted, len(object_ids), ContentType.objects.get_for_id(content_type_id).name,
+                )
+
+
 # Models ######################################################################
 
 
+class LogEntryQuerySet(models.QuerySet):
+    """
+    Additional methods for log entry querysets
+    Also used as the standard manager for the LogEntry model (`LogEntry.objects`)
+    """
+    def page(self, before=None, limit=None):
+        """
+        Return a page of at most `limit` log entries, older than the `before` cursor if given.
+
+        Rows are read newest first and filtered on (created, id), so with the
+        (content_type, object_id, created) index only the rows of the requested page are read,
+        however long the log is. Returns a tuple of the entries (oldest first) and the cursor to
+        pass as `before` to get the previous page, which is None when there are no older entries.
+        """
+        if limit is None:
+            limit = settings.LOG_PAGE_SIZE
+        entries = self.order_by('-created', '-pk')
+        if before:
+            created, pk = parse_log_cursor(before)
+            entries = entries.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+        # Fetch one extra row to know whether there are older entries left:
+        entries = list(entries[:limit + 1])
+        before = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            before = entries[-1].cursor
+        entries.reverse()
+        return entries, before
+
+    def expired(self):
+        """
+        Filter the log entries which are past their retention period
+
+        Warnings and errors are kept for LOG_ERROR_RETENTION_DAYS, and the other entries for
+        LOG_RETENTION_DAYS. The (level, created) index is used to find the expired entries.
+        """
+        now = timezone.now()
+        expired = [
+            Q(level__in=levels, created__lt=now - timedelta(days=days))
+            for levels, days in (
+                (self.model.WARNING_LEVELS, settings.LOG_ERROR_RETENTION_DAYS),
+                (self.model.DEBUG_LEVELS, settings.LOG_RETENTION_DAYS),
+            ) if days
+        ]
+        if not expired:
+            return self.none()
+        return self.filter(reduce(operator.or_, expired))
+
+    def delete_in_chunks(self, chunk_size=None):
+        """
+        Delete the log entries of the queryset, `chunk_size` rows at a time
+
+        Each chunk is deleted by primary key in its own short query, so that the table isn't locked
+        while a large number of entries is deleted. No signals are sent for the deleted entries.
+        Returns the number of deleted entries.
+        """
+        if chunk_size is None:
+            chunk_size = settings.LOG_RETENTION_CHUNK_SIZE
+        num_deleted = 0
+        while True:
+            pks = list(self.order_by().values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return num_deleted
+            # Skip the collector, which would fetch the entries to send post_delete signals:
+            chunk = self.model.objects.filter(pk__in=pks)
+            num_deleted += chunk._raw_delete(self.db)  # pylint: disable=protected-access
+
+
 class LogEntry(ValidateModelMixin, TimeStampedModel):
     """
     Single log entry
@@ -52,6 +194,9 @@ class LogEntry(ValidateModelMixin, TimeStampedModel):
         ('ERROR', 'Error'),
         ('CRITICAL', 'Critical'),
     )
+    # Levels of the entries kept for LOG_ERROR_RETENTION_DAYS, and of those kept for LOG_RETENTION_DAYS
+    WARNING_LEVELS = ('WARNING', 'ERROR', 'CRITICAL')
+    DEBUG_LEVELS = ('DEBUG', 'INFO')
 
     text = models.TextField(blank=True)
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
@@ -59,8 +204,14 @@ class LogEntry(ValidateModelMixin, TimeStampedModel):
     content_object = GenericForeignKey('content_type', 'object_id')
     level = models.CharField(max_length=9, db_index=True, default='INFO', choices=LOG_LEVEL_CHOICES)
 
+    objects = LogEntryQuerySet().as_manager()
+
     class Meta:
         ordering = ('-created', )
+        index_together = (
+            ('content_type', 'object_id', 'created'),
+            ('level', 'created'),
+        )
         permissions = (
             ("read_log_entry", "Can read LogEntry"),
         )
@@ -69,6 +220,13 @@ class LogEntry(ValidateModelMixin, TimeStampedModel):
     def __str__(self):
         return '{0.created:%Y-%m-%d %H:%M:%S} | {0.level:>8s} | {0.text}'.format(self)
 
+    @property
+    def cursor(self):
+        """
+        Opaque position of this entry in its log, used to paginate log entries (see `LogEntryQuerySet.page`)
+        """
+        return '{:%Y-%m-%dT%H:%M:%S.%f}Z,{}'.format(timezone.localtime(self.created, timezone.utc), self.pk)
+
     def clean_fields(self, **kwargs):
         """
         Clean fields, including the 'object_id' field
@@ -82,24 +240,22 @@ class LogEntry(ValidateModelMixin, TimeStampedModel):
             if not self.content_type_id or not self.object_id:
                 raise ValidationError('LogEntry content_type and object_id must both be set or both be None.')
             # Ensure that the object_id (primary key) is valid:
-            if not self.content_type.get_all_objects_for_this_type(pk=self.object_id).exists():
+            content_type = ContentType.objects.get_for_id(self.content_type_id)
+            if not content_type.get_all_objects_for_this_type(pk=self.object_id).exists():
                 raise ValidationError({'object_id': 'Object attached to LogEntry has bad content_type or primary key'})
 
     @staticmethod
-    def on_post_delete(sender, instance, **kwargs):
+    def on_post_delete(sender, instance, using, **kwargs):
         """
-        Whenever an object is deleted, check if there are corresponding log entries to delete.
+        Whenever an object is deleted, schedule the deletion of its log entries.
+
+        The log entries are deleted in bulk when the transaction is committed, so that deleting
+        many objects at once doesn't run one query per object (see `PendingLogDeletion`).
         """
         if isinstance(instance, LogEntry) or instance._meta.app_label == 'migrations':
             return  # Avoid pointless database queries when deleting log entries themselves or saving migration history
         if not isinstance(instance.pk, int):
             return  # Current LogEntry schema requires integer objects IDs, so we know this object isn't in the table
-        content_type = ContentType.objects.get_for_model(instance)
-        num_deleted, dummy = LogEntry.objects.filter(content_type=content_type, object_id=instance.pk).delete()
-        if num_deleted > 0:
-            logger.info(
-                'Deleted %d log entries for deleted %s instance with ID %d',
-                num_deleted, content_type.name, instance.pk
-            )
+        PendingLogDeletion.add(using, ContentType.objects.get_for_model(instance), instance.pk)
 
 post_delete.connect(LogEntry.on_post_delete)
@@ -22,13 +22,16 @@ Instance app model mixins - Ansible
 
 # Imports #####################################################################
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack
 import os
+from tempfile import SpooledTemporaryFile
 
 from django.conf import settings
 from django.db import models
 
 from instance import ansible
+from instance.models.playbook_event import PlaybookEvent
 from instance.repo import open_repository
 from instance.utils import poll_streams
 
@@ -64,22 +67,64 @@ class AnsibleAppServerMixin(models.Model):
         return []
 
     @property
-    def inventory_str(self):
+    def inventory_host(self):
         """
-        The ansible inventory (list of servers) as a string
+        The host of the AppServer's VM in ansible inventories
         """
         public_ip = self.server.public_ip
         if public_ip is None:
             raise RuntimeError("Cannot prepare to run playbooks when server has no public IP.")
-        return '[app]\n{server_ip}'.format(server_ip=public_ip)
+        return public_ip
+
+    @property
+    def inventory_str(self):
+        """
+        The ansible inventory (list of servers) as a string
+        """
+        return '[app]\n{server_ip}'.format(server_ip=self.inventory_host)
 
-    def _run_playbook(self, working_dir, playbook):
+    @staticmethod
+    def _make_log_file():
+        """
+        Create a file to collect the output of playbooks, which is only written to disk once it
+        grows bigger than ANSIBLE_LOG_SPOOL_SIZE
+        """
+        return SpooledTemporaryFile(max_size=settings.ANSIBLE_LOG_SPOOL_SIZE)
+
+    @staticmethod
+    def _write_log_line(log_file, line):
+        """
+        Write a line of playbook output, as read by `poll_streams()`, to a log file
+        """
+        log_file.write(line)
+        if not line.endswith(b'\n'):
+            log_file.write(b'\n')
+
+    def _make_playbook_event(self, playbook, event):
+        """
+        Create an (unsaved) PlaybookEvent of this AppServer from an event of a playbook run, as
+        returned by `ansible.parse_playbook_event()`
+        """
+        return PlaybookEvent(
+            appserver=self,
+            playbook=playbook.playbook_path,
+            role=event['role'][:255],
+            task=event['task'][:255],
+            status=event['status'],
+            started=event['started'],
+            duration=event['duration'],
+            result=event['result'],
+        )
+
+    def _run_playbook(self, working_dir, playbook, log_file):
         """
         Run a playbook against the AppServer's VM
+
+        The output of the playbook is logged, and written to the binary file `log_file`; the
+        results of its tasks are stored as PlaybookEvents. Returns the exit code of ansible-playbook.
         """
         playbook_path = os.path.join(working_dir, playbook.playbook_path)
 
-        log_lines = []
         with ansible.run_playbook(
             requirements_path=os.path.join(working_dir, playbook.requirements_path),
             inventory_str=self.inventory_str,
@@ -88,40 +133,224 @@ class AnsibleAppServerMixin(models.Model):
             playbook_name=os.path.basename(playbook_path),
             username=settings.OPENSTACK_SANDBOX_SSH_USERNAME,
         ) as process:
+            events = []
             try:
                 log_line_generator = poll_streams(
                     process.stdout,
                     process.stderr,
+                    process.events,
                     line_timeout=settings.ANSIBLE_LINE_TIMEOUT,
                     global_timeout=settings.ANSIBLE_GLOBAL_TIMEOUT,
                 )
                 for f, line in log_line_generator:
-                    line = line.decode('utf-8').rstrip()
+                    if f == process.events:
+                        event = ansible.parse_playbook_event(line)
+                        if event is not None:
+                            events.append(self._make_playbook_event(playbook, event))
+                        continue
+                    self._write_log_line(log_file, line)
+                    line = line.decode('utf-8', errors='replace').rstrip()
                     if f == process.stdout:
                         self.logger.info(line)
                     elif f == process.stderr:
                         self.logger.error(line)
-                    log_lines.append(line)
             except TimeoutError:
                 self.logger.error('Playbook run timed out.  Terminating the Ansible process.')
                 process.terminate()
             process.wait()
-            return log_lines, process.returncode
+            PlaybookEvent.objects.bulk_create(events)
+            return process.returncode
 
     def run_ansible_playbooks(self):
         """
         Provision the server using ansible
+
+        Returns a tuple of the output of the playbooks, in a binary file object, and the exit code
+        of the last playbook run. The caller must close the file object.
         """
-        log = []
-        for playbook in self.get_playbooks():
-            with open_repository(playbook.source_repo, ref=playbook.version) as configuration_repo:
-                self.logger.info('Running playbook "%s" from "%s"', playbook.playbook_path, playbook.source_repo)
-                playbook_log, returncode = self._run_playbook(configuration_repo.working_dir, playbook)
-                log += playbook_log
-                if returncode != 0:
-                    self.logger.error('Playbook failed for AppServer %s', self)
-                    break
+        log = self._make_log_file()
+        try:
+            with ExitStack() as stack:
+                # Playbooks from the same repository & version share a single checkout
+                repositories = {}
+                for playbook in self.get_playbooks():
+                    repository_key = (playbook.source_repo, playbook.version)
+                    if repository_key not in repositories:
+                        repositories[repository_key] = stack.enter_context(
+                            open_repository(playbook.source_repo, ref=playbook.version)
+                        )
+                    configuration_repo = repositories[repository_key]
+                    self.logger.info('Running playbook "%s" from "%s"', playbook.playbook_path, playbook.source_repo)
+                    returncode = self._run_playbook(configuration_repo.working_dir, playbook, log)
+                    if returncode != 0:
+                        self.logger.error('Playbook failed for AppServer %s', self)
+                        break
+        except:  # pylint: disable=bare-except
+            log.close()
+            raise
 
         if returncode == 0:
             self.logger.info('Playbooks completed for AppServer %s', self)
         return (log, returncode)
+
+    @classmethod
+    def _log_batch_output(cls, appservers, output_splitter, log_files, raw_line, is_error):
+        """
+        Log a line of the output of a batched playbook run, and write it to the log files of the
+        AppServers it's about, according to the `output_splitter` of its stream - as an error for the
+        lines of stderr (`is_error`)
+
+        `appservers` is a dict of the AppServers by inventory host, and `log_files` a dict of their
+        log files by primary key.
+        """
+        line = raw_line.decode('utf-8', errors='replace').rstrip()
+        for host in output_splitter.split(line):
+            cls._write_log_line(log_files[appservers[host].pk], raw_line)
+            if is_error:
+                appservers[host].logger.error(line)
+            else:
+                appservers[host].logger.info(line)
+
+    @classmethod
+    def _run_playbook_batch(cls, working_dir, appserver_playbooks, log_files):
+        """
+        Run a playbook against the VMs of several AppServers at once, with the variables of each
+        AppServer passed for its VM only (see `ansible.write_batch_inventory`)
+
+        `appserver_playbooks` is a list of (appserver, playbook) tuples, whose playbooks only differ by
+        the values of their variables. The output of each AppServer is logged, and written to its file in the
+        `log_files` dict, by primary key, and the results of its tasks are stored as PlaybookEvents.
+        Returns a dict mapping each AppServer's primary key to its exit code.
+        """
+        playbook = appserver_playbooks[0][1]
+        playbook_path = os.path.join(working_dir, playbook.playbook_path)
+        appservers = OrderedDict((appserver.inventory_host, appserver) for appserver, dummy in appserver_playbooks)
+        # The lines of stdout and stderr are interleaved, so each stream is split separately
+        output_splitter = ansible.PlaybookOutputSplitter(appservers.keys())
+        error_splitter = ansible.PlaybookOutputSplitter(appservers.keys())
+
+        with ansible.run_playbook(
+            requirements_path=os.path.join(working_dir, playbook.requirements_path),
+            inventory_str='[app]\n{}'.format('\n'.join(appservers)),
+            vars_str=None,
+            playbook_path=os.path.dirname(playbook_path),
+            playbook_name=os.path.basename(playbook_path),
+            username=settings.OPENSTACK_SANDBOX_SSH_USERNAME,
+            host_vars={appserver.inventory_host: playbook.variables for appserver, playbook in appserver_playbooks},
+            forks=settings.ANSIBLE_FORKS,
+        ) as process:
+            events = []
+            try:
+                log_line_generator = poll_streams(
+                    process.stdout,
+                    process.stderr,
+                    process.events,
+                    line_timeout=settings.ANSIBLE_LINE_TIMEOUT,
+                    global_timeout=settings.ANSIBLE_GLOBAL_TIMEOUT,
+                )
+                for f, raw_line in log_line_generator:
+                    if f == process.events:
+                        event = ansible.parse_playbook_event(raw_line)
+                        if event is not None and event['host'] in appservers:
+                            events.append(appservers[event['host']]._make_playbook_event(playbook, event))
+                        continue
+                    if f == process.stderr:
+                        cls._log_batch_output(appservers, error_splitter, log_files, raw_line, is_error=True)
+                    else:
+                        cls._log_batch_output(appservers, output_splitter, log_files, raw_line, is_error=False)
+            except TimeoutError:
+                for appserver in appservers.values():
+                    appserver.logger.error('Playbook run timed out.  Terminating the Ansible process.')
+                process.terminate()
+            process.wait()
+            PlaybookEvent.objects.bulk_create(events)
+            return {
+                appserver.pk: output_splitter.get_returncode(host, process.returncode)
+                for host, appserver in appservers.items()
+            }
+
+    @staticmethod
+    def _group_next_playbooks(appservers, playbooks, returncodes, step):
+        """
+        Group the AppServers which haven't failed so far by the playbook they run at the given step,
+        and by the batch key of its variables (see `ansible.get_batch_key`)
+
+        `playbooks` and `returncodes` are dicts of the playbooks and the exit codes of the last
+        playbook runs, by AppServer primary key. Returns an ordered dict mapping each (repository,
+        version, playbook path, requirements path, batch key) tuple to a list of (appserver, playbook)
+        tuples.
+        """
+        groups = OrderedDict()
+        for appserver in appservers:
+            if returncodes[appserver.pk] != 0 or step >= len(playbooks[appserver.pk]):
+                continue
+            playbook = playbooks[appserver.pk][step]
+            group_key = (
+                playbook.source_repo, playbook.version, playbook.playbook_path, playbook.requirements_path,
+                ansible.get_batch_key(playbook.variables),
+            )
+            groups.setdefault(group_key, []).append((appserver, playbook))
+        return groups
+
+    @classmethod
+    def _run_playbooks_by_step(cls, appservers, playbooks, log_files):
+        """
+        Run the playbooks of several AppServers one step at a time, in one batch per playbook run at
+        each step, until each AppServer has run all its playbooks or one of them failed
+
+        `playbooks` is a dict of the playbooks of each AppServer, and `log_files` a dict of their log
+        files, by primary key. Returns a dict mapping each AppServer's primary key to the exit code
+        of its last playbook run.
+        """
+        returncodes = {appserver.pk: 0 for appserver in appservers}
+        with ExitStack() as stack:
+            repositories = {}
+            step = 0
+            while True:
+                groups = cls._group_next_playbooks(appservers, playbooks, returncodes, step)
+                if not groups:
+                    break
+
+                for (source_repo, version, playbook_path, dummy, dummy), appserver_playbooks in groups.items():
+                    if (source_repo, version) not in repositories:
+                        repositories[(source_repo, version)] = stack.enter_context(
+                            open_repository(source_repo, ref=version)
+                        )
+                    configuration_repo = repositories[(source_repo, version)]
+                    for appserver, dummy in appserver_playbooks:
+                        appserver.logger.info('Running playbook "%s" from "%s"', playbook_path, source_repo)
+                    returncodes.update(
+                        cls._run_playbook_batch(configuration_repo.working_dir, appserver_playbooks, log_files)
+                    )
+                    for appserver, dummy in appserver_playbooks:
+                        if returncodes[appserver.pk] != 0:
+                            appserver.logger.error('Playbook failed for AppServer %s', appserver)
+                step += 1
+        return returncodes
+
+    @classmethod
+    def run_ansible_playbooks_batch(cls, appservers):
+        """
+        Provision the servers of several AppServers using ansible
+
+        The AppServers running the same playbook (same repository, version and playbook path), with the
+        same variables, are configured by a single ansible run, using a multi-host inventory, which
+        configures up to ANSIBLE_FORKS servers in parallel. The values of the variables of each AppServer
+        are passed for its VM only, with the precedence of extra vars, as in `run_ansible_playbooks()`.
+
+        Returns a dict mapping each AppServer's primary key to its (log, returncode), like
+        `run_ansible_playbooks()`. The caller must close the log file objects.
+        """
+        playbooks = {appserver.pk: appserver.get_playbooks() for appserver in appservers}
+        log_files = {appserver.pk: cls._make_log_file() for appserver in appservers}
+        try:
+            returncodes = cls._run_playbooks_by_step(appservers, playbooks, log_files)
+        except Exception:
+            for log_file in log_files.values():
+                log_file.close()
+            raise
+
+        for appserver in appservers:
+            if returncodes[appserver.pk] == 0:
+                appserver.logger.info('Playbooks completed for AppServer %s', appserver)
+        return {appserver.pk: (log_files[appserver.pk], returncodes[appserver.pk]) for appserver in appservers}
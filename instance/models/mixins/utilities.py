@@ -63,10 +63,16 @@ class EmailMixin:
     def provision_failed_email(self, reason, log=None):
         """
         Send email notifications when instance provisioning is failed
+
+        The log can be a list of lines, or a binary file object like the one returned by `run_ansible_playbooks()`
         """
         attachments = []
         if log is not None:
-            log_str = "\n".join(log)
+            if hasattr(log, 'read'):
+                log.seek(0)
+                log_str = log.read().decode('utf-8', errors='replace')
+            else:
+                log_str = "\n".join(log)
             attachments.append(("provision.log", log_str, "text/plain"))
 
         self._send_email(
@@ -275,43 +275,74 @@ class OpenEdXAppServer(AppServer, OpenEdXAppConfiguration, AnsibleAppServerMixin
         admin_users += self.github_admin_users
         return admin_users
 
-    @log_exception
+    def _accepts_ssh_commands(self):
+        """
+        Does the server accept SSH commands?
+        """
+        return self.server.status.accepts_ssh_commands
+
     @AppServer.status.only_for(AppServer.Status.New)
-    def provision(self):
+    def _start_server(self):
         """
-        Provision this AppServer.
+        Request a new server/VM for this AppServer.
 
         Returns True on success or False on failure
         """
         self.logger.info('Starting provisioning')
-        # Start by requesting a new server/VM:
         self._status_to_waiting_for_server()
         assert self.server.vm_not_yet_requested
         self.server.name_prefix = ('edxapp-' + slugify(self.instance.lms_preview_domain))[:20]
         self.server.save()
 
-        def accepts_ssh_commands():
-            """ Does server accept SSH commands? """
-            return self.server.status.accepts_ssh_commands
-
         try:
             self.server.start()
+        except:  # pylint: disable=bare-except
+            self._server_start_failed()
+            return False
+        return True
+
+    def _wait_for_server(self):
+        """
+        Wait until the server of this AppServer has booted.
+
+        Returns True on success or False on failure
+        """
+        try:
             self.logger.info('Waiting for server %s...', self.server)
             self.server.sleep_until(lambda: self.server.status.vm_available)
             self.logger.info('Waiting for server %s to finish booting...', self.server)
-            self.server.sleep_until(accepts_ssh_commands)
+            self.server.sleep_until(self._accepts_ssh_commands)
         except:  # pylint: disable=bare-except
-            self._status_to_error()
-            message = 'Unable to start an OpenStack server'
-            self.logger.exception(message)
-            self.provision_failed_email(message)
+            self._server_start_failed()
             return False
+        return True
+
+    def _server_start_failed(self):
+        """
+        Report a failure to start the server - must be called from an exception handler
+        """
+        self._status_to_error()
+        message = 'Unable to start an OpenStack server'
+        self.logger.exception(message)
+        self.provision_failed_email(message)
 
+    def _configuration_failed_with_exception(self):
+        """
+        Report an unhandled exception while configuring the server - must be called from an exception handler
+        """
+        self._status_to_configuration_failed()
+        message = "AppServer deploy failed: unhandled exception"
+        self.logger.exception(message)
+        self.provision_failed_email(message)
+
+    def _finish_provisioning(self, log, exit_code):
+        """
+        Reboot the server once the playbooks have run, and mark this AppServer as running.
+        The log of the playbooks is closed once it isn't needed anymore.
+
+        Returns True on success or False on failure
+        """
         try:
-            # Provisioning (ansible)
-            self.logger.info('Provisioning server...')
-            self._status_to_configuring_server()
-            log, exit_code = self.run_ansible_playbooks()
             if exit_code != 0:
                 self.logger.info('Provisioning failed')
                 self._status_to_configuration_failed()
@@ -322,7 +353,7 @@ class OpenEdXAppServer(AppServer, OpenEdXAppConfiguration, AnsibleAppServerMixin
             self.logger.info('Provisioning completed')
             self.logger.info('Rebooting server %s...', self.server)
             self.server.reboot()
-            self.server.sleep_until(accepts_ssh_commands)
+            self.server.sleep_until(self._accepts_ssh_commands)
 
             # Declare instance up and running
             self._status_to_running()
@@ -330,11 +361,59 @@ class OpenEdXAppServer(AppServer, OpenEdXAppConfiguration, AnsibleAppServerMixin
             return True
 
         except:  # pylint: disable=bare-except
-            self._status_to_configuration_failed()
-            message = "AppServer deploy failed: unhandled exception"
-            self.logger.exception(message)
-            self.provision_failed_email(message)
+            self._configuration_failed_with_exception()
             return False
+        finally:
+            if hasattr(log, 'close'):
+                log.close()
+
+    @log_exception
+    @AppServer.status.only_for(AppServer.Status.New)
+    def provision(self):
+        """
+        Provision this AppServer.
+
+        Returns True on success or False on failure
+        """
+        # Start by requesting a new server/VM:
+        if not self._start_server() or not self._wait_for_server():
+            return False
+
+        try:
+            # Provisioning (ansible)
+            self.logger.info('Provisioning server...')
+            self._status_to_configuring_server()
+            log, exit_code = self.run_ansible_playbooks()
+        except:  # pylint: disable=bare-except
+            self._configuration_failed_with_exception()
+            return False
+
+        return self._finish_provisioning(log, exit_code)
+
+    @classmethod
+    @log_exception
+    def provision_batch(cls, appservers):
+        """
+        Provision several new AppServers at once: their servers boot in parallel, and the servers
+        running the same playbooks are configured together (see `run_ansible_playbooks_batch()`).
+
+        Returns the list of the AppServers which were provisioned successfully
+        """
+        # pylint: disable=protected-access
+        appservers = [appserver for appserver in appservers if appserver._start_server()]
+        appservers = [appserver for appserver in appservers if appserver._wait_for_server()]
+
+        for appserver in appservers:
+            appserver.logger.info('Provisioning server...')
+            appserver._status_to_configuring_server()
+        try:
+            results = cls.run_ansible_playbooks_batch(appservers)
+        except:  # pylint: disable=bare-except
+            for appserver in appservers:
+                appserver._configuration_failed_with_exception()
+            return []
+
+        return [appserver for appserver in appservers if appserver._finish_provisioning(*results[appserver.pk])]
 
     def save(self, *args, **kwargs):
         """
@@ -21,6 +21,7 @@ Open edX Instance models
 """
 import re
 import string
+import traceback
 
 from django.conf import settings
 from django.db import models, transaction
@@ -297,6 +298,42 @@ class OpenEdXInstance(Instance, OpenEdXAppConfiguration, OpenEdXDatabaseMixin,
 
         Returns the ID of the new AppServer on success or None on failure.
         """
+        app_server = self._prepare_appserver()
+        return self._check_appserver_provisioned(app_server, app_server.provision())
+
+    @classmethod
+    @log_exception
+    def spawn_appservers(cls, instances):
+        """
+        Provision a new AppServer for each of the given instances, configuring the AppServers together
+        (see `OpenEdXAppServer.provision_batch()`).
+
+        Returns the list of the IDs of the new AppServers, with None for those which failed to provision.
+        An instance whose databases can't be provisioned is left out of the batch.
+        """
+        # pylint: disable=protected-access
+        app_servers = {}
+        for instance in instances:
+            try:
+                app_servers[instance.pk] = instance._prepare_appserver()
+            except Exception:  # pylint: disable=broad-except
+                instance.logger.critical(traceback.format_exc())
+                instance.logger.error('Failed to provision new app server')
+
+        provisioned = set(app_server.pk for app_server in OpenEdXAppServer.provision_batch(list(app_servers.values())))
+        app_server_ids = []
+        for instance in instances:
+            app_server = app_servers.get(instance.pk)
+            if app_server is None:
+                app_server_ids.append(None)
+            else:
+                app_server_ids.append(instance._check_appserver_provisioned(app_server, app_server.pk in provisioned))
+        return app_server_ids
+
+    def _prepare_appserver(self):
+        """
+        Provision the external databases if needed, then create a new AppServer, ready to be provisioned
+        """
         # Provision external databases:
         if not self.use_ephemeral_databases:
             # TODO: Use db row-level locking to ensure we don't get any race conditions when creating these DBs.
@@ -308,9 +345,15 @@ class OpenEdXInstance(Instance, OpenEdXAppConfiguration, OpenEdXDatabaseMixin,
             self.logger.info('Provisioning Swift container...')
             self.provision_swift()
 
-        app_server = self._create_owned_appserver()
+        return self._create_owned_appserver()
 
-        if app_server.provision():
+    def _check_appserver_provisioned(self, app_server, success):
+        """
+        Record the outcome of the provisioning of a new AppServer
+
+        Returns the ID of the AppServer on success or None on failure.
+        """
+        if success:
             self.logger.info('Provisioned new app server, %s', app_server.name)
             self.successfully_provisioned = True
             self.save()
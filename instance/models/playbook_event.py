@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Instance app models - Playbook events
+"""
+
+# Imports #####################################################################
+
+from django.db import models
+from django.db.models import Avg, Case, Count, IntegerField, Max, Sum, When
+from django_extensions.db.fields.json import JSONField
+
+
+# Constants ###################################################################
+
+PLAYBOOK_EVENT_STATUS_CHOICES = (
+    ('ok', 'OK'),
+    ('changed', 'Changed'),
+    ('skipped', 'Skipped'),
+    ('failed', 'Failed'),
+    ('unreachable', 'Unreachable'),
+)
+
+
+# Models ######################################################################
+
+class PlaybookEventQuerySet(models.QuerySet):
+    """
+    Additional methods for PlaybookEvent querysets, to aggregate the durations of tasks
+
+    Also used as the standard manager for the PlaybookEvent model (`PlaybookEvent.objects`)
+    """
+    def durations(self, *fields):
+        """
+        Aggregate the durations of the events grouped by the given fields, slowest total first
+
+        For instance, `durations('role')` lists the slowest roles across all provisions, and
+        `durations('role', 'task')` the slowest tasks. Each row has the `count` of events, and their
+        `total`, `average` and `longest` duration, in seconds.
+        """
+        return self.values(*fields).annotate(
+            count=Count('id'),
+            total=Sum('duration'),
+            average=Avg('duration'),
+            longest=Max('duration'),
+        ).order_by('-total')
+
+    def duration_histogram(self, bounds):
+        """
+        Count the events in each duration bucket delimited by the ascending `bounds`, in seconds
+
+        Returns a list of (lower bound, upper bound, count) tuples, from 0 to infinity (None), computed
+        in a single query; e.g. `PlaybookEvent.objects.filter(task=...).duration_histogram([1, 10, 60])`.
+        """
+        buckets = list(zip([0] + list(bounds), list(bounds) + [None]))
+        counts = self.aggregate(**{
+            'bucket_{}'.format(i): Sum(Case(
+                When(duration__gte=lower, then=1) if upper is None else
+                When(duration__gte=lower, duration__lt=upper, then=1),
+                default=0,
+                output_field=IntegerField(),
+            ))
+            for i, (lower, upper) in enumerate(buckets)
+        })
+        return [(lower, upper, counts['bucket_{}'.format(i)] or 0) for i, (lower, upper) in enumerate(buckets)]
+
+
+class PlaybookEvent(models.Model):
+    """
+    The result of an ansible task on the VM of an AppServer, as written by the `opencraft_events`
+    callback plugin (see `instance.ansible.run_playbook`)
+
+    Events are compact and indexed by role and task, to compare the timing of tasks across provisions.
+    """
+    appserver = models.ForeignKey('OpenEdXAppServer', on_delete=models.CASCADE, related_name='playbook_events')
+    playbook = models.CharField(max_length=255, help_text='Path of the playbook within its repository.')
+    role = models.CharField(max_length=255, blank=True, db_index=True)
+    task = models.CharField(max_length=255, db_index=True)
+    status = models.CharField(max_length=11, choices=PLAYBOOK_EVENT_STATUS_CHOICES)
+    started = models.DateTimeField()
+    duration = models.FloatField(help_text='Duration of the task on this host, in seconds.')
+    result = JSONField(blank=True, default={}, help_text='Summary of the result of failed tasks.')
+
+    objects = PlaybookEventQuerySet().as_manager()
+
+    class Meta:
+        ordering = ('started', 'id')
+
+    def __str__(self):
+        return '{}: {} ({}, {:.1f}s)'.format(self.role or self.playbook, self.task, self.status, self.duration)
+
+    @property
+    def changed(self):
+        """
+        Whether the task changed the state of the VM
+        """
+        return self.status == 'changed'
+
+    @property
+    def failed(self):
+        """
+        Whether the task failed
+        """
+        return self.status in ('failed', 'unreachable')
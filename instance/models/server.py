@@ -22,12 +22,15 @@ Instance app models - Server
 
 # Imports #####################################################################
 
+from collections import namedtuple
 import logging
 import time
 
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 from django.db.models import Q
+from django.utils import timezone
 from django_extensions.db.models import TimeStampedModel
 import novaclient
 import requests
@@ -38,7 +41,7 @@ from instance.logger_adapter import ServerLoggerAdapter
 from instance.models.utils import (
     ValidateModelMixin, ResourceState, ModelResourceStateDescriptor, SteadyStateException
 )
-from instance.utils import is_port_open, to_json
+from instance.utils import exponential_backoff, is_port_open, open_ports, to_json, NotificationListener
 
 
 # Logging #####################################################################
@@ -46,6 +49,15 @@ from instance.utils import is_port_open, to_json
 logger = logging.getLogger(__name__)
 
 
+# Data objects ################################################################
+
+StatusReconciliation = namedtuple('StatusReconciliation', [
+    'servers',  # Number of servers whose status was reconciled
+    'api_calls',  # Number of nova API requests made to list the servers
+    'api_calls_saved',  # Number of nova API requests saved compared to updating each server separately
+])
+
+
 # States ######################################################################
 
 class ServerState(ResourceState):
@@ -135,6 +147,155 @@ class ServerQuerySet(models.QuerySet):
         return self.filter(~Q(_status=Status.Terminated.state_id))
 
 
+class OpenStackServerQuerySet(ServerQuerySet):
+    """
+    Additional methods for OpenStack server querysets
+    Also used as the standard manager for the OpenStackServer model (`OpenStackServer.objects`)
+    """
+    def terminate(self, *args, batch_size=500, **kwargs):
+        """
+        Terminate the servers from the queryset, in bulk
+
+        The VMs are deleted concurrently by a bounded pool of threads (see `openstack.delete_servers_by_id`).
+        The statuses are then updated with one UPDATE query per `batch_size` servers, without
+        going through `save()`, and a single `servers_update` notification is published.
+        Servers whose VM could not be deleted are left untouched, so they can be terminated again later.
+        """
+        qs = self.filter(~Q(_status=Status.Terminated.state_id), *args, **kwargs)
+        servers = list(qs)
+        for server in servers:
+            server.logger.info('Terminating server (status=%s)...', server.status)
+
+        vm_servers = {server.openstack_id: server for server in servers if server.vm_created}
+        errors = openstack.delete_servers_by_id(list(vm_servers)) if vm_servers else {}
+        terminated_pks = []
+        for server in servers:
+            error = errors.get(server.openstack_id) if server.openstack_id in vm_servers else None
+            if isinstance(error, novaclient.exceptions.NotFound):
+                server.logger.error('Error while attempting to terminate server: could not find OS server')
+            elif error is not None:
+                server.logger.error('Error while attempting to terminate server: %s', error)
+                continue
+            terminated_pks.append(server.pk)
+
+        for i in range(0, len(terminated_pks), batch_size):
+            self.model.objects.filter(pk__in=terminated_pks[i:i + batch_size]).update(
+                _status=Status.Terminated.state_id,
+                _public_ip=None,
+                modified=timezone.now(),
+            )
+        if terminated_pks:
+            publish_data('notification', {
+                'type': 'servers_update',
+                'server_pks': terminated_pks,
+            })
+        return qs
+
+    def update_status(self, nova=None):
+        """
+        Refresh the status of the servers from the queryset which have a VM whose status can still change
+
+        All servers are retrieved from nova using a single paginated listing, rather than
+        with one request per server. The status of the servers is then updated in a transaction
+        which locks them, skipping the servers whose status changed in the meantime, e.g. because
+        they were terminated. Returns a `StatusReconciliation` object.
+        """
+        servers = list(self.exclude_terminated().exclude(
+            Q(_status=Status.BuildFailed.state_id) | Q(openstack_id='')
+        ))
+        if not servers:
+            return StatusReconciliation(servers=0, api_calls=0, api_calls_saved=0)
+        if nova is None:
+            nova = openstack.get_nova_client()
+
+        os_servers, api_calls = self._list_os_servers(nova)
+        reachable = os_servers is not None
+        os_servers = os_servers or {}
+        ssh_open = self._probe_ssh_ports(servers, os_servers)
+
+        with transaction.atomic():
+            servers = self._lock_unchanged(servers)
+            self.model.objects.filter(pk__in=[server.pk for server in servers]).mark_status_checked()
+            for server in servers:
+                os_server = os_servers.get(server.openstack_id)
+                if os_server is None:
+                    # Unless the API is unreachable, this is what nova would answer with a 404
+                    # if we requested this server directly
+                    server.update_status_unreachable(mark_checked=False)
+                else:
+                    server.update_status(os_server=os_server, ssh_open=server.pk in ssh_open, mark_checked=False)
+
+        return StatusReconciliation(
+            servers=len(servers),
+            api_calls=api_calls,
+            api_calls_saved=max(len(servers) - api_calls, 0) if reachable else 0,
+        )
+
+    @staticmethod
+    def _list_os_servers(nova):
+        """
+        List all the nova servers, with one API call per page
+
+        Returns a tuple of a dict of the nova servers by ID, or None if the OpenStack API couldn't be
+        reached, and the number of API calls made.
+        """
+        api_calls = 0
+        os_servers = {}
+        try:
+            for page in openstack.get_server_pages(nova):
+                api_calls += 1
+                os_servers.update((os_server.id, os_server) for os_server in page)
+        except (requests.RequestException, novaclient.exceptions.ClientException):
+            logger.debug('Could not reach the OpenStack API to list servers')
+            return None, api_calls
+        return os_servers, api_calls
+
+    def _lock_unchanged(self, servers):
+        """
+        Lock the rows of the given servers until the end of the transaction, and return the servers
+        whose status is still the one they were loaded with
+
+        Nova is listed and SSH ports are probed without holding any lock, so a server can be terminated
+        meanwhile, e.g. by `terminate()`; its status must then be left alone.
+        """
+        current_statuses = dict(
+            self.model.objects.select_for_update().filter(
+                pk__in=[server.pk for server in servers]
+            ).values_list('pk', '_status')
+        )
+        return [server for server in servers if current_statuses.get(server.pk) == server._status]
+
+    def mark_status_checked(self):
+        """
+        Record that the status of the servers from the queryset has just been checked against the
+        OpenStack API, with a single UPDATE query, and return the time of the check
+
+        The query doesn't go through `save()`, to avoid sending server update notifications.
+        """
+        status_checked_at = timezone.now()
+        self.update(status_checked_at=status_checked_at)
+        return status_checked_at
+
+    def _probe_ssh_ports(self, servers, os_servers):
+        """
+        Probe the SSH port of all the servers which could become ready at once, rather than one by one
+
+        `os_servers` is a dict of the nova servers by ID. Returns the set of the primary keys of the
+        servers whose SSH port is open.
+        """
+        ssh_addresses = {}
+        for server in servers:
+            os_server = os_servers.get(server.openstack_id)
+            if os_server is None or os_server.status in self.model.NOVA_REBOOT_STATUSES:
+                continue
+            if server.status in (Status.Building, Status.Booting, Status.Unknown):
+                public_ip = server._get_public_ip(os_server) #pylint: disable=protected-access
+                if public_ip:
+                    ssh_addresses[server.pk] = (public_ip, 22)
+        ssh_open = open_ports(ssh_addresses.values())
+        return {pk for pk, address in ssh_addresses.items() if address in ssh_open}
+
+
 class Server(ValidateModelMixin, TimeStampedModel):
     """
     A single server VM
@@ -193,13 +354,18 @@ class Server(ValidateModelMixin, TimeStampedModel):
 
     def sleep_until(self, condition, timeout=3600):
         """
-        Sleep in a loop until condition related to server status is fulfilled,
+        Sleep until condition related to server status is fulfilled,
         or until timeout (provided in seconds) is reached.
 
         Raises an exception if the desired condition can not be fulfilled.
         This can happen if the server is in a steady state (i.e., a state that is not expected to change)
         that does not fulfill the desired condition.
 
+        The status is checked again after exponentially increasing delays (with jitter), or as soon
+        as a notification is published for this server, e.g. when its status is updated by another
+        process polling the status of all servers at once. The timeout is measured with a monotonic
+        clock, so waking up early on a notification doesn't shorten it.
+
         The default timeout is 1h.
 
         Use as follows:
@@ -214,21 +380,25 @@ class Server(ValidateModelMixin, TimeStampedModel):
 
         self.logger.info('Waiting to reach status from which we can proceed...')
 
-        while timeout > 0:
-            self.update_status()
-            if condition():
-                self.logger.info(
-                    'Reached appropriate status ({name}). Proceeding.'.format(name=self.status.name)
-                )
-                return
-            else:
-                if self.status.is_steady_state:
+        delays = exponential_backoff(settings.SERVER_STATUS_WAIT_MIN_DELAY, settings.SERVER_STATUS_WAIT_MAX_DELAY)
+        deadline = time.monotonic() + timeout
+        with NotificationListener('notification', self._is_update_notification) as listener:
+            while True:
+                self.poll_status()
+                if condition():
+                    self.logger.info(
+                        'Reached appropriate status ({name}). Proceeding.'.format(name=self.status.name)
+                    )
+                    return
+                elif self.status.is_steady_state:
                     raise SteadyStateException(
                         "The current status ({name}) does not fulfill the desired condition "
                         "and is not expected to change.".format(name=self.status.name)
                     )
-            time.sleep(1)
-            timeout -= 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                listener.wait(min(next(delays), remaining))
 
         # If we get here, this means we've reached the timeout
         raise TimeoutError(
@@ -236,6 +406,15 @@ class Server(ValidateModelMixin, TimeStampedModel):
             "Aborting with a status of {status}.".format(minutes=timeout / 60, status=self.status.name)
         )
 
+    def _is_update_notification(self, data):
+        """
+        Return True if `data` is the notification published when this server is saved,
+        or when it is updated in bulk (see `OpenStackServerQuerySet.terminate`)
+        """
+        if data.get('type') == 'servers_update':
+            return self.pk in data.get('server_pks', ())
+        return data.get('type') == 'server_update' and data.get('server_pk') == self.pk
+
     def save(self, *args, **kwargs):
         """
         Save this Server
@@ -252,12 +431,27 @@ class Server(ValidateModelMixin, TimeStampedModel):
         """
         raise NotImplementedError
 
+    def poll_status(self):
+        """
+        Refresh the current status while waiting for it to change (see `sleep_until`)
+        """
+        return self.update_status()
+
 
 class OpenStackServer(Server):
     """
     A Server VM hosted on an OpenStack cloud
     """
     openstack_id = models.CharField(max_length=250, db_index=True, blank=True)
+    # Statuses of the nova server while it is being rebooted
+    NOVA_REBOOT_STATUSES = ('REBOOT', 'HARD_REBOOT')
+
+    # Public IP of the VM, stored once it is available. Use the `public_ip` property to read it.
+    _public_ip = models.GenericIPAddressField(null=True, blank=True, db_column='public_ip')
+    # Last time the status was checked against the OpenStack API (see `update_status`)
+    status_checked_at = models.DateTimeField(null=True, blank=True)
+
+    objects = OpenStackServerQuerySet().as_manager()
 
     class Meta:
         verbose_name = 'OpenStack VM'
@@ -286,14 +480,28 @@ class OpenStackServer(Server):
     def public_ip(self):
         """
         Return one of the public address(es)
+
+        The address is stored once the VM is available, so nova is only queried when it is missing.
         """
-        if not self.openstack_id:
-            return None
+        if self._public_ip or not self.openstack_id:
+            return self._public_ip
 
         try:
-            public_addr = openstack.get_server_public_address(self.os_server)
+            os_server = self.os_server
         except (requests.RequestException, novaclient.exceptions.ClientException):
             return None  # Could not determine an IP based on the OS API
+
+        public_ip = self._get_public_ip(os_server)
+        if self.status.vm_available:
+            self._store_public_ip(public_ip)
+        return public_ip
+
+    @staticmethod
+    def _get_public_ip(os_server):
+        """
+        Return one of the public address(es) of the given nova server
+        """
+        public_addr = openstack.get_server_public_address(os_server)
         if not public_addr:
             return None
 
@@ -313,9 +521,14 @@ class OpenStackServer(Server):
         """
         return self.status == Status.Pending
 
-    def update_status(self):
+    def update_status(self, os_server=None, ssh_open=None, mark_checked=True):
         """
         Refresh the status by querying the openstack server via nova
+
+        The nova server can be passed as `os_server` when it has already been retrieved,
+        to avoid querying it again. Likewise, `ssh_open` can be passed when the SSH port
+        of the server has already been probed, and `mark_checked` can be False when the
+        time of the check has already been recorded (see `OpenStackServerQuerySet.update_status`).
         """
         # TODO: Check when server is stopped or terminated
 
@@ -323,15 +536,27 @@ class OpenStackServer(Server):
         # This is not the case if we can not interact with the server:
         if self.status in (Status.BuildFailed, Status.Terminated):
             return self.status
-        try:
-            os_server = self.os_server
-        except (requests.RequestException, novaclient.exceptions.ClientException):
-            self.logger.debug('Could not reach the OpenStack API')
-            if self.status not in (Status.BuildFailed, Status.Terminated, Status.Pending, Status.Unknown):
-                self._status_to_unknown()
-            return self.status
+        if os_server is None:
+            try:
+                os_server = self.os_server
+            except (requests.RequestException, novaclient.exceptions.ClientException):
+                return self.update_status_unreachable(mark_checked=mark_checked)
+        if mark_checked:
+            self._mark_status_checked()
         self.logger.debug('Updating status from nova (currently %s):\n%s', self.status, to_json(os_server))
 
+        self._update_build_status(os_server)
+        self._update_boot_status(os_server, ssh_open)
+
+        if self.status.vm_available:
+            self._store_public_ip(self._get_public_ip(os_server))
+
+        return self.status
+
+    def _update_build_status(self, os_server):
+        """
+        Update the status while the VM is being built, from the status of the nova server
+        """
         if self.status == Status.Unknown:
             if os_server.status in ('INITIALIZED', 'BUILDING'):
                 # OpenStack has multiple API versions; INITIALIZED is current; BUILDING was used in the past
@@ -342,9 +567,65 @@ class OpenStackServer(Server):
             if os_server._loaded and os_server.status == 'ACTIVE':
                 self._status_to_booting()
 
-        if self.status in (Status.Booting, Status.Unknown) and self.public_ip and is_port_open(self.public_ip, 22):
-            self._status_to_ready()
+    def _update_boot_status(self, os_server, ssh_open=None):
+        """
+        Update the status while the VM is booting, once its SSH port is open
+
+        `ssh_open` is probed unless it is given (see `update_status`).
+        """
+        if os_server.status in self.NOVA_REBOOT_STATUSES:
+            # Nova sets these statuses before its reboot API call returns, and until the VM has restarted,
+            # so SSH being still up at this point doesn't mean that the reboot is over
+            self.logger.debug('OpenStack: reboot in progress (status="%s")', os_server.status)
+        elif self.status in (Status.Booting, Status.Unknown):
+            if ssh_open is None:
+                public_ip = self._get_public_ip(os_server)
+                ssh_open = bool(public_ip) and is_port_open(public_ip, 22)
+            if ssh_open:
+                self._status_to_ready()
+
+    def _mark_status_checked(self):
+        """
+        Record that the status has just been checked against the OpenStack API
+
+        See `OpenStackServerQuerySet.mark_status_checked`.
+        """
+        self.status_checked_at = OpenStackServer.objects.filter(pk=self.pk).mark_status_checked()
+
+    def _store_public_ip(self, public_ip):
+        """
+        Persist the public IP of the VM, if it is known and has changed
+        """
+        if public_ip and public_ip != self._public_ip:
+            self._public_ip = public_ip
+            self.save(update_fields=['_public_ip'])
 
+    def poll_status(self):
+        """
+        Refresh the current status while waiting for it to change (see `sleep_until`)
+
+        All the processes waiting on servers share a single polling loop: at most once every
+        `OPENSTACK_STATUS_POLL_INTERVAL` seconds, one of them refreshes the status of all servers
+        with a single nova listing. The other ones only reload the status from the database.
+        """
+        if self.status == Status.Pending:
+            # The VM still needs to be requested; `update_status()` takes care of it
+            return self.update_status()
+        interval = settings.OPENSTACK_STATUS_POLL_INTERVAL
+        if not interval or cache.add('openstack_server_status_poll', True, interval):
+            OpenStackServer.objects.update_status(nova=self.nova)
+        self.refresh_from_db(fields=['_status'])
+        return self.status
+
+    def update_status_unreachable(self, mark_checked=True):
+        """
+        Update the status when the server can't be retrieved from the OpenStack API
+        """
+        self.logger.debug('Could not reach the OpenStack API')
+        if mark_checked:
+            self._mark_status_checked()
+        if self.status not in (Status.BuildFailed, Status.Terminated, Status.Pending, Status.Unknown):
+            self._status_to_unknown()
         return self.status
 
     @Server.status.only_for(Status.Pending)
@@ -385,13 +666,11 @@ class OpenStackServer(Server):
         """
         if self.status == Status.Booting:
             return
-        self._status_to_booting()
+        # Switch to 'booting' only once nova accepted the reboot, so that the status reconciliation
+        # (see `update_status`) doesn't see a booting server which nova doesn't reboot, and mark it
+        # as ready again. From then on, it stays booting until nova reports that the reboot is over.
         self.os_server.reboot(reboot_type=reboot_type)
-
-        # TODO: Find a better way to wait for the server shutdown and reboot
-        # Currently, without sleeping here, the status would immediately switch back to ready,
-        # as SSH is still available until the reboot terminates the SSHD process
-        time.sleep(30)
+        self._status_to_booting()
 
     def terminate(self):
         """
@@ -405,6 +684,9 @@ class OpenStackServer(Server):
             return
 
         self._status_to_terminated()
+        if self._public_ip:
+            self._public_ip = None
+            self.save(update_fields=['_public_ip'])
         try:
             self.os_server.delete()
         except novaclient.exceptions.NotFound:
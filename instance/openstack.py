@@ -21,13 +21,20 @@ OpenStack - Helper functions
 """
 
 # Imports #####################################################################
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatchcase
+import io
 import logging
+import os
+import threading
+import time
 from collections import namedtuple, defaultdict
 
 from django.conf import settings
 from novaclient.client import Client as NovaClient
+import novaclient
 import requests
-from swiftclient.service import SwiftService
+from swiftclient.service import SwiftService, SwiftUploadObject
 
 from instance.utils import get_requests_retry
 
@@ -39,11 +46,71 @@ logger = logging.getLogger(__name__)
 
 FailedContainer = namedtuple('FailedContainer', ['name', 'number_of_failures'])
 StatContainer = namedtuple('StatContainer', ['read_acl', 'write_acl', 'bytes'])
+ServerDeletion = namedtuple('ServerDeletion', ['server_id', 'error'])
+
+# Classes #####################################################################
+
+class ResourceCache:
+    """
+    Thread-safe cache of nova resources (flavors, images...), whose entries expire after
+    `OPENSTACK_RESOURCE_CACHE_TTL` seconds
+
+    Keeps count of the cache hits and misses.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(resource_type, selector):
+        """
+        Get the cache key of the resource of type `resource_type` matching the `selector` dict
+        """
+        return (resource_type, tuple(sorted(selector.items())))
+
+    def get(self, key):
+        """
+        Return the cached resource for `key`, or None if it is missing or has expired
+        """
+        with self._lock:
+            resource, expiration = self._entries.get(key, (None, 0))
+            if expiration > time.time():
+                self.hits += 1
+                return resource
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def set(self, key, resource):
+        """
+        Cache `resource` for `key`
+        """
+        with self._lock:
+            self._entries[key] = (resource, time.time() + settings.OPENSTACK_RESOURCE_CACHE_TTL)
+
+    def invalidate(self, *keys):
+        """
+        Remove the given keys from the cache, or clear the whole cache if no key is given
+        """
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+nova_resource_cache = ResourceCache()
+
 
 # Functions ###################################################################
 
 
-def get_nova_client(api_version=2):
+_nova_client_pool = threading.local()
+
+
+def _create_nova_client(api_version):
     """
     Instantiate a python novaclient.Client() object with proper credentials
     """
@@ -67,25 +134,283 @@ def get_nova_client(api_version=2):
     return nova
 
 
+def get_nova_client(api_version=2):
+    """
+    Get a python novaclient.Client() object with proper credentials
+
+    Clients are pooled per thread, so that all the objects using nova from the same thread
+    share the keystone token (which novaclient transparently renews when it expires) and the
+    HTTP connections (which the requests session keeps alive). Clients are not shared between
+    threads, since neither the requests session nor the token renewal are thread-safe: threads
+    using nova concurrently, like the workers of `delete_servers`, each get their own client.
+    The pool is reset in processes forked after it was populated, to avoid sharing connections
+    between processes.
+    """
+    if getattr(_nova_client_pool, 'pid', None) != os.getpid():
+        _nova_client_pool.pid = os.getpid()
+        _nova_client_pool.clients = {}
+
+    key = (
+        api_version,
+        settings.OPENSTACK_USER,
+        settings.OPENSTACK_TENANT,
+        settings.OPENSTACK_AUTH_URL,
+        settings.OPENSTACK_REGION,
+    )
+    nova = _nova_client_pool.clients.get(key)
+    if nova is None:
+        nova = _create_nova_client(api_version)
+        _nova_client_pool.clients[key] = nova
+    return nova
+
+
+def reset_nova_client_pool():
+    """
+    Discard the nova clients pooled for the current thread
+    """
+    _nova_client_pool.clients = {}
+
+
+def find_resource(manager, resource_type, selector):
+    """
+    Find the nova resource matching `selector` using `manager` (e.g. `nova.flavors`)
+
+    Listing flavors or images is slow on large clouds, so results are memoized in
+    `nova_resource_cache`, and a failed lookup removes any stale cached result.
+    """
+    key = nova_resource_cache.get_key(resource_type, selector)
+    resource = nova_resource_cache.get(key)
+    if resource is None:
+        try:
+            resource = manager.find(**selector)
+        except novaclient.exceptions.NotFound:
+            nova_resource_cache.invalidate(key)
+            raise
+        nova_resource_cache.set(key, resource)
+    return resource
+
+
 def create_server(nova, server_name, flavor_selector, image_selector, key_name=None):
     """
     Create a VM via nova
     """
-    flavor = nova.flavors.find(**flavor_selector)
-    image = nova.images.find(**image_selector)
+    flavor = find_resource(nova.flavors, 'flavor', flavor_selector)
+    image = find_resource(nova.images, 'image', image_selector)
 
     logger.info('Creating OpenStack server: name=%s image=%s flavor=%s', server_name, image, flavor)
-    return nova.servers.create(server_name, image, flavor, key_name=key_name)
+    try:
+        return nova.servers.create(server_name, image, flavor, key_name=key_name)
+    except (novaclient.exceptions.NotFound, novaclient.exceptions.BadRequest) as error:
+        # The flavor or the image may have been deleted since they were cached: look the stale
+        # ones up again, and retry if they have changed
+        stale_keys = [
+            nova_resource_cache.get_key(resource_type, selector)
+            for manager, resource_type, selector, resource in (
+                (nova.flavors, 'flavor', flavor_selector, flavor),
+                (nova.images, 'image', image_selector, image),
+            )
+            if _is_stale_resource(manager, resource_type, resource, error)
+        ]
+        if not stale_keys:
+            raise
+        nova_resource_cache.invalidate(*stale_keys)
+        new_flavor = find_resource(nova.flavors, 'flavor', flavor_selector)
+        new_image = find_resource(nova.images, 'image', image_selector)
+        if (new_flavor, new_image) == (flavor, image):
+            raise
+        logger.info('Retrying with image=%s flavor=%s', new_image, new_flavor)
+        return nova.servers.create(server_name, new_image, new_flavor, key_name=key_name)
+
+
+def _is_stale_resource(manager, resource_type, resource, error):
+    """
+    Check whether the `error` raised by nova when creating a server may be caused by `resource`,
+    a flavor or an image found by `find_resource`, having been deleted since it was cached:
+    either the error names the resource type, or the resource ID doesn't resolve anymore
+    """
+    if resource_type in str(error).lower():
+        return True
+    try:
+        manager.get(resource.id)
+    except novaclient.exceptions.NotFound:
+        return True
+    return False
+
+
+def get_server_pages(nova, search_opts=None, page_size=None, detailed=True):
+    """
+    Iterate over the (detailed) servers visible to `nova`, one page per API request
+
+    Pagination markers are followed until a page shorter than `page_size` is returned, so
+    `page_size` should not exceed the `osapi_max_limit` of the OpenStack provider.
+    """
+    if page_size is None:
+        page_size = settings.OPENSTACK_SERVER_LIST_PAGE_SIZE
+    marker = None
+    while True:
+        page = nova.servers.list(detailed=detailed, search_opts=search_opts, marker=marker, limit=page_size)
+        yield page
+        if len(page) < page_size:
+            return
+        marker = page[-1].id
+
+
+def _escape_regex(string):
+    """
+    Escape the regex special characters of `string`
+
+    Only the characters which are special in all the regex dialects used by nova databases are escaped.
+    """
+    return ''.join('\\' + char if char in '.^$*+?()[]{}|\\' else char for char in string)
 
 
-def delete_servers_by_name(nova, server_name):
+def _is_portable_bracket_expression(chars, negate):
     """
-    Delete all servers with `server_name`
+    Check that the set of characters `chars` of a bracket expression means the same to all the
+    regex dialects used by nova databases: it must not contain a backslash, `[:`, `[.`, `[=` or a
+    reversed range, nor start with `^` (unless the expression is negated, i.e. `[^^...]`).
     """
-    for server in nova.servers.list():
-        if server.name == server_name:
-            logger.info('deleting server %s', server)
-            nova.servers.delete(server)
+    if '\\' in chars or any(seq in chars for seq in ('[:', '[.', '[=')) or (chars.startswith('^') and not negate):
+        return False
+    index = 0
+    while index < len(chars):
+        if chars[index + 1:index + 2] == '-' and index + 2 < len(chars):
+            if chars[index] > chars[index + 2]:
+                return False
+            index += 3
+        else:
+            index += 1
+    return True
+
+
+def _translate_pattern(pattern):
+    """
+    Translate the shell-style `pattern` to a regex, like `fnmatch.translate` but in the POSIX-style
+    dialect shared by the databases used by nova (MySQL, PostgreSQL & SQLite): `*`, `?`, `[seq]`
+    and `[!seq]` are supported.
+
+    Raises ValueError for bracket expressions which these dialects don't read the same way (see
+    `_is_portable_bracket_expression`).
+    """
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        if char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '[':
+            # Like fnmatch, a ']' right after '[' or '[!' is part of the set, and an unclosed '[' is literal
+            end = index + 1 if pattern[index:index + 1] == '!' else index
+            end = pattern.find(']', end + 1 if pattern[end:end + 1] == ']' else end)
+            if end == -1:
+                regex.append(_escape_regex(char))
+                continue
+            chars, index = pattern[index:end], end + 1
+            negate = chars.startswith('!')
+            if negate:
+                chars = chars[1:]
+            if not _is_portable_bracket_expression(chars, negate):
+                raise ValueError('Unsupported bracket expression in server name pattern: {!r}'.format(pattern))
+            regex.append('[{}{}]'.format('^' if negate else '', chars))
+        else:
+            regex.append(_escape_regex(char))
+    return ''.join(regex)
+
+
+def _name_regex(names, pattern):
+    """
+    Build a regex matching any of `names` or the shell-style `pattern`, to filter servers by name
+    via the nova API (see `_translate_pattern`)
+    """
+    alternatives = [_escape_regex(name) for name in sorted(names)]
+    if pattern is not None:
+        alternatives.append(_translate_pattern(pattern))
+    return '^({})$'.format('|'.join(alternatives))
+
+
+def delete_servers(names=(), pattern=None, max_workers=None):
+    """
+    Delete all servers whose name is one of `names` or matches the shell-style `pattern` (e.g. 'inst-*-vm').
+    Patterns with bracket expressions which can't be translated for nova raise ValueError (see `_translate_pattern`).
+
+    The servers are found using a single listing, filtered by name on the server side, and deleted
+    concurrently by at most `max_workers` threads (OPENSTACK_DELETE_MAX_WORKERS by default). Like
+    the deletion threads, the listing uses the nova client of the current thread (see `get_nova_client`),
+    so no client is passed in: all the requests go to the OpenStack account configured in the settings.
+
+    Returns a dict mapping each of `names` and each other deleted server name to a list of
+    `ServerDeletion` objects, one per server with that name; `error` is None if the deletion succeeded.
+    """
+    names = set(names)
+    results = {name: [] for name in names}
+    if not names and pattern is None:
+        return results
+
+    def matches(server_name):
+        """ Check the name client-side too, since nova's regex filter is not anchored on all clouds """
+        return server_name in names or (pattern is not None and fnmatchcase(server_name, pattern))
+
+    name_regex = _name_regex(names, pattern)
+    servers = [
+        server
+        for page in get_server_pages(get_nova_client(), search_opts={'name': name_regex}, detailed=False)
+        for server in page if matches(server.name)
+    ]
+    if not servers:
+        return results
+
+    for server, error in _delete_concurrently(servers, max_workers):
+        results.setdefault(server.name, []).append(ServerDeletion(server_id=server.id, error=error))
+    return results
+
+
+def delete_servers_by_id(server_ids, max_workers=None):
+    """
+    Delete the servers with the given OpenStack IDs, concurrently (see `delete_servers`)
+
+    Returns a dict mapping each server ID to the error raised while deleting it, or to None
+    if the deletion succeeded.
+    """
+    return dict(_delete_concurrently(server_ids, max_workers))
+
+
+def _delete_concurrently(servers, max_workers=None):
+    """
+    Delete `servers` (nova server objects or IDs) using at most `max_workers` threads
+    (OPENSTACK_DELETE_MAX_WORKERS by default), each with its own nova client
+
+    Generates a (server, error) tuple for each server as soon as its deletion is done;
+    `error` is None if the deletion succeeded.
+    """
+    if not servers:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers or settings.OPENSTACK_DELETE_MAX_WORKERS) as executor:
+        futures = {executor.submit(_delete_server, server): server for server in servers}
+        for future in as_completed(futures):
+            server = futures[future]
+            error = future.exception()
+            if error is None:
+                logger.info('Deleted server %s', server)
+            else:
+                logger.error('Could not delete server %s: %s', server, error)
+            yield server, error
+
+
+def _delete_server(server):
+    """
+    Delete a server (nova server object or ID), using the nova client of the current thread
+    """
+    get_nova_client().servers.delete(server)
+
+
+def delete_servers_by_name(server_name):
+    """
+    Delete all servers with `server_name` (see `delete_servers`)
+    """
+    return delete_servers(names=[server_name])
 
 
 def get_server_public_address(server):
@@ -179,6 +504,39 @@ def create_swift_container(container_name, **kwargs):
         service.post(container_name, options={'read_acl': '.r:*'})
 
 
+def upload_to_swift_container(container_name, object_name, data, **kwargs):
+    """
+    Upload `data` (bytes) as the object `object_name` of a Swift container, creating the
+    container if needed.
+    """
+    with swift_service(**kwargs) as service:
+        upload = SwiftUploadObject(io.BytesIO(data), object_name=object_name)
+        for result in service.upload(container_name, [upload]):
+            if not result['success']:
+                raise result['error']
+
+
+def download_from_swift_container(container_name, object_name, **kwargs):
+    """
+    Return the contents (bytes) of the object `object_name` of a Swift container.
+    """
+    with swift_service(**kwargs) as service:
+        for result in service.download(container_name, [object_name], options={'out_file': '-'}):
+            if not result['success']:
+                raise result['error']
+            return b''.join(result['contents'])
+
+
+def delete_from_swift_container(container_name, object_names, **kwargs):
+    """
+    Delete the objects `object_names` of a Swift container. Objects which don't exist are ignored.
+    """
+    with swift_service(**kwargs) as service:
+        for result in service.delete(container_name, object_names):
+            if not result['success'] and getattr(result['error'], 'http_status', None) != 404:
+                raise result['error']
+
+
 def delete_swift_container(container_name, **kwargs):
     """
     Delete a Swift container.
@@ -23,10 +23,14 @@ Git repository - Helper functions
 # Imports #####################################################################
 
 from contextlib import contextmanager
+import fcntl
+import hashlib
 import logging
+import os
 import shutil
 import tempfile
 
+from django.conf import settings
 import git
 
 
@@ -37,17 +41,58 @@ logger = logging.getLogger(__name__)
 
 # Functions ###################################################################
 
+def update_mirror(repo_url):
+    """
+    Create or update the local bare mirror of the repository at `repo_url`, and return its path
+
+    Mirrors are kept in GIT_MIRROR_CACHE_DIR, one per repository URL, and only fetch the new
+    objects once they exist. Callers must hold the lock of the mirror (see `open_repository`).
+
+    Like any repository, mirrors are garbage-collected by `git fetch` once enough objects were fetched
+    (`git gc --auto`), which happens while the lock is held. Since the clones share the objects of the
+    mirror, only the objects which have been unreferenced for GIT_MIRROR_PRUNE_EXPIRE are deleted.
+    """
+    mirror_path = os.path.join(
+        settings.GIT_MIRROR_CACHE_DIR, '{}.git'.format(hashlib.sha256(repo_url.encode()).hexdigest())
+    )
+    if os.path.isdir(mirror_path):
+        logger.info('Fetching repository %s in mirror %s...', repo_url, mirror_path)
+        git.Git(mirror_path).fetch('origin', prune=True)
+    else:
+        logger.info('Mirroring repository %s in %s...', repo_url, mirror_path)
+        # Clone into a temporary directory first, so that an interrupted clone isn't used as a mirror
+        shutil.rmtree(mirror_path + '.tmp', ignore_errors=True)
+        git.repo.base.Repo.clone_from(repo_url, mirror_path + '.tmp', mirror=True)
+        # Collect garbage in the foreground, while the mirror is locked, rather than in a background process
+        mirror = git.Git(mirror_path + '.tmp')
+        mirror.config('gc.autoDetach', 'false')
+        mirror.config('gc.pruneExpire', settings.GIT_MIRROR_PRUNE_EXPIRE)
+        os.rename(mirror_path + '.tmp', mirror_path)
+    return mirror_path
+
+
 @contextmanager
 def open_repository(repo_url, ref='master'):
     """
     Get a `Git` object for a repository URL and switch it to the branch `ref`
 
-    Note that this clones the repository locally
+    Note that this clones the repository locally. When GIT_MIRROR_CACHE_DIR is set, the repository is
+    cloned from a local mirror, sharing its objects, so only the new commits are downloaded.
     """
     repo_dir_path = tempfile.mkdtemp()
-    logger.info('Cloning repository %s (ref=%s) in %s...', repo_url, ref, repo_dir_path)
-
-    git.repo.base.Repo.clone_from(repo_url, repo_dir_path)
+    if settings.GIT_MIRROR_CACHE_DIR:
+        os.makedirs(settings.GIT_MIRROR_CACHE_DIR, exist_ok=True)
+        lock_path = os.path.join(
+            settings.GIT_MIRROR_CACHE_DIR, '{}.lock'.format(hashlib.sha256(repo_url.encode()).hexdigest())
+        )
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            mirror_path = update_mirror(repo_url)
+            logger.info('Cloning repository %s (ref=%s) in %s...', repo_url, ref, repo_dir_path)
+            git.repo.base.Repo.clone_from(mirror_path, repo_dir_path, shared=True)
+    else:
+        logger.info('Cloning repository %s (ref=%s) in %s...', repo_url, ref, repo_dir_path)
+        git.repo.base.Repo.clone_from(repo_url, repo_dir_path)
     g = git.Git(repo_dir_path)
     g.checkout(ref)
     yield g
@@ -25,6 +25,8 @@ SwampDragon routers - Register channels available to the client-side (browser)
 from swampdragon import route_handler
 from swampdragon.route_handler import BaseRouter
 
+from instance.logging import get_log_channel, LOG_CHANNEL_OBJECT_TYPES
+
 
 # Routers #####################################################################
 
@@ -32,9 +34,27 @@ class NotificationRouter(BaseRouter): #pylint: disable=abstract-method,missing-d
     route_name = 'notifier'
 
     def get_subscription_channels(self, **kwargs):
-        return ['notification', 'log']
+        return ['notification']
+
+
+class LogRouter(BaseRouter): #pylint: disable=abstract-method
+    """
+    Log entries of a single object, e.g. `swampdragon.subscribe('log', ..., {object_type: 'instance', object_id: 12})`
+    """
+    route_name = 'log'
+
+    def get_subscription_channels(self, **kwargs):
+        object_type = kwargs.get('object_type')
+        try:
+            object_id = int(kwargs.get('object_id'))
+        except (TypeError, ValueError):
+            return []
+        if object_type not in LOG_CHANNEL_OBJECT_TYPES:
+            return []
+        return [get_log_channel(object_type, object_id)]
 
 
 # Routers registration ########################################################
 
 route_handler.register(NotificationRouter)
+route_handler.register(LogRouter)
@@ -26,7 +26,7 @@ from rest_framework import serializers
 
 from instance.models.instance import InstanceReference, Instance
 from instance.models.openedx_instance import OpenEdXInstance
-from instance.serializers.logentry import LogEntrySerializer
+from instance.serializers.logentry import serialize_log_entries_page
 from instance.serializers.openedx_instance import OpenEdXInstanceSerializer
 
 
@@ -98,8 +98,8 @@ class InstanceReferenceBasicSerializer(InstanceReferenceMinimalSerializer):
         for key, val in details.items():
             output.setdefault(key, val)
         if not self.summary_only:
-            # Add log entries:
-            output['log_entries'] = [LogEntrySerializer(entry).data for entry in obj.instance.log_entries]
+            # Add the latest log entries - older entries can be fetched from the "logs" view:
+            output.update(serialize_log_entries_page(*obj.instance.get_log_entries_page()))
         return output
 
 
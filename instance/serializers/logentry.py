@@ -22,9 +22,35 @@ LogEntry serializers (API representation)
 
 # Imports #####################################################################
 
+from django.conf import settings
 from rest_framework import serializers
 
 
+# Functions ###################################################################
+
+def validate_log_cursor(value):
+    """
+    Check that a log entry cursor is well formed
+    """
+    # This module is imported by the logging configuration, before the models can be loaded
+    from instance.models.log_entry import parse_log_cursor
+    try:
+        parse_log_cursor(value)
+    except ValueError:
+        raise serializers.ValidationError('Invalid cursor.')
+    return value
+
+
+def serialize_log_entries_page(entries, before):
+    """
+    Serialize a page of log entries, as returned by `LogEntryQuerySet.page`
+    """
+    return {
+        'log_entries': LogEntrySerializer(entries, many=True).data,
+        'log_entries_before': before,
+    }
+
+
 # Serializers #################################################################
 
 class LogEntrySerializer(serializers.Serializer): #pylint: disable=abstract-method
@@ -34,3 +60,33 @@ class LogEntrySerializer(serializers.Serializer): #pylint: disable=abstract-meth
     level = serializers.CharField(read_only=True)
     text = serializers.CharField(read_only=True)
     created = serializers.DateTimeField(read_only=True)
+
+
+# create/update intentionally omitted, pylint: disable=abstract-method
+class LogEntryPageQuerySerializer(serializers.Serializer):
+    """
+    Serializer for the optional 'before', 'limit' and 'levels' arguments of the "GET .../logs/" views
+    """
+    before = serializers.CharField(
+        required=False, validators=[validate_log_cursor], label="Cursor of the oldest log entry already fetched",
+    )
+    limit = serializers.IntegerField(required=False, min_value=1, label="Maximum number of log entries")
+    levels = serializers.CharField(
+        required=False, source='level_list', label="Comma-separated logging levels, e.g. 'ERROR,CRITICAL'",
+    )
+
+    def validate_limit(self, value):  # pylint: disable=no-self-use
+        """
+        Never return more than LOG_LIMIT entries at once
+        """
+        return min(value, settings.LOG_LIMIT)
+
+    def validate_levels(self, value):  # pylint: disable=no-self-use
+        """
+        Split the list of logging levels, and check that they exist
+        """
+        levels = value.upper().split(',')
+        known_levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+        if not set(levels) <= set(known_levels):
+            raise serializers.ValidationError('Logging levels must be in {}.'.format(', '.join(known_levels)))
+        return levels
@@ -27,7 +27,6 @@ from rest_framework import serializers
 from instance.models.openedx_appserver import OpenEdXAppServer, OpenEdXAppConfiguration
 from instance.serializers.appserver import AppServerBasicSerializer
 from instance.serializers.instance import InstanceReferenceMinimalSerializer
-from instance.serializers.logentry import LogEntrySerializer
 from instance.serializers.server import OpenStackServerSerializer
 
 # Serializers #################################################################
@@ -36,11 +35,11 @@ from instance.serializers.server import OpenStackServerSerializer
 class OpenEdXAppServerSerializer(serializers.ModelSerializer):
     """
     Detailed serializer for OpenEdXAppServer
+
+    Log entries are not included, to keep the details small: they are served by the "logs" view.
     """
     instance = InstanceReferenceMinimalSerializer(source='owner')
     server = OpenStackServerSerializer()
-    log_entries = LogEntrySerializer(many=True, read_only=True)
-    log_error_entries = LogEntrySerializer(many=True, read_only=True)
 
     class Meta:
         model = OpenEdXAppServer
@@ -50,8 +49,6 @@ class OpenEdXAppServerSerializer(serializers.ModelSerializer):
             'configuration_settings',
             'instance',
             'server',
-            'log_entries',
-            'log_error_entries',
         )
 
     def to_representation(self, obj):
@@ -25,6 +25,7 @@ Server serializers (API representation)
 from rest_framework import serializers
 
 from instance.models.server import OpenStackServer
+from instance.tasks import refresh_server_status
 
 
 # Serializers #################################################################
@@ -32,6 +33,10 @@ from instance.models.server import OpenStackServer
 class OpenStackServerSerializer(serializers.ModelSerializer):
     """
     OpenStackServer API Serializer
+
+    The status is read from the database, and kept up to date by the worker (see `tasks.update_server_statuses`).
+    Pass `?refresh=1` to also queue an immediate refresh of the status of the server. Lists of servers
+    are refreshed by the view instead, with a single task (see `OpenStackServerViewSet.list`).
     """
     api_url = serializers.HyperlinkedIdentityField(view_name='api:openstackserver-detail')
 
@@ -45,12 +50,15 @@ class OpenStackServerSerializer(serializers.ModelSerializer):
             'name',
             'openstack_id',
             'status',
+            'status_checked_at',
             'public_ip',
         )
 
     def to_representation(self, obj):
-        # Make sure we have an up-to-date representation of the server
-        obj.update_status()
+        request = self.context.get('request')
+        listed = isinstance(self.parent, serializers.ListSerializer)
+        if request is not None and request.query_params.get('refresh') == '1' and not listed:
+            refresh_server_status(obj.pk)
         output = super().to_representation(obj)
         # Convert the state values from objects to strings:
         output['status'] = obj.status.state_id
@@ -91,7 +91,19 @@ app.controller("Index", ['$scope', '$state', 'OpenCraftAPI', '$timeout',
             });
             swampdragon.ready(function() {
                 swampdragon.subscribe('notifier', 'notification', null);
-                swampdragon.subscribe('notifier', 'log', null);
+            });
+        };
+
+        // Receive the log entries of a single object, until the given scope is destroyed.
+        // objectType is 'instance', 'appserver' or 'server'.
+        $scope.subscribeToLogs = function(scope, objectType, objectId) {
+            var channel = 'log:' + objectType + ':' + objectId;
+            var args = {object_type: objectType, object_id: objectId};
+            swampdragon.ready(function() {
+                swampdragon.subscribe('log', channel, args);
+            });
+            scope.$on('$destroy', function() {
+                swampdragon.unsubscribe('log', channel, args);
             });
         };
 
@@ -141,8 +153,10 @@ app.controller("Details", ['$scope', '$state', '$stateParams', 'OpenCraftAPI',
         $scope.init = function() {
             $scope.is_spawning_appserver = false;
             $scope.is_updating_from_pr = false;
+            $scope.is_loading_log_entries = false;
             $scope.instance_active_tabs = {};
             $scope.old_appserver_count = 0;
+            $scope.subscribeToLogs($scope, 'instance', $stateParams.instanceId);
             $scope.refresh();
         };
 
@@ -180,6 +194,18 @@ app.controller("Details", ['$scope', '$state', '$stateParams', 'OpenCraftAPI',
             });
         };
 
+        $scope.load_older_log_entries = function() {
+            // Fetch the page of log entries preceding the oldest one displayed, and show it above
+            $scope.is_loading_log_entries = true;
+            var params = {before: $scope.instance.log_entries_before};
+            return OpenCraftAPI.one("instance", $stateParams.instanceId).customGET('logs', params).then(function(page) {
+                $scope.instance.log_entries.unshift.apply($scope.instance.log_entries, page.log_entries);
+                $scope.instance.log_entries_before = page.log_entries_before;
+            }).finally(function() {
+                $scope.is_loading_log_entries = false;
+            });
+        };
+
         $scope.spawn_appserver = function() {
             console.log('Spawning new AppServer');
             $scope.is_spawning_appserver = true; // Disable the button
@@ -201,9 +227,9 @@ app.controller("Details", ['$scope', '$state', '$stateParams', 'OpenCraftAPI',
                 $scope.refresh();
             }
         });
-        $scope.$on("swampdragon:object_log_line", function (event, data) {
+        $scope.$on("swampdragon:object_log_lines", function (event, data) {
             if (data.instance_id == $scope.instance.id && !data.appserver_id) {
-                $scope.instance.log_entries.push(data.log_entry);
+                $scope.instance.log_entries.push.apply($scope.instance.log_entries, data.log_entries);
             }
         });
 
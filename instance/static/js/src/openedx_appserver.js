@@ -21,6 +21,22 @@
 
 var app = angular.module('InstanceApp'); // Load the existing app so we can add to it.
 
+// Return a loaded page of log entries, followed by the log entries received by websocket
+// which the page doesn't include yet. Published log entries don't have an ID, so they are
+// compared on their date, level and text.
+function mergeLogEntries(pageEntries, receivedEntries) {
+    var getKey = function(logEntry) {
+        return [logEntry.created, logEntry.level, logEntry.text].join(' | ');
+    };
+    var pageKeys = {};
+    pageEntries.forEach(function(logEntry) {
+        pageKeys[getKey(logEntry)] = true;
+    });
+    return pageEntries.concat(receivedEntries.filter(function(logEntry) {
+        return !pageKeys[getKey(logEntry)];
+    }));
+}
+
 app.config(function($stateProvider) {
 
     $stateProvider
@@ -36,7 +52,14 @@ app.controller("OpenEdXAppServerDetails", ['$scope', '$state', '$stateParams', '
 
         $scope.init = function() {
             $scope.appserver = null;
+            $scope.log_server_id = null;
+            $scope.log_entries = [];
+            $scope.log_entries_before = null;
+            $scope.log_error_entries = [];
+            $scope.is_loading_log_entries = false;
+            $scope.subscribeToLogs($scope, 'appserver', $stateParams.appserverId);
             $scope.refresh();
+            $scope.load_log_entries();
         };
 
         $scope.refresh = function() {
@@ -44,14 +67,43 @@ app.controller("OpenEdXAppServerDetails", ['$scope', '$state', '$stateParams', '
                 if (appserver.instance.id != $stateParams.instanceId) {
                     throw "This appserver is associated with another instance.";
                 }
-                if (typeof appserver.log_error_entries === "undefined") {
-                    appserver.log_error_entries = [];  // This field is not always present.
-                }
                 $scope.appserver = appserver;
+                if (appserver.server && appserver.server.id != $scope.log_server_id) {
+                    // Also receive the log entries of the VM, once it is known
+                    $scope.log_server_id = appserver.server.id;
+                    $scope.subscribeToLogs($scope, 'server', appserver.server.id);
+                }
                 $scope.is_active = $scope.instance.active_appserver && (appserver.id == $scope.instance.active_appserver.id);
             });
         };
 
+        $scope.load_log_entries = function() {
+            // The log entries are not part of the AppServer details: load the latest ones,
+            // and the latest errors, which are displayed separately when the AppServer failed.
+            // Keep the log entries received by websocket in the meantime.
+            var api = OpenCraftAPI.one("openedx_appserver", $stateParams.appserverId);
+            api.customGET('logs').then(function(page) {
+                $scope.log_entries = mergeLogEntries(page.log_entries, $scope.log_entries);
+                $scope.log_entries_before = page.log_entries_before;
+            });
+            api.customGET('logs', {levels: 'ERROR,CRITICAL'}).then(function(page) {
+                $scope.log_error_entries = mergeLogEntries(page.log_entries, $scope.log_error_entries);
+            });
+        };
+
+        $scope.load_older_log_entries = function() {
+            // Fetch the page of log entries preceding the oldest one displayed, and show it above
+            $scope.is_loading_log_entries = true;
+            var params = {before: $scope.log_entries_before};
+            var api = OpenCraftAPI.one("openedx_appserver", $stateParams.appserverId);
+            return api.customGET('logs', params).then(function(page) {
+                $scope.log_entries.unshift.apply($scope.log_entries, page.log_entries);
+                $scope.log_entries_before = page.log_entries_before;
+            }).finally(function() {
+                $scope.is_loading_log_entries = false;
+            });
+        };
+
         $scope.make_appserver_active = function() {
             $scope.is_active = true; // Disable the button optimistically
             OpenCraftAPI.one("openedx_appserver", $stateParams.appserverId).post('make_active').then(function() {
@@ -66,15 +118,19 @@ app.controller("OpenEdXAppServerDetails", ['$scope', '$state', '$stateParams', '
             });
         };
 
-        $scope.$on("swampdragon:object_log_line", function (event, data) {
+        $scope.$on("swampdragon:object_log_lines", function (event, data) {
             if (!$scope.appserver) {
                 return; // The App Server is not loaded yet, so no need to watch for log lines
             }
             if (data.appserver_id == $scope.appserver.id || ($scope.appserver.server && data.server_id == $scope.appserver.server.id)) {
-                if (data.log_entry.level == 'ERROR' || data.log_entry.level == 'CRITICAL') {
-                    $scope.appserver.log_error_entries.push(data.log_entry);
+                // Log lines are sent in batches, so append them all at once
+                var errorEntries = data.log_entries.filter(function(logEntry) {
+                    return logEntry.level == 'ERROR' || logEntry.level == 'CRITICAL';
+                });
+                if (errorEntries.length) {
+                    $scope.log_error_entries.push.apply($scope.log_error_entries, errorEntries);
                 }
-                $scope.appserver.log_entries.push(data.log_entry);
+                $scope.log_entries.push.apply($scope.log_entries, data.log_entries);
             }
         });
 
@@ -84,6 +140,19 @@ app.controller("OpenEdXAppServerDetails", ['$scope', '$state', '$stateParams', '
             }
         });
 
+        // The status of the VM is displayed too: refresh it when the VM is saved, or updated
+        // in bulk with other VMs (e.g. when they are terminated together)
+        $scope.$on("swampdragon:server_update", function(event, data) {
+            if ($scope.appserver && $scope.appserver.server && data.server_pk == $scope.appserver.server.id) {
+                $scope.refresh();
+            }
+        });
+        $scope.$on("swampdragon:servers_update", function(event, data) {
+            if ($scope.appserver && $scope.appserver.server && data.server_pks.indexOf($scope.appserver.server.id) != -1) {
+                $scope.refresh();
+            }
+        });
+
         $scope.init();
     }
 ]);
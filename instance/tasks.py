@@ -22,11 +22,19 @@ Worker tasks for instance hosting & management
 
 # Imports #####################################################################
 
+from datetime import timedelta
 import logging
 
-from huey.contrib.djhuey import db_task
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import timezone
+from huey.contrib.djhuey import crontab, db_periodic_task, db_task
 
+from instance.models.log_entry import LogEntry
+from instance.models.openedx_appserver import OpenEdXAppServer
 from instance.models.openedx_instance import OpenEdXInstance
+from instance.models.server import OpenStackServer
 
 
 # Logging #####################################################################
@@ -60,3 +68,101 @@ def spawn_appserver(instance_ref_id, mark_active_on_success=False, num_attempts=
                 # finish and replace the second as the active server. We are not really worried about that for now.
                 instance.set_appserver_active(appserver_id)
             break
+
+
+@db_task()
+def spawn_appservers(instance_ref_ids, mark_active_on_success=False):
+    """
+    Create a new AppServer for each of several existing instances, configuring them together with
+    one ansible run per playbook (see `OpenEdXInstance.spawn_appservers()`).
+
+    instance_ref_ids should be a list of IDs of InstanceReferences (instance.ref.pk)
+
+    Optionally mark each new AppServer as active when its provisioning completes.
+    """
+    logger.info('Retrieving instances: IDs=%s', instance_ref_ids)
+    instances = list(OpenEdXInstance.objects.filter(ref_set__pk__in=instance_ref_ids))
+    for instance in instances:
+        instance.logger.info('Spawning new AppServer, with %d other instances', len(instances) - 1)
+    appserver_ids = OpenEdXInstance.spawn_appservers(instances)
+    if mark_active_on_success:
+        for instance, appserver_id in zip(instances, appserver_ids):
+            if appserver_id:
+                instance.set_appserver_active(appserver_id)
+
+
+@db_task()
+def refresh_server_status(server_pk):
+    """
+    Refresh the status of a single OpenStack server from nova, outside of the API request cycle
+
+    Pending servers are skipped, like in `OpenStackServerQuerySet.update_status`, since refreshing
+    their status would start their VM.
+    """
+    server = OpenStackServer.objects.get(pk=server_pk)
+    if server.vm_not_yet_requested:
+        return
+    server.update_status()
+
+
+@db_task()
+def refresh_server_statuses(server_pks):
+    """
+    Refresh the status of several OpenStack servers from nova, outside of the API request cycle
+
+    The servers are reconciled together, with a single listing of the nova servers.
+    """
+    OpenStackServer.objects.filter(pk__in=server_pks).update_status()
+
+
+@db_periodic_task(crontab(minute='*/1'))
+def update_server_statuses():
+    """
+    Reconcile the status of all the OpenStack servers with nova, in a single pass
+    """
+    reconciliation = OpenStackServer.objects.update_status()
+    if reconciliation.servers:
+        logger.info(
+            'Updated the status of %d servers using %d nova API calls (%d calls saved)',
+            reconciliation.servers, reconciliation.api_calls, reconciliation.api_calls_saved,
+        )
+
+
+@db_periodic_task(crontab(hour='3', minute='0'))
+def delete_expired_log_entries():
+    """
+    Delete the log entries which are past their retention period (see `LogEntryQuerySet.expired`)
+    """
+    num_deleted = LogEntry.objects.expired().delete_in_chunks()
+    if num_deleted:
+        logger.info('Deleted %d expired log entries', num_deleted)
+
+
+@db_periodic_task(crontab(minute='15'))
+def archive_appserver_log_entries():
+    """
+    Move the older log entries of the AppServers which failed or are terminated to compressed
+    archives (see `AppServer.archive_log_entries`), if LOG_ARCHIVE_STORAGE is set. An error with
+    one AppServer doesn't prevent archiving the logs of the others.
+    """
+    if not settings.LOG_ARCHIVE_STORAGE:
+        return
+    before = timezone.now() - timedelta(hours=settings.LOG_ARCHIVE_AFTER_HOURS)
+
+    # Find the AppServers with log entries to archive, without going through all of them
+    def get_object_ids(model):
+        """ Return the IDs of the objects of the given model with log entries to archive """
+        return LogEntry.objects.filter(
+            content_type=ContentType.objects.get_for_model(model), created__lt=before,
+        ).order_by().values_list('object_id', flat=True).distinct()
+    app_servers = OpenEdXAppServer.objects.filter(
+        Q(pk__in=get_object_ids(OpenEdXAppServer)) | Q(server_id__in=get_object_ids(OpenStackServer)),
+        _status__in=[status.state_id for status in OpenEdXAppServer.ARCHIVABLE_STATUSES],
+    )
+    for app_server in app_servers:
+        try:
+            num_archived = app_server.archive_log_entries(before)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not archive the log entries of %s', app_server)
+            continue
+        logger.info('Archived %d log entries of %s to %s', num_archived, app_server, app_server.log_archive)
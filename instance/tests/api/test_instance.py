@@ -23,6 +23,7 @@ Views - Tests
 # Imports #####################################################################
 
 import ddt
+from django.test import override_settings
 from rest_framework import status
 
 from instance.tests.api.base import APITestCase
@@ -132,3 +133,25 @@ class InstanceAPITestCase(APITestCase):
         for expected_entry, log_entry in zip(expected_list, response.data['log_entries']):
             self.assertEqual(expected_entry['level'], log_entry['level'])
             self.assertEqual(expected_entry['text'].format(inst_id=instance.ref.pk), log_entry['text'])
+
+    def test_get_log_entries_page(self):
+        """
+        GET - Older log entries are fetched one page at a time
+        """
+        self.api_client.login(username='user3', password='pass')
+        instance = OpenEdXInstanceFactory()
+        for i in range(3):
+            instance.logger.info("line %d", i)
+
+        with override_settings(LOG_PAGE_SIZE=2):
+            response = self.api_client.get('/api/v1/instance/{pk}/'.format(pk=instance.ref.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['text'][-6:] for entry in response.data['log_entries']], ['line 1', 'line 2'])
+
+        response = self.api_client.get(
+            '/api/v1/instance/{pk}/logs/'.format(pk=instance.ref.pk),
+            {'before': response.data['log_entries_before']},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['text'][-6:] for entry in response.data['log_entries']], ['line 0'])
+        self.assertIsNone(response.data['log_entries_before'])
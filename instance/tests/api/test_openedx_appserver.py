@@ -25,6 +25,7 @@ Views - Tests
 from unittest.mock import patch
 import ddt
 
+from django.test import override_settings
 from rest_framework import status
 
 from instance.tests.api.base import APITestCase
@@ -142,11 +143,27 @@ class OpenEdXAppServerAPITestCase(APITestCase):
         server_data = response.data['server'].items()
         self.assertIn(('id', app_server.server.pk), server_data)
         self.assertIn(('public_ip', None), server_data)
-        # The API call will try to start the server, which will fail, since we're
-        # not actually talking to an OpenStack instance when unit tests are running
-        self.assertIn(('status', 'failed'), server_data)
-        self.assertIn('log_entries', response.data)
-        self.assertIn('log_error_entries', response.data)
+        # The status is read from the database, without querying OpenStack
+        self.assertIn(('status', 'pending'), server_data)
+        self.assertIn(('status_checked_at', None), server_data)
+        # Log entries are served by the logs view
+        self.assertNotIn('log_entries', response.data)
+        self.assertNotIn('log_error_entries', response.data)
+
+    @patch('instance.serializers.server.refresh_server_status')
+    def test_get_details_refresh_server_status(self, mock_refresh_server_status):
+        """
+        GET - Detailed attributes - the server status refresh is queued when requested
+        """
+        self.api_client.login(username='user3', password='pass')
+        app_server = make_test_appserver()
+        response = self.api_client.get('/api/v1/openedx_appserver/{pk}/'.format(pk=app_server.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(mock_refresh_server_status.called)
+
+        response = self.api_client.get('/api/v1/openedx_appserver/{pk}/?refresh=1'.format(pk=app_server.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_refresh_server_status.assert_called_once_with(app_server.server.pk)
 
     def test_view_name(self):
         """
@@ -225,7 +242,7 @@ class OpenEdXAppServerAPITestCase(APITestCase):
         server.logger.info("info")
         server.logger.error("error")
 
-        response = self.api_client.get('/api/v1/openedx_appserver/{pk}/'.format(pk=app_server.pk))
+        response = self.api_client.get('/api/v1/openedx_appserver/{pk}/logs/'.format(pk=app_server.pk))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         expected_list = [
@@ -251,22 +268,61 @@ class OpenEdXAppServerAPITestCase(APITestCase):
                 'level': 'ERROR',
                 'text': 'instance.models.server    | server={server_name} | error',
             },
-            {
-                'level': 'INFO',
-                'text': 'instance.models.server    | server={server_name} |'
-                        ' Starting server (status=Pending [pending])...'
-            },
-            {
-                'level': 'ERROR',
-                'text': 'instance.models.server    | server={server_name} |'
-                        ' Failed to start server: Not found (HTTP 404)'
-            },
         ]
         self.check_log_list(
             expected_list, response.data['log_entries'],
             inst_id=instance.ref.id, as_id=app_server.pk, server_name=server.name,
         )
 
+    def test_get_log_entries_page(self):
+        """
+        GET - Older log entries are fetched one page at a time
+        """
+        self.api_client.login(username='user3', password='pass')
+        app_server = make_test_appserver()
+        for i in range(5):
+            app_server.logger.info("line %d", i)
+
+        url = '/api/v1/openedx_appserver/{pk}/logs/'.format(pk=app_server.pk)
+        with override_settings(LOG_PAGE_SIZE=2):
+            response = self.api_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['text'][-6:] for entry in response.data['log_entries']], ['line 3', 'line 4'])
+
+        response = self.api_client.get(url, {'before': response.data['log_entries_before'], 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['text'][-6:] for entry in response.data['log_entries']], ['line 1', 'line 2'])
+        response = self.api_client.get(url, {'before': response.data['log_entries_before']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['text'][-6:] for entry in response.data['log_entries']], ['line 0'])
+        self.assertIsNone(response.data['log_entries_before'])
+
+    def test_get_log_entries_page_invalid(self):
+        """
+        GET - Invalid log page parameters are rejected
+        """
+        self.api_client.login(username='user3', password='pass')
+        app_server = make_test_appserver()
+        url = '/api/v1/openedx_appserver/{pk}/logs/'.format(pk=app_server.pk)
+        response = self.api_client.get(url, {'before': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('before', response.data)
+        response = self.api_client.get(url, {'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('limit', response.data)
+
+    def test_get_log_entries_invalid_levels(self):
+        """
+        GET - Unknown logging levels are rejected
+        """
+        self.api_client.login(username='user3', password='pass')
+        app_server = make_test_appserver()
+        response = self.api_client.get(
+            '/api/v1/openedx_appserver/{pk}/logs/'.format(pk=app_server.pk), {'levels': 'error,fatal'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('levels', response.data)
+
     def check_log_list(self, expected_list, log_list, **kwargs):
         """
         Check that the log entries in log_list match expected_list.
@@ -292,7 +348,9 @@ class OpenEdXAppServerAPITestCase(APITestCase):
         server.logger.info("info")
         server.logger.error("error")
 
-        response = self.api_client.get('/api/v1/openedx_appserver/{pk}/'.format(pk=app_server.pk))
+        response = self.api_client.get(
+            '/api/v1/openedx_appserver/{pk}/logs/'.format(pk=app_server.pk), {'levels': 'error,critical'},
+        )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         expected_list = [
@@ -307,13 +365,8 @@ class OpenEdXAppServerAPITestCase(APITestCase):
                 'level': 'ERROR',
                 'text': 'instance.models.server    | server={server_name} | error',
             },
-            {
-                'level': 'ERROR',
-                'text': 'instance.models.server    | server={server_name} |'
-                        ' Failed to start server: Not found (HTTP 404)'
-            },
         ]
         self.check_log_list(
-            expected_list, response.data['log_error_entries'],
+            expected_list, response.data['log_entries'],
             inst_id=instance.ref.id, as_id=app_server.pk, server_name=server.name,
         )
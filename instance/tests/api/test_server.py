@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+OpenStackServer API - Tests
+"""
+
+# Imports #####################################################################
+
+from unittest.mock import patch
+
+from rest_framework import status
+
+from instance.tests.api.base import APITestCase
+from instance.tests.models.factories.server import OpenStackServerFactory
+
+
+# Tests #######################################################################
+
+class OpenStackServerAPITestCase(APITestCase):
+    """
+    Test cases for OpenStackServer API calls
+    """
+    @patch('instance.serializers.server.refresh_server_status')
+    @patch('instance.api.server.refresh_server_statuses')
+    def test_list_refresh_server_statuses(self, mock_refresh_server_statuses, mock_refresh_server_status):
+        """
+        GET - List - the statuses of the listed servers are refreshed by a single task when requested
+        """
+        self.api_client.login(username='user3', password='pass')
+        servers = [OpenStackServerFactory(), OpenStackServerFactory()]
+        response = self.api_client.get('/api/v1/openstackserver/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(mock_refresh_server_statuses.called)
+
+        response = self.api_client.get('/api/v1/openstackserver/?refresh=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(mock_refresh_server_statuses.call_count, 1)
+        self.assertCountEqual(mock_refresh_server_statuses.call_args[0][0], [server.pk for server in servers])
+        self.assertFalse(mock_refresh_server_status.called)
+
+    @patch('instance.serializers.server.refresh_server_status')
+    def test_get_details_refresh_server_status(self, mock_refresh_server_status):
+        """
+        GET - Details - the status of the server is refreshed when requested
+        """
+        self.api_client.login(username='user3', password='pass')
+        server = OpenStackServerFactory()
+        response = self.api_client.get('/api/v1/openstackserver/{pk}/?refresh=1'.format(pk=server.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_refresh_server_status.assert_called_once_with(server.pk)
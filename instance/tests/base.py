@@ -28,6 +28,7 @@ import re
 
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.test import TestCase as DjangoTestCase
 
 from ..models.instance import InstanceReference
@@ -70,6 +71,18 @@ def add_fixture_to_object(obj, fixture_filename):
     return obj
 
 
+def run_on_commit_callbacks(using=DEFAULT_DB_ALIAS):
+    """
+    Run the callbacks registered with `transaction.on_commit()` so far
+
+    TestCase never commits the test transaction, so these callbacks would otherwise never be called.
+    """
+    connection = connections[using]
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for dummy, callback in callbacks:
+        callback()
+
+
 # Classes #####################################################################
 
 class AnyStringMatching(str):
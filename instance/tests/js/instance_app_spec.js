@@ -52,7 +52,9 @@ describe('Instance app', function () {
                 };
             }),
             sendChannelMessage: undefined,
-            ready: jasmine.createSpy()
+            ready: jasmine.createSpy().and.callFake(function(fn) { fn(); }),
+            subscribe: jasmine.createSpy(),
+            unsubscribe: jasmine.createSpy()
         };
 
         // Models
@@ -162,6 +164,16 @@ describe('Instance app', function () {
             });
         });
 
+        describe('log subscription', function() {
+            it('subscribes to the log entries of the instance until the view is closed', function() {
+                const args = {object_type: 'instance', object_id: 50};
+                expect(swampdragon.subscribe).toHaveBeenCalledWith('log', 'log:instance:50', args);
+                expect(swampdragon.unsubscribe).not.toHaveBeenCalled();
+                $scope.$destroy();
+                expect(swampdragon.unsubscribe).toHaveBeenCalledWith('log', 'log:instance:50', args);
+            });
+        });
+
         describe('swampdragon event handlers', function() {
             beforeEach(function() {
                 spyOn(rootScope, 'updateInstanceList'); // Mock this out to avoid its HTTP requests
@@ -183,28 +195,28 @@ describe('Instance app', function () {
             it("update the instance's log entries", function() {
                 const logEntry = {created: new Date(), level: "INFO", text: "A long time ago"};
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     instance_id: instanceDetail.id,
-                    log_entry: logEntry,
+                    log_entries: [logEntry],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
                 expect($scope.instance.log_entries.push).toHaveBeenCalledWith(logEntry);
             });
             it("do not update the instance's log entries for other instance logs", function() {
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     instance_id: 400,
-                    log_entry: {created: new Date(), level: "INFO", text: "Irrelevant log line"},
+                    log_entries: [{created: new Date(), level: "INFO", text: "Irrelevant log line"}],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
                 expect($scope.instance.log_entries.push).not.toHaveBeenCalled();
             });
             it("do not update the instance's log entries for AppServer logs", function() {
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     instance_id: instanceDetail.id,
                     appserver_id: 15,
-                    log_entry: {created: new Date(), level: "INFO", text: "Irrelevant log line"},
+                    log_entries: [{created: new Date(), level: "INFO", text: "Irrelevant log line"}],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
                 expect($scope.instance.log_entries.push).not.toHaveBeenCalled();
@@ -215,6 +227,22 @@ describe('Instance app', function () {
             });
         });
 
+        describe('$scope.load_older_log_entries', function() {
+            it('prepends the previous page of log entries', function() {
+                const olderEntry = {created: "2016-05-19T03:30:00.000000Z", level: "INFO", text: "Older line"};
+                $scope.instance.log_entries_before = '2016-05-19T03:33:25.272824Z,381';
+                httpBackend.expectGET(
+                    '/api/v1/instance/50/logs/?before=2016-05-19T03:33:25.272824Z,381'
+                ).respond({log_entries: [olderEntry], log_entries_before: null});
+                $scope.load_older_log_entries();
+                expect($scope.is_loading_log_entries).toBe(true);
+                flushHttpBackend();
+                expect($scope.is_loading_log_entries).toBe(false);
+                expect($scope.instance.log_entries).toEqual([olderEntry]);
+                expect($scope.instance.log_entries_before).toBe(null);
+            });
+        });
+
         describe('$scope.spawn_appserver', function() {
             it('will spawn an appserver and set is_spawning_appserver=true until the appserver is ready', function() {
                 expect($scope.is_spawning_appserver).toBe(false);
@@ -288,12 +316,18 @@ describe('Instance app', function () {
     describe('OpenEdXAppServerDetails controller', function() {
         var $scope,
             parentScope,
-            appServerDetail;
+            appServerDetail,
+            appServerLogs,
+            appServerErrorLogs;
 
         beforeEach(function() {
             // Models
             appServerDetail = jasmine.loadFixture('api/appserver_detail.json');
+            appServerLogs = jasmine.loadFixture('api/appserver_logs.json');
+            appServerErrorLogs = {log_entries: [], log_entries_before: null};
             httpBackend.whenGET('/api/v1/openedx_appserver/8/').respond(appServerDetail);
+            httpBackend.whenGET('/api/v1/openedx_appserver/8/logs/').respond(appServerLogs);
+            httpBackend.whenGET('/api/v1/openedx_appserver/8/logs/?levels=ERROR,CRITICAL').respond(appServerErrorLogs);
 
             // Mock the parent scope (instance details)
             parentScope = rootScope.$new(); // Scope for the Instance "Details" controller
@@ -315,13 +349,23 @@ describe('Instance app', function () {
 
         describe('$scope.refresh', function() {
             it('loads the AppServer details from the API on init', function() {
-                // If django-rest-framework's serializers have dropped the empty 'log_error_entries'
-                // field, it should have been added back (so that we can call .push() on it):
-                if (!appServerDetail.log_error_entries) {
-                    appServerDetail.log_error_entries = [];
-                }
                 expect(jasmine.sanitizeRestangularOne($scope.appserver)).toEqual(appServerDetail);
             });
+            it('subscribes to the log entries of the AppServer and of its VM', function() {
+                expect(swampdragon.subscribe).toHaveBeenCalledWith(
+                    'log', 'log:appserver:8', {object_type: 'appserver', object_id: 8}
+                );
+                const serverId = appServerDetail.server.id;
+                expect(swampdragon.subscribe).toHaveBeenCalledWith(
+                    'log', 'log:server:' + serverId, {object_type: 'server', object_id: serverId}
+                );
+
+                // Refreshing the AppServer doesn't subscribe again
+                swampdragon.subscribe.calls.reset();
+                $scope.refresh();
+                flushHttpBackend();
+                expect(swampdragon.subscribe).not.toHaveBeenCalled();
+            });
             it('sets is_active correctly', function() {
                 expect($scope.is_active).toBe(true); // Based on the fixture, AppServer 8 is active
 
@@ -337,6 +381,45 @@ describe('Instance app', function () {
             });
         });
 
+        describe('$scope.load_log_entries', function() {
+            it('loads the latest log entries and errors from the API on init', function() {
+                expect($scope.log_entries).toEqual(appServerLogs.log_entries);
+                expect($scope.log_entries_before).toEqual(appServerLogs.log_entries_before);
+                expect($scope.log_error_entries).toEqual([]);
+            });
+            it('keeps the log entries received while loading them', function() {
+                const loadedEntry = appServerLogs.log_entries[appServerLogs.log_entries.length - 1];
+                const newEntry = {created: "2016-05-19T03:40:00.000000Z", level: "ERROR", text: "Newer line"};
+                $scope.log_entries = [];
+                $scope.log_error_entries = [];
+                $scope.load_log_entries();
+                swampdragon.sendChannelMessage({
+                    type: "object_log_lines",
+                    appserver_id: appServerDetail.id,
+                    log_entries: [angular.copy(loadedEntry), newEntry],
+                });
+                flushHttpBackend();
+                expect($scope.log_entries).toEqual(appServerLogs.log_entries.concat([newEntry]));
+                expect($scope.log_error_entries).toEqual([newEntry]);
+            });
+        });
+
+        describe('$scope.load_older_log_entries', function() {
+            it('prepends the previous page of log entries', function() {
+                const olderEntry = {created: "2016-05-19T03:30:00.000000Z", level: "INFO", text: "Older line"};
+                const newerEntries = appServerLogs.log_entries;
+                httpBackend.expectGET(
+                    '/api/v1/openedx_appserver/8/logs/?before=' + appServerLogs.log_entries_before
+                ).respond({log_entries: [olderEntry], log_entries_before: null});
+                $scope.load_older_log_entries();
+                expect($scope.is_loading_log_entries).toBe(true);
+                flushHttpBackend();
+                expect($scope.is_loading_log_entries).toBe(false);
+                expect($scope.log_entries).toEqual([olderEntry].concat(newerEntries));
+                expect($scope.log_entries_before).toBe(null);
+            });
+        });
+
         describe('$scope.make_appserver_active', function() {
             it('will make an API call to make the AppServer active, then refresh the view', function() {
                 parentScope.instance.active_appserver = null;
@@ -368,8 +451,8 @@ describe('Instance app', function () {
             beforeEach(function() {
                 spyOn(rootScope, 'updateInstanceList'); // Mock this out to avoid its HTTP requests
                 spyOn($scope, 'refresh');
-                spyOn($scope.appserver.log_entries, 'push');
-                spyOn($scope.appserver.log_error_entries, 'push');
+                spyOn($scope.log_entries, 'push');
+                spyOn($scope.log_error_entries, 'push');
             });
             it('update the AppServer details whenever the AppServer is updated', function() {
                 swampdragon.sendChannelMessage({type: "openedx_appserver_update", appserver_id: 404});
@@ -377,64 +460,89 @@ describe('Instance app', function () {
                 swampdragon.sendChannelMessage({type: "openedx_appserver_update", appserver_id: appServerDetail.id});
                 expect($scope.refresh).toHaveBeenCalled();
             });
+            it('update the AppServer details whenever its VM is updated', function() {
+                const serverId = appServerDetail.server.id;
+                swampdragon.sendChannelMessage({type: "server_update", server_pk: serverId + 1});
+                swampdragon.sendChannelMessage({type: "servers_update", server_pks: [serverId + 1, serverId + 2]});
+                expect($scope.refresh).not.toHaveBeenCalled();
+                swampdragon.sendChannelMessage({type: "server_update", server_pk: serverId});
+                expect($scope.refresh.calls.count()).toBe(1);
+                swampdragon.sendChannelMessage({type: "servers_update", server_pks: [serverId + 1, serverId]});
+                expect($scope.refresh.calls.count()).toBe(2);
+            });
             it("update the AppServer's log entries for new AppServer logs", function() {
                 const logEntry = {created: new Date(), level: "INFO", text: "A long time ago"};
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     appserver_id: appServerDetail.id,
-                    log_entry: logEntry,
+                    log_entries: [logEntry],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).toHaveBeenCalledWith(logEntry);
-                expect($scope.appserver.log_error_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_entries.push).toHaveBeenCalledWith(logEntry);
+                expect($scope.log_error_entries.push).not.toHaveBeenCalled();
             });
             it("update the AppServer's log entries for new AppServer error logs", function() {
                 const logEntry = {created: new Date(), level: "ERROR", text: "Something went wrong"};
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
+                    appserver_id: appServerDetail.id,
+                    log_entries: [logEntry],
+                });
+                expect($scope.refresh).not.toHaveBeenCalled();
+                expect($scope.log_entries.push).toHaveBeenCalledWith(logEntry);
+                expect($scope.log_error_entries.push).toHaveBeenCalledWith(logEntry);
+            });
+            it("update the AppServer's log entries with a batch of AppServer logs", function() {
+                const logEntries = [
+                    {created: new Date(), level: "INFO", text: "A long time ago"},
+                    {created: new Date(), level: "ERROR", text: "Something went wrong"},
+                    {created: new Date(), level: "INFO", text: "In a galaxy far, far away"},
+                ];
+                swampdragon.sendChannelMessage({
+                    type: "object_log_lines",
                     appserver_id: appServerDetail.id,
-                    log_entry: logEntry,
+                    log_entries: logEntries,
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).toHaveBeenCalledWith(logEntry);
-                expect($scope.appserver.log_error_entries.push).toHaveBeenCalledWith(logEntry);
+                expect($scope.log_entries.push).toHaveBeenCalledWith(logEntries[0], logEntries[1], logEntries[2]);
+                expect($scope.log_error_entries.push).toHaveBeenCalledWith(logEntries[1]);
             });
             it("do not update the AppServer's log entries for other AppServer logs", function() {
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     appserver_id: 404,
-                    log_entry: {created: new Date(), level: "INFO", text: "Irrelevant log line"},
+                    log_entries: [{created: new Date(), level: "INFO", text: "Irrelevant log line"}],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).not.toHaveBeenCalled();
-                expect($scope.appserver.log_error_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_error_entries.push).not.toHaveBeenCalled();
             });
             it("update the AppServer's log entries for new VM error logs", function() {
                 const logEntry = {created: new Date(), level: "ERROR", text: "Something went wrong on the server"};
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     server_id: appServerDetail.server.id,
-                    log_entry: logEntry,
+                    log_entries: [logEntry],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).toHaveBeenCalledWith(logEntry);
-                expect($scope.appserver.log_error_entries.push).toHaveBeenCalledWith(logEntry);
+                expect($scope.log_entries.push).toHaveBeenCalledWith(logEntry);
+                expect($scope.log_error_entries.push).toHaveBeenCalledWith(logEntry);
             });
             it("do not update the AppServer's log entries for other VM logs", function() {
                 swampdragon.sendChannelMessage({
-                    type: "object_log_line",
+                    type: "object_log_lines",
                     server_id: 404,
-                    log_entry: {created: new Date(), level: "INFO", text: "Irrelevant log line"},
+                    log_entries: [{created: new Date(), level: "INFO", text: "Irrelevant log line"}],
                 });
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).not.toHaveBeenCalled();
-                expect($scope.appserver.log_error_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_error_entries.push).not.toHaveBeenCalled();
             });
             it('do not update the AppServer or log entries details for other changes', function() {
                 swampdragon.sendChannelMessage({type: "other_update"});
                 expect($scope.refresh).not.toHaveBeenCalled();
-                expect($scope.appserver.log_entries.push).not.toHaveBeenCalled();
-                expect($scope.appserver.log_error_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_entries.push).not.toHaveBeenCalled();
+                expect($scope.log_error_entries.push).not.toHaveBeenCalled();
             });
         });
     });
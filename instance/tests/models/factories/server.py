@@ -75,9 +75,18 @@ class OSServerMockManager:
         Returns the mock `os_server` for this `openstack_id`
         """
         if openstack_id not in self._os_server_dict.keys():
-            self._os_server_dict[openstack_id] = MagicMock(addresses={"Ext-Net": [{"addr": "1.1.1.1", }]})
+            self._os_server_dict[openstack_id] = MagicMock(
+                id=openstack_id,
+                addresses={"Ext-Net": [{"addr": "1.1.1.1", }]},
+            )
         return self._os_server_dict[openstack_id]
 
+    def list_os_servers(self, *args, **kwargs): #pylint: disable=unused-argument
+        """
+        Returns all the mock `os_server` created so far, like `Server.nova.servers.list()`
+        """
+        return list(self._os_server_dict.values())
+
     def set_os_server_attributes(self, openstack_id, **attributes):
         """
         Set the attributes on the mock `os_server` returned for this `openstack_id`
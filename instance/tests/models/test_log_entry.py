@@ -22,15 +22,25 @@ Logger models & mixins - Tests
 
 # Imports #####################################################################
 
-from unittest.mock import patch
+import logging
+import os
+import queue
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.test import override_settings
+from django.utils.dateparse import parse_datetime
 from freezegun import freeze_time
 
+from instance.logging import DBHandler, LogShippingStats
 from instance.models.log_entry import LogEntry
-from instance.tests.base import TestCase
+from instance.models.openedx_appserver import OpenEdXAppServer
+from instance.models.server import OpenStackServer
+from instance.tests.base import TestCase, run_on_commit_callbacks
 from instance.tests.models.factories.openedx_appserver import make_test_appserver
 from instance.tests.models.factories.openedx_instance import OpenEdXInstanceFactory
 from instance.tests.models.factories.server import OpenStackServerFactory
@@ -120,16 +130,107 @@ class LoggingTestCase(TestCase):
         with override_settings(LOG_LIMIT=2):
             self.check_log_entries(self.app_server.log_entries, expected[-2:])
 
+    def test_log_entries_page(self):
+        """
+        Check that log entries can be fetched page by page, from the latest to the oldest
+        """
+        # Two lines share the same timestamp, to check that the pages don't skip or repeat entries
+        lines = [
+            ("2015-08-05 18:07:00", self.server.logger.info, 'Line #1'),
+            ("2015-08-05 18:07:01", self.app_server.logger.info, 'Line #2'),
+            ("2015-08-05 18:07:01", self.server.logger.info, 'Line #3'),
+            ("2015-08-05 18:07:02", self.instance.logger.info, 'Line #4, on instance'),
+            ("2015-08-05 18:07:03", self.server.logger.info, 'Line #5'),
+        ]
+        for date, log, text in lines:
+            with freeze_time(date):
+                log(text)
+
+        entries, before = self.app_server.get_log_entries_page(limit=2)
+        self.assertEqual([entry.text[-7:] for entry in entries], ['Line #3', 'Line #5'])
+        entries, before = self.app_server.get_log_entries_page(before=before, limit=2)
+        self.assertEqual([entry.text[-7:] for entry in entries], ['Line #1', 'Line #2'])
+        self.assertIsNone(before)
+
+        entries, before = self.instance.get_log_entries_page()
+        self.assertEqual([entry.text for entry in entries], [self.instance_prefix + 'Line #4, on instance'])
+        self.assertIsNone(before)
+
+    def test_log_entries_page_invalid_cursor(self):
+        """
+        Check that a malformed cursor is rejected
+        """
+        for cursor in ('2015-08-05T18:07:00Z', 'yesterday,1', '2015-08-05T18:07:00Z,-1'):
+            with self.assertRaises(ValueError):
+                LogEntry.objects.page(before=cursor)
+
+    def test_log_entries_archive(self):
+        """
+        Check that the archived log entries of an AppServer are read transparently
+        """
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        lines = [
+            ("2015-08-05 18:07:00", self.server.logger.info, 'Line #1'),
+            ("2015-08-05 18:07:01", self.app_server.logger.error, 'Line #2'),
+            ("2015-08-05 18:07:02", self.server.logger.info, 'Line #3'),
+            ("2015-08-05 18:07:03", self.app_server.logger.info, 'Line #4'),
+            ("2015-08-05 18:07:04", self.server.logger.error, 'Line #5'),
+        ]
+        for date, log, text in lines:
+            with freeze_time(date):
+                log(text)
+
+        with override_settings(LOG_ARCHIVE_STORAGE='local', LOG_ARCHIVE_LOCAL_DIR=archive_dir):
+            self.assertEqual(self.app_server.archive_log_entries(parse_datetime('2015-08-05 18:07:02Z')), 2)
+        self.assertEqual(LogEntry.objects.filter(text__contains='Line #').count(), 3)
+
+        # Read the archive from a fresh object:
+        app_server = OpenEdXAppServer.objects.get(pk=self.app_server.pk)
+        self.assertTrue(app_server.log_archive.startswith('file://'))
+        texts = lambda entries: [entry.text[-7:] for entry in entries]
+        self.assertEqual(texts(app_server.log_entries), ['Line #1', 'Line #2', 'Line #3', 'Line #4', 'Line #5'])
+        self.assertEqual(texts(app_server.log_error_entries), ['Line #2', 'Line #5'])
+        with override_settings(LOG_LIMIT=4):
+            self.assertEqual(texts(app_server.log_entries), ['Line #2', 'Line #3', 'Line #4', 'Line #5'])
+
+        entries, before = app_server.get_log_entries_page(level_list=['ERROR'])
+        self.assertEqual(texts(entries), ['Line #2', 'Line #5'])
+        self.assertIsNone(before)
+
+        entries, before = app_server.get_log_entries_page(limit=2)
+        self.assertEqual(texts(entries), ['Line #4', 'Line #5'])
+        entries, before = app_server.get_log_entries_page(before=before, limit=2)
+        self.assertEqual(texts(entries), ['Line #2', 'Line #3'])
+        entries, before = app_server.get_log_entries_page(before=before, limit=2)
+        self.assertEqual(texts(entries), ['Line #1'])
+        self.assertIsNone(before)
+
+        # Archiving again adds the newer entries to a new chunk of the archive
+        with override_settings(LOG_ARCHIVE_STORAGE='local', LOG_ARCHIVE_LOCAL_DIR=archive_dir):
+            self.assertEqual(app_server.archive_log_entries(parse_datetime('2015-08-05 18:08:00Z')), 3)
+        self.assertFalse(LogEntry.objects.filter(text__contains='Line #').exists())
+        app_server = OpenEdXAppServer.objects.get(pk=self.app_server.pk)
+        self.assertEqual(texts(app_server.log_entries), ['Line #1', 'Line #2', 'Line #3', 'Line #4', 'Line #5'])
+        archive_path = os.path.join(archive_dir, 'openedxappserver-{}'.format(app_server.pk))
+        self.assertEqual(sorted(os.listdir(archive_path)), ['00000.jsonl.gz', '00001.jsonl.gz'])
+
+        # The archive is deleted along with the AppServer, once the transaction is committed
+        app_server.delete()
+        self.assertTrue(os.path.exists(archive_path))
+        run_on_commit_callbacks()
+        self.assertFalse(os.path.exists(archive_path))
+
     @patch('instance.logging.publish_data')
     def test_log_publish(self, mock_publish_data):
         """
-        Logger sends an event to the client on each new log entry added
+        Logger sends an event to the client with the new log entries
         """
         with freeze_time("2015-09-21 21:07:00"):
             self.instance.logger.info('Text the client should see')
 
-        mock_publish_data.assert_called_with('log', {
-            'log_entry': {
+        mock_publish_data.assert_called_with('log:instance:{}'.format(self.instance.ref.pk), {
+            'log_entries': [{
                 'created': '2015-09-21T21:07:00Z',
                 'level': 'INFO',
                 'text': (
@@ -137,8 +238,8 @@ class LoggingTestCase(TestCase):
                         self.instance.ref.pk
                     )
                 ),
-            },
-            'type': 'object_log_line',
+            }],
+            'type': 'object_log_lines',
             'instance_id': self.instance.ref.pk,
             'instance_type': 'OpenEdXInstance',
         })
@@ -146,17 +247,46 @@ class LoggingTestCase(TestCase):
         with freeze_time("2015-09-21 21:07:01"):
             self.server.logger.info('Text the client should also see, with unicode «ταБЬℓσ»')
 
-        mock_publish_data.assert_called_with('log', {
-            'log_entry': {
+        mock_publish_data.assert_called_with('log:server:{}'.format(self.server.pk), {
+            'log_entries': [{
                 'created': '2015-09-21T21:07:01Z',
                 'level': 'INFO',
                 'text': ('instance.models.server    | server=test-vm-name | Text the client '
                          'should also see, with unicode «ταБЬℓσ»'),
-            },
-            'type': 'object_log_line',
+            }],
+            'type': 'object_log_lines',
             'server_id': self.server.pk,
         })
 
+    @patch('instance.logging.publish_data')
+    def test_log_publish_coalesced(self, mock_publish_data):
+        """
+        The log entries written in the same batch are sent with one event per object, on its own channel
+        """
+        handler = DBHandler(capacity=3, flush_interval=3600)
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        test_logger = logging.getLogger('instance.tests.publish')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+
+        test_logger.info('Line #1', extra={'obj': self.instance})
+        test_logger.info('Line #2', extra={'obj': self.app_server})
+        self.assertFalse(mock_publish_data.called)
+        test_logger.info('Line #3', extra={'obj': self.instance})
+
+        self.assertEqual(mock_publish_data.call_count, 2)
+        (instance_channel, instance_event), (appserver_channel, appserver_event) = [
+            args for args, kwargs in mock_publish_data.call_args_list
+        ]
+        self.assertEqual(instance_channel, 'log:instance:{}'.format(self.instance.ref.pk))
+        self.assertEqual(instance_event['type'], 'object_log_lines')
+        self.assertEqual(instance_event['instance_id'], self.instance.ref.pk)
+        self.assertEqual([entry['text'] for entry in instance_event['log_entries']], ['Line #1', 'Line #3'])
+        self.assertEqual(appserver_channel, 'log:appserver:{}'.format(self.app_server.pk))
+        self.assertEqual(appserver_event['appserver_id'], self.app_server.pk)
+        self.assertEqual([entry['text'] for entry in appserver_event['log_entries']], ['Line #2'])
+
     def test_log_delete(self):
         """
         Check `log_entries` output for combination of instance & server logs
@@ -170,8 +300,10 @@ class LoggingTestCase(TestCase):
 
         self.assertEqual(LogEntry.objects.count(), 3)
         # Delete server 1:
-        server1_id = server1.pk
         server1.delete()
+        # Its log entry is only deleted once the transaction is committed:
+        self.assertEqual(LogEntry.objects.count(), 3)
+        run_on_commit_callbacks()
         # Now its log entry should be deleted:
         entries = LogEntry.objects.order_by('pk').all().values_list('text', flat=True)
         for entry_text in entries:
@@ -179,24 +311,281 @@ class LoggingTestCase(TestCase):
         self.assertIn('Line #1, on instance', entries[0])
         self.assertIn('Line #3, on server 2', entries[1])
         self.assertIn(
-            'Deleted 1 log entries for deleted OpenStack VM instance with ID {}'.format(server1_id),
+            'Deleted 1 log entries for 1 deleted OpenStack VM instance(s)',
             entries[2]
         )
 
+    def test_log_delete_bulk(self):
+        """
+        Check that the log entries of objects deleted in the same transaction are deleted together
+        """
+        servers = [OpenStackServerFactory(openstack_id='vm{}_id'.format(i)) for i in range(5)]
+        for server in servers:
+            server.logger.info('Line on %s', server.openstack_id)
+        self.instance.logger.info('Line on instance')
+        self.assertEqual(LogEntry.objects.count(), 6)
+
+        OpenStackServer.objects.filter(pk__in=[server.pk for server in servers]).delete()
+        with self.assertNumQueries(2):
+            # One query to delete the log entries of all the servers, one to log it
+            run_on_commit_callbacks()
+        entries = LogEntry.objects.order_by('pk').values_list('text', flat=True)
+        self.assertEqual(len(entries), 2)
+        self.assertIn('Line on instance', entries[0])
+        self.assertIn('Deleted 5 log entries for 5 deleted OpenStack VM instance(s)', entries[1])
+
+    def test_log_delete_rollback(self):
+        """
+        Check that log entries are kept if the deletion of their object is rolled back
+        """
+        self.server.logger.info('Line on server')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.server.delete()
+            raise RuntimeError('Abort the deletion')
+        run_on_commit_callbacks()
+        self.assertEqual(LogEntry.objects.filter(text__contains='Line on server').count(), 1)
+
     def test_log_num_queries(self):
         """
         Check that logging to the LogEntry table doesn't do more queries than necessary.
 
-        The expected queries upon inserting a log entry are:
-        1. SELECT (1) AS "a" FROM "django_content_type" WHERE "django_content_type"."id" = {content_type_id} LIMIT 1
-        2. SELECT (1) AS "a" FROM "instance_openstackserver" WHERE "instance_openstackserver"."id" = {object_id} LIMIT 1
-        3. INSERT INTO "instance_logentry" (...)
+        The expected queries upon writing the first batch of log entries attached to an object (of a
+        single entry in tests) are:
+        1. SELECT "instance_openstackserver"."id" FROM "instance_openstackserver"
+           WHERE "instance_openstackserver"."id" IN ({object_ids})
+        2. INSERT INTO "instance_logentry" (...)
 
-        The first two are used to validate the foreign keys. 1. is added by django, and 2. is
-        added by us since the object_id foreign key constraint is not enforced by the database.
+        The first one is used to validate the object_id foreign keys, since this constraint is not
+        enforced by the database. It is skipped for the next batches, since the object is then known
+        to exist. The content types are memoized.
         """
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             self.server.logger.info('some log message')
+        with self.assertNumQueries(1):
+            self.server.logger.info('another log message')
+
+    def test_log_deleted_object(self):
+        """
+        Check that objects are checked again once deleted, so no log entry is attached to them
+        """
+        server = OpenStackServerFactory()
+        server.logger.info('Line #1')
+        server_pk = server.pk
+        server.delete()
+        server.pk = server_pk
+        with self.assertNumQueries(1):
+            server.logger.info('Line #2, on a deleted server')
+        self.assertFalse(LogEntry.objects.filter(text__contains='Line #2').exists())
+
+    @patch('instance.logging.EXISTING_OBJECTS_CACHE_TIMEOUT', -1)
+    def test_log_existing_object_expired(self):
+        """
+        Check that objects are checked again once expired, since other processes may have deleted them
+        """
+        with self.assertNumQueries(2):
+            self.server.logger.info('some log message')
+        with self.assertNumQueries(2):
+            self.server.logger.info('another log message')
+
+    @patch('instance.logging.EXISTING_OBJECTS_CACHE_SIZE', 1)
+    def test_log_existing_object_evicted(self):
+        """
+        Check that only the most recently used objects are remembered to exist
+        """
+        with self.assertNumQueries(2):
+            self.server.logger.info('Line #1, on the server')
+        with self.assertNumQueries(2):
+            self.app_server.logger.info('Line #2, on the appserver')
+        with self.assertNumQueries(1):
+            self.app_server.logger.info('Line #3, on the appserver')
+        with self.assertNumQueries(2):
+            self.server.logger.info('Line #4, on the server')
+
+    def test_log_batch(self):
+        """
+        Check that log entries are buffered, then validated and written in a single batch.
+        """
+        handler = DBHandler(capacity=3, flush_interval=3600)
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        test_logger = logging.getLogger('instance.tests.batch')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+        deleted_server = OpenStackServerFactory()
+        deleted_server_pk = deleted_server.pk
+        deleted_server.delete()
+        deleted_server.pk = deleted_server_pk
+        initial_count = LogEntry.objects.count()
+
+        test_logger.info('Line #1', extra={'obj': self.server})
+        test_logger.info('Line #2, on a deleted server', extra={'obj': deleted_server})
+        self.assertEqual(LogEntry.objects.count(), initial_count)
+
+        with self.assertNumQueries(4):
+            # One query to check the servers, one for the appserver, one to insert the entries,
+            # and one to insert the report of the entry attached to the deleted server
+            test_logger.info('Line #3', extra={'obj': self.app_server})
+        texts = list(LogEntry.objects.order_by('pk').values_list('text', flat=True)[initial_count:])
+        self.assertEqual(texts[:2], ['Line #1', 'Line #3'])
+        self.assertIn("Dropped 1 log entries, because the objects they are attached to don't exist (INFO: 1)", texts[2])
+        self.assertEqual(handler.get_stats().orphaned, {'INFO': 1})
+
+        test_logger.info('Line #4')
+        test_logger.warning('Line #5, written right away')
+        self.assertEqual(LogEntry.objects.count(), initial_count + 5)
+
+        test_logger.info('Line #6, written on close')
+        handler.close()
+        self.assertEqual(LogEntry.objects.count(), initial_count + 6)
+
+    def test_log_async(self):
+        """
+        Check that log entries are written in batches by a background thread, in asynchronous mode.
+        """
+        handler = DBHandler(capacity=2, flush_interval=3600, asynchronous=True)
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        batches = []
+        # The writer thread uses its own database connection, which can't see the test transaction
+        def write_batch(entries): # pylint: disable=missing-docstring
+            batches.append([log_entry.text for log_entry, _ in entries])
+            return {id(log_entry) for log_entry, _ in entries}
+        handler._write_batch = write_batch
+        test_logger = logging.getLogger('instance.tests.async')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+
+        for i in range(3):
+            test_logger.info('Line #%d', i + 1, extra={'obj': self.server})
+        handler.flush()
+        self.assertEqual(batches, [['Line #1', 'Line #2'], ['Line #3']])
+        self.assertTrue(handler.writer.is_alive())
+        self.assertEqual(handler.get_stats().queue_depth, 0)
+
+    @patch('instance.logging.publish_data')
+    def test_log_async_retry(self, mock_publish_data):
+        """
+        Check that the writer thread retries the entries attached to objects it can't see yet.
+        """
+        handler = DBHandler(flush_interval=3600, asynchronous=True)
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        attempts = []
+        def write(log_entries): # pylint: disable=missing-docstring
+            attempts.append([log_entry.text for log_entry in log_entries])
+            # The server isn't visible to the writer thread at first, as if its transaction wasn't committed yet
+            return log_entries if len(attempts) > 1 else [entry for entry in log_entries if not entry.object_id]
+        handler._write = write
+        test_logger = logging.getLogger('instance.tests.retry')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+
+        test_logger.info('Line #1', extra={'obj': self.server})
+        test_logger.info('Line #2')
+        handler.flush()
+        self.assertEqual(attempts, [['Line #1', 'Line #2']])
+        handler.flush()
+        self.assertEqual(attempts, [['Line #1', 'Line #2'], ['Line #1']])
+        self.assertEqual(handler.get_stats().written, 2)
+        self.assertEqual(mock_publish_data.call_count, 1)
+
+    def test_log_missing_object(self):
+        """
+        Check that entries attached to objects which don't exist are dropped, and reported.
+        """
+        handler = DBHandler()
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        test_logger = logging.getLogger('instance.tests.missing')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+        missing_server = OpenStackServer.objects.get(pk=self.server.pk)
+        missing_server.pk = 987654321
+
+        initial_count = LogEntry.objects.count()
+        test_logger.warning('Line #1', extra={'obj': missing_server})
+        self.assertEqual(handler.get_stats().orphaned, {'WARNING': 1})
+        self.assertEqual(LogEntry.objects.count(), initial_count + 1)
+        report = LogEntry.objects.order_by('-pk')[0]
+        self.assertEqual(report.level, 'WARNING')
+        self.assertIsNone(report.object_id)
+        self.assertIn(
+            "Dropped 1 log entries, because the objects they are attached to don't exist (WARNING: 1)",
+            report.text,
+        )
+
+        test_logger.warning('Line #2')
+        self.assertEqual(LogEntry.objects.count(), initial_count + 2)
+
+    def test_log_async_backpressure(self):
+        """
+        Check that DEBUG entries are dropped first when the writer thread can't keep up.
+        """
+        handler = DBHandler(asynchronous=True, queue_size=4)
+        # Simulate a stuck writer thread, until the end of the test
+        handler.queue = queue.Queue(maxsize=4)
+        handler.writer = Mock()
+        handler.writer_pid = os.getpid()
+        self.addCleanup(setattr, handler, 'writer', None)
+        test_logger = logging.getLogger('instance.tests.backpressure')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+
+        test_logger.info('Line #1')
+        test_logger.debug('Line #2')
+        test_logger.info('Line #3')
+        test_logger.debug('Line #4, dropped since the queue is half full')
+        test_logger.info('Line #5')
+        test_logger.info('Line #6, dropped since the queue is full')
+        self.assertEqual(handler.get_stats(), LogShippingStats(
+            queue_depth=4, max_queue_depth=4, written=0, dropped={'DEBUG': 1, 'INFO': 1}, orphaned={},
+        ))
+
+        reports = handler._get_drops_report()
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0][0].level, 'WARNING')
+        self.assertIn('Dropped 2 log entries', reports[0][0].text)
+        self.assertIn('(DEBUG: 1, INFO: 1)', reports[0][0].text)
+        self.assertEqual(handler._get_drops_report(), [])
+
+    def test_log_async_flush_timeout(self):
+        """
+        Check that flushing doesn't wait forever when the writer thread is stuck.
+        """
+        handler = DBHandler(asynchronous=True, queue_size=1, queue_timeout=0.01)
+        handler.queue = queue.Queue(maxsize=1)
+        handler.writer = Mock()
+        handler.writer_pid = os.getpid()
+        self.addCleanup(setattr, handler, 'writer', None)
+        with self.assertLogs('instance.logging', 'WARNING') as logs:
+            handler.flush()
+            # The first flush is still queued
+            handler.flush()
+        self.assertEqual(logs.output, [
+            'WARNING:instance.logging:Timed out waiting for the log entries to be written',
+            'WARNING:instance.logging:Could not flush the log entries, since the queue is full',
+        ])
+
+    def test_log_stats(self):
+        """
+        Check that the statistics of the handler are logged periodically, after a batch is written.
+        """
+        handler = DBHandler(stats_interval=3600)
+        handler.setFormatter(logging.Formatter('{message}', style='{'))
+        test_logger = logging.getLogger('instance.tests.stats')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        self.addCleanup(test_logger.removeHandler, handler)
+
+        with self.assertLogs('instance.logging', 'INFO') as logs:
+            test_logger.warning('Line #1')
+            handler.stats_logged -= 3600
+            test_logger.warning('Line #2')
+            test_logger.warning('Line #3')
+        self.assertEqual(logs.output, [
+            'INFO:instance.logging:Log entries written: 2, queued: 0 (at most 0), dropped: 0, orphaned: 0',
+        ])
 
     def test_log_delete_num_queries(self):
         """
@@ -206,6 +595,7 @@ class LoggingTestCase(TestCase):
         with self.assertNumQueries(3):
             # We expect one query to check for a related appserver, one to delete the server, one to delete the LogEntry
             server.delete()
+            run_on_commit_callbacks()
         log_entry = LogEntry.objects.create(text='blah')
         with self.assertNumQueries(1):
             log_entry.delete()
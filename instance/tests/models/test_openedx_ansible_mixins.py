@@ -22,10 +22,13 @@ OpenEdXAppServer Ansible Mixin - Tests
 
 # Imports #####################################################################
 
+from datetime import datetime, timezone
+import io
 import os
 from unittest.mock import patch, call, Mock
 
 from instance.models.mixins.ansible import Playbook
+from instance.models.openedx_appserver import OpenEdXAppServer
 from instance.tests.base import TestCase
 from instance.tests.models.factories.openedx_appserver import make_test_appserver
 from instance.tests.utils import patch_services
@@ -83,25 +86,225 @@ class AnsibleAppServerTestCase(TestCase):
             username='ubuntu',
         ), mock_run_playbook.mock_calls)
 
+    @patch('instance.models.mixins.ansible.AnsibleAppServerMixin._run_playbook', return_value=0)
+    @patch('instance.models.mixins.ansible.open_repository')
+    def test_provisioning_shared_repository(self, mock_open_repo, mock_run_playbook):
+        """
+        Playbooks from the same repository and version share a single checkout
+        """
+        appserver = make_test_appserver()
+        playbooks = [
+            Playbook(source_repo='repo', playbook_path='first.yml', requirements_path='', version='v1', variables=''),
+            Playbook(source_repo='repo', playbook_path='second.yml', requirements_path='', version='v1', variables=''),
+            Playbook(source_repo='repo', playbook_path='third.yml', requirements_path='', version='v2', variables=''),
+        ]
+        with patch('instance.models.openedx_appserver.OpenEdXAppServer.get_playbooks', return_value=playbooks):
+            dummy, returncode = appserver.run_ansible_playbooks()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(mock_open_repo.mock_calls.count(call('repo', ref='v1')), 1)
+        self.assertEqual(mock_open_repo.mock_calls.count(call('repo', ref='v2')), 1)
+        self.assertEqual(mock_run_playbook.call_count, 3)
+
+    @patch('instance.models.mixins.ansible.AnsibleAppServerMixin._run_playbook', side_effect=RuntimeError)
+    @patch('instance.models.mixins.ansible.open_repository')
+    def test_provisioning_exception(self, mock_open_repo, mock_run_playbook):
+        """
+        The log of the playbooks is closed when they can't run
+        """
+        appserver = make_test_appserver()
+        log = io.BytesIO()
+        with patch('instance.models.mixins.ansible.AnsibleAppServerMixin._make_log_file', return_value=log):
+            with self.assertRaises(RuntimeError):
+                appserver.run_ansible_playbooks()
+        self.assertTrue(log.closed)
+
+        appservers = [make_test_appserver(), make_test_appserver()]
+        logs = [io.BytesIO(), io.BytesIO()]
+        with patch('instance.models.mixins.ansible.AnsibleAppServerMixin._make_log_file', side_effect=logs):
+            with patch('instance.models.mixins.ansible.AnsibleAppServerMixin._run_playbook_batch',
+                       side_effect=RuntimeError), self.assertRaises(RuntimeError):
+                OpenEdXAppServer.run_ansible_playbooks_batch(appservers)
+        self.assertTrue(all(log.closed for log in logs))
+
+    @patch('instance.models.mixins.ansible.AnsibleAppServerMixin._run_playbook_batch')
+    @patch('instance.models.mixins.ansible.open_repository')
+    def test_provisioning_batch(self, mock_open_repo, mock_run_playbook_batch):
+        """
+        AppServers running the same playbooks are provisioned together
+        """
+        appservers = [make_test_appserver() for dummy in range(3)]
+        playbooks = {
+            appserver.pk: [
+                Playbook(source_repo='repo', playbook_path='first.yml', requirements_path='', version=version,
+                         variables='name: appserver-{}'.format(appserver.pk)),
+                Playbook(source_repo='repo', playbook_path='second.yml', requirements_path='', version=version,
+                         variables=''),
+            ]
+            for appserver, version in zip(appservers, ['v1', 'v1', 'v2'])
+        }
+
+        def run_playbook_batch(working_dir, appserver_playbooks, log_files):
+            """ The playbook fails on the first AppServer """
+            for appserver, playbook in appserver_playbooks:
+                log_files[appserver.pk].write('{} {}\n'.format(playbook.playbook_path, appserver.pk).encode())
+            return {appserver.pk: int(appserver == appservers[0]) for appserver, playbook in appserver_playbooks}
+        mock_run_playbook_batch.side_effect = run_playbook_batch
+
+        with patch('instance.models.openedx_appserver.OpenEdXAppServer.get_playbooks', autospec=True,
+                   side_effect=lambda appserver: playbooks[appserver.pk]):
+            results = OpenEdXAppServer.run_ansible_playbooks_batch(appservers)
+
+        log_files = {}
+        for appserver in appservers:
+            log_file, returncode = results[appserver.pk]
+            log_files[appserver.pk] = log_file
+            log_file.seek(0)
+            results[appserver.pk] = (log_file.read().decode(), returncode)
+        self.assertEqual(results, {
+            appservers[0].pk: ('first.yml {}\n'.format(appservers[0].pk), 1),
+            appservers[1].pk: ('first.yml {0}\nsecond.yml {0}\n'.format(appservers[1].pk), 0),
+            appservers[2].pk: ('first.yml {0}\nsecond.yml {0}\n'.format(appservers[2].pk), 0),
+        })
+        # One run per playbook & version, without the AppServers which already failed:
+        working_dir = mock_open_repo.return_value.__enter__.return_value.working_dir
+        self.assertEqual(mock_run_playbook_batch.mock_calls, [
+            call(working_dir, [(appservers[0], playbooks[appservers[0].pk][0]),
+                               (appservers[1], playbooks[appservers[1].pk][0])], log_files),
+            call(working_dir, [(appservers[2], playbooks[appservers[2].pk][0])], log_files),
+            call(working_dir, [(appservers[1], playbooks[appservers[1].pk][1])], log_files),
+            call(working_dir, [(appservers[2], playbooks[appservers[2].pk][1])], log_files),
+        ])
+        self.assertEqual(mock_open_repo.mock_calls.count(call('repo', ref='v1')), 1)
+        self.assertEqual(mock_open_repo.mock_calls.count(call('repo', ref='v2')), 1)
+
+    @staticmethod
+    def make_pipes(process, **output):
+        """
+        Set the `stdout`, `stderr` and `events` pipes of a mock ansible process, with the given output
+        """
+        for name in ('stdout', 'stderr', 'events'):
+            read_fd, write_fd = os.pipe()
+            os.write(write_fd, output.get(name, b''))
+            os.close(write_fd)
+            setattr(process, name, open(read_fd, 'rb', buffering=0))
+
     @patch('instance.models.mixins.ansible.ansible.run_playbook')
     @patch('instance.models.mixins.ansible.AnsibleAppServerMixin.inventory_str')
     def test_run_playbook_logging(self, mock_inventory_str, mock_run_playbook):
         """
         Ensure logging routines are working on _run_playbook method
         """
-        stdout_r, stdout_w = os.pipe()
-        stderr_r, stderr_w = os.pipe()
-        with open(stdout_r, 'rb', buffering=0) as stdout, open(stderr_r, 'rb', buffering=0) as stderr:
-            mock_run_playbook.return_value.__enter__.return_value.stdout = stdout
-            mock_run_playbook.return_value.__enter__.return_value.stderr = stderr
-            mock_run_playbook.return_value.__enter__.return_value.returncode = 0
-            os.write(stdout_w, b'Hello\n')
-            os.close(stdout_w)
-            os.write(stderr_w, b'Hi\n')
-            os.close(stderr_w)
-            appserver = make_test_appserver()
-            playbook = Playbook(source_repo='dummy', playbook_path='dummy', requirements_path='dummy', version='dummy',
-                                variables='dummy')
-            log, returncode = appserver._run_playbook("/tmp/test/working/dir/", playbook)
-            self.assertCountEqual(log, ['Hello', 'Hi'])
-            self.assertEqual(returncode, 0)
+        process = mock_run_playbook.return_value.__enter__.return_value
+        process.returncode = 0
+        self.make_pipes(process, stdout=b'Hello\n', stderr=b'Hi', events=(
+            b'{"task": "Install", "role": "common", "host": "10.0.0.1", "status": "changed", '
+            b'"started": 1476698400.5, "duration": 2.5, "result": {}}\n'
+            b'Invalid event\n'
+        ))
+        appserver = make_test_appserver()
+        playbook = Playbook(source_repo='dummy', playbook_path='dummy', requirements_path='dummy', version='dummy',
+                            variables='dummy')
+        log_file = io.BytesIO()
+        returncode = appserver._run_playbook("/tmp/test/working/dir/", playbook, log_file)
+        for pipe in (process.stdout, process.stderr, process.events):
+            pipe.close()
+        self.assertCountEqual(log_file.getvalue().splitlines(), [b'Hello', b'Hi'])
+        self.assertEqual(returncode, 0)
+        started = datetime(2016, 10, 17, 10, 0, 0, 500000, tzinfo=timezone.utc)
+        self.assertEqual(
+            [(event.playbook, event.role, event.task, event.status, event.duration, event.started)
+             for event in appserver.playbook_events.all()],
+            [('dummy', 'common', 'Install', 'changed', 2.5, started)],
+        )
+
+    @patch('instance.models.mixins.ansible.ansible.run_playbook')
+    def test_run_playbook_batch_events(self, mock_run_playbook):
+        """
+        The events of a batched playbook run are stored for the AppServers of their hosts
+        """
+        appservers = [make_test_appserver(), make_test_appserver()]
+        process = mock_run_playbook.return_value.__enter__.return_value
+        process.returncode = 0
+        event = (
+            '{{"task": "Install", "role": "common", "host": "{}", "status": "{}", '
+            '"started": 1476698400.5, "duration": 2.5, "result": {{}}}}\n'
+        )
+        self.make_pipes(process, events=''.join([
+            event.format('10.0.0.1', 'changed'),
+            event.format('10.0.0.2', 'ok'),
+            event.format('10.0.0.3', 'ok'),
+        ]).encode())
+        playbook = Playbook(source_repo='dummy', playbook_path='dummy', requirements_path='dummy', version='dummy',
+                            variables='dummy')
+        hosts = {appservers[0].pk: '10.0.0.1', appservers[1].pk: '10.0.0.2'}
+        with patch.object(OpenEdXAppServer, 'inventory_host', property(lambda appserver: hosts[appserver.pk])):
+            returncodes = OpenEdXAppServer._run_playbook_batch(
+                '/tmp/test/working/dir/',
+                [(appserver, playbook) for appserver in appservers],
+                {appserver.pk: io.BytesIO() for appserver in appservers},
+            )
+        for pipe in (process.stdout, process.stderr, process.events):
+            pipe.close()
+        self.assertEqual(returncodes, {appserver.pk: 0 for appserver in appservers})
+        self.assertEqual([event.status for event in appservers[0].playbook_events.all()], ['changed'])
+        self.assertEqual([event.status for event in appservers[1].playbook_events.all()], ['ok'])
+
+    @patch('instance.models.mixins.ansible.ansible.run_playbook')
+    def test_run_playbook_batch_logging(self, mock_run_playbook):
+        """
+        The output of a batched playbook run is logged for the AppServers it's about, on stdout and stderr
+        """
+        appservers = [make_test_appserver(), make_test_appserver()]
+        process = mock_run_playbook.return_value.__enter__.return_value
+        process.returncode = 0
+        self.make_pipes(
+            process,
+            stdout=b'TASK [common : Install] ***\nok: [10.0.0.1]\nchanged: [10.0.0.2]\n',
+            stderr=b'[WARNING]: Could not match supplied host pattern\nssh failure on [10.0.0.2]\n',
+        )
+        playbook = Playbook(source_repo='dummy', playbook_path='dummy', requirements_path='dummy', version='dummy',
+                            variables='dummy')
+        hosts = {appservers[0].pk: '10.0.0.1', appservers[1].pk: '10.0.0.2'}
+        log_files = {appserver.pk: io.BytesIO() for appserver in appservers}
+        with patch.object(OpenEdXAppServer, 'inventory_host', property(lambda appserver: hosts[appserver.pk])):
+            OpenEdXAppServer._run_playbook_batch(
+                '/tmp/test/working/dir/', [(appserver, playbook) for appserver in appservers], log_files,
+            )
+        for pipe in (process.stdout, process.stderr, process.events):
+            pipe.close()
+
+        self.assertCountEqual(log_files[appservers[0].pk].getvalue().splitlines(), [
+            b'TASK [common : Install] ***',
+            b'ok: [10.0.0.1]',
+            b'[WARNING]: Could not match supplied host pattern',
+        ])
+        self.assertCountEqual(log_files[appservers[1].pk].getvalue().splitlines(), [
+            b'TASK [common : Install] ***',
+            b'changed: [10.0.0.2]',
+            b'[WARNING]: Could not match supplied host pattern',
+            b'ssh failure on [10.0.0.2]',
+        ])
+        for appserver, num_errors in zip(appservers, [1, 2]):
+            errors = [entry.text for entry in appserver.log_entries if entry.level == 'ERROR']
+            self.assertEqual(len(errors), num_errors)
+            self.assertTrue(errors[0].endswith('[WARNING]: Could not match supplied host pattern'))
+
+    def test_group_next_playbooks(self):
+        """
+        AppServers are only batched together if their playbooks define the same variables
+        """
+        appservers = [make_test_appserver() for dummy in range(4)]
+        variables = ['name: a\nport: 80', 'name: b\nport: 80', 'name: c', 'name: d\nport: 8080']
+        playbooks = {
+            appserver.pk: [Playbook(source_repo='repo', playbook_path='site.yml', requirements_path='', version='v1',
+                                    variables=appserver_variables)]
+            for appserver, appserver_variables in zip(appservers, variables)
+        }
+        groups = OpenEdXAppServer._group_next_playbooks(
+            appservers, playbooks, {appserver.pk: 0 for appserver in appservers}, 0,
+        )
+        self.assertEqual(
+            [[appserver for appserver, dummy in appserver_playbooks] for appserver_playbooks in groups.values()],
+            [appservers[:2], [appservers[2]], [appservers[3]]],
+        )
@@ -22,6 +22,7 @@ OpenEdXAppServer model - Tests
 
 # Imports #####################################################################
 
+import io
 from unittest.mock import patch, Mock
 
 from ddt import ddt, data
@@ -53,7 +54,8 @@ class OpenEdXAppServerTestCase(TestCase):
         """
         Run provisioning sequence
         """
-        mocks.mock_run_ansible_playbooks.return_value = (['log'], 0)
+        log = io.BytesIO(b'log')
+        mocks.mock_run_ansible_playbooks.return_value = (log, 0)
         mocks.mock_create_server.side_effect = [Mock(id='test-run-provisioning-server'), None]
         mocks.os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
         mock_reboot = mocks.os_server_manager.get_os_server('test-run-provisioning-server').reboot
@@ -67,6 +69,7 @@ class OpenEdXAppServerTestCase(TestCase):
         self.assertEqual(appserver.server.status, Server.Status.Ready)
         self.assertEqual(mocks.mock_run_ansible_playbooks.call_count, 1)
         self.assertEqual(mock_reboot.call_count, 1)
+        self.assertTrue(log.closed)
 
     @patch_services
     def test_provision_build_failed(self, mocks):
@@ -117,6 +120,31 @@ class OpenEdXAppServerTestCase(TestCase):
         self.assertFalse(result)
         mocks.mock_provision_failed_email.assert_called_once_with("AppServer deploy failed: unhandled exception")
 
+    @patch_services
+    @patch('instance.models.mixins.ansible.AnsibleAppServerMixin.run_ansible_playbooks_batch')
+    def test_provision_batch(self, mocks, mock_run_ansible_playbooks_batch):
+        """
+        Provision several AppServers at once
+        """
+        mocks.os_server_manager.add_fixture('server1', 'openstack/api_server_2_active.json')
+        mocks.os_server_manager.add_fixture('server2', 'openstack/api_server_3_active.json')
+        appservers = [make_test_appserver(), make_test_appserver()]
+        logs = [io.BytesIO(b'log'), io.BytesIO(b'log')]
+        mock_run_ansible_playbooks_batch.return_value = {
+            appservers[0].pk: (logs[0], 0),
+            appservers[1].pk: (logs[1], 2),
+        }
+
+        self.assertEqual(OpenEdXAppServer.provision_batch(appservers), [appservers[0]])
+        mock_run_ansible_playbooks_batch.assert_called_once_with(appservers)
+        self.assertEqual(mocks.mock_run_ansible_playbooks.call_count, 0)
+        self.assertEqual(appservers[0].status, AppServerStatus.Running)
+        self.assertEqual(appservers[1].status, AppServerStatus.ConfigurationFailed)
+        mocks.mock_provision_failed_email.assert_called_once_with(
+            "AppServer deploy failed: Ansible play exited with non-zero exit code", logs[1]
+        )
+        self.assertTrue(all(log.closed for log in logs))
+
     def test_github_admin_username_list_default(self):
         """
         By default, no admin should be configured
@@ -424,6 +452,21 @@ class EmailMixinInstanceTestCase(TestCase):
         self.assertEqual(len(mail.attachments), 1)
         self.assertEqual(mail.attachments[0], ("provision.log", "\n".join(log_lines), "text/plain"))
 
+    @override_settings(ADMINS=(("admin1", "admin1@localhost"),))
+    def test_provision_failed_email_log_file(self):
+        """
+        Tests that provision_failed attaches the playbook output collected in a log file
+        """
+        appserver = make_test_appserver()
+        with appserver._make_log_file() as log_file:
+            log_file.write('log line1 ✓\nlog line2\n'.encode())
+            appserver.provision_failed_email("something went wrong", log_file)
+
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(django_mail.outbox[0].attachments, [
+            ("provision.log", "log line1 ✓\nlog line2\n", "text/plain"),
+        ])
+
     @override_settings(ADMINS=(
         ("admin1", "admin1@localhost"),
         ("admin2", "admin2@localhost"),
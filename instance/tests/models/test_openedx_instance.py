@@ -429,6 +429,26 @@ class OpenEdXInstanceTestCase(TestCase):
                         'EDXAPP_SWIFT_USERNAME', 'EDXAPP_SWIFT_KEY'):
             self.assertTrue(ansible_vars[setting])
 
+    @patch_services
+    @patch('instance.models.openedx_instance.OpenEdXAppServer.provision_batch')
+    def test_spawn_appservers_database_failure(self, mocks, mock_provision_batch):
+        """
+        An instance whose databases can't be provisioned is left out of a batch, without aborting it
+        """
+        failing_instance = OpenEdXInstanceFactory(sub_domain='failing', use_ephemeral_databases=False)
+        instance = OpenEdXInstanceFactory(sub_domain='working', use_ephemeral_databases=True)
+        mocks.mock_provision_mysql.side_effect = Exception('MySQL is down')
+        mock_provision_batch.side_effect = lambda appservers: appservers
+
+        appserver_ids = OpenEdXInstance.spawn_appservers([failing_instance, instance])
+        appserver = instance.appserver_set.get()
+        self.assertEqual(appserver_ids, [None, appserver.pk])
+        mock_provision_batch.assert_called_once_with([appserver])
+        self.assertEqual(failing_instance.appserver_set.count(), 0)
+        log_entries = list(failing_instance.log_entries)
+        self.assertIn('MySQL is down', log_entries[-2].text)
+        self.assertIn('Failed to provision new app server', log_entries[-1].text)
+
     @ddt.data(True, False)
     @patch_services
     @patch('instance.models.openedx_instance.OpenEdXAppServer.terminate_vm')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+PlaybookEvent model - Tests
+"""
+
+# Imports #####################################################################
+
+from django.utils import timezone
+
+from instance.models.playbook_event import PlaybookEvent
+from instance.tests.base import TestCase
+from instance.tests.models.factories.openedx_appserver import make_test_appserver
+
+
+# Tests #######################################################################
+
+class PlaybookEventTestCase(TestCase):
+    """
+    Test cases for the PlaybookEvent model
+    """
+    def setUp(self):
+        super().setUp()
+        appservers = [make_test_appserver(), make_test_appserver()]
+        events = [
+            (appservers[0], 'common', 'Install packages', 'changed', 30),
+            (appservers[0], 'common', 'Configure ssh', 'ok', 1),
+            (appservers[0], 'edxapp', 'Compile assets', 'changed', 600),
+            (appservers[1], 'common', 'Install packages', 'ok', 5),
+            (appservers[1], 'common', 'Configure ssh', 'ok', 2),
+            (appservers[1], 'edxapp', 'Compile assets', 'failed', 90),
+        ]
+        PlaybookEvent.objects.bulk_create(
+            PlaybookEvent(appserver=appserver, playbook='playbooks/edx_sandbox.yml', role=role, task=task,
+                          status=status, started=timezone.now(), duration=duration)
+            for appserver, role, task, status, duration in events
+        )
+
+    def test_durations(self):
+        """
+        Durations are aggregated by role or task, slowest first
+        """
+        self.assertEqual(
+            [(row['role'], row['count'], row['total'], row['longest'])
+             for row in PlaybookEvent.objects.durations('role')],
+            [('edxapp', 2, 690, 600), ('common', 4, 38, 30)],
+        )
+        self.assertEqual(
+            [(row['task'], row['average']) for row in PlaybookEvent.objects.durations('role', 'task')],
+            [('Compile assets', 345), ('Install packages', 17.5), ('Configure ssh', 1.5)],
+        )
+        self.assertEqual(
+            [(row['task'], row['total']) for row in PlaybookEvent.objects.filter(status='ok').durations('task')],
+            [('Install packages', 5), ('Configure ssh', 3)],
+        )
+
+    def test_duration_histogram(self):
+        """
+        Events are counted by duration bucket
+        """
+        self.assertEqual(PlaybookEvent.objects.duration_histogram([2, 60]), [(0, 2, 1), (2, 60, 3), (60, None, 2)])
+        self.assertEqual(
+            PlaybookEvent.objects.filter(task='Compile assets').duration_histogram([60, 120]),
+            [(0, 60, 0), (60, 120, 1), (120, None, 1)],
+        )
+        self.assertEqual(PlaybookEvent.objects.none().duration_histogram([60]), [(0, 60, 0), (60, None, 0)])
+
+    def test_status(self):
+        """
+        The changed & failed flags are derived from the status
+        """
+        failed_event = PlaybookEvent.objects.get(status='failed')
+        self.assertTrue(failed_event.failed)
+        self.assertFalse(failed_event.changed)
+        self.assertEqual(str(failed_event), 'edxapp: Compile assets (failed, 90.0s)')
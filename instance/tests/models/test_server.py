@@ -28,8 +28,10 @@ from unittest.mock import Mock, call, patch
 
 from ddt import ddt, data, unpack
 from django.conf import settings
+from django.test import override_settings
 import novaclient
 
+from instance import openstack
 from instance.models.server import OpenStackServer, Status as ServerStatus
 from instance.models.utils import SteadyStateException, WrongStateException
 from instance.tests.base import AnyStringMatching, TestCase
@@ -60,6 +62,17 @@ class OpenStackServerTestCase(TestCase):
     """
     Test cases for OpenStackServer models
     """
+    @staticmethod
+    def mock_clock(mock_wait, elapsed):
+        """
+        Return a fake monotonic clock, which each `mock_wait(delay)` call advances by `elapsed(delay)` seconds
+        """
+        now = [0]
+        def wait(delay): #pylint: disable=missing-docstring
+            now[0] += elapsed(delay)
+        mock_wait.side_effect = wait
+        return lambda: now[0]
+
     def test_new_server(self):
         """
         New OpenStackServer object
@@ -137,7 +150,9 @@ class OpenStackServerTestCase(TestCase):
         mock_authenticate.side_effect = authenticate
 
         # We do not use the OpenStackServerFactory here as it mocks the retry
-        # behaviour that we are trying to test
+        # behaviour that we are trying to test. Make sure a new nova client is used, too.
+        openstack.reset_nova_client_pool()
+        self.addCleanup(openstack.reset_nova_client_pool)
         server = OpenStackServer.objects.create(name_prefix="test-nova-error")
         self.assertTrue(server.os_server)
 
@@ -146,9 +161,9 @@ class OpenStackServerTestCase(TestCase):
         'accepts_ssh_commands',
         'vm_available',
     )
-    @patch('instance.models.server.OpenStackServer.update_status')
-    @patch('instance.models.server.time.sleep')
-    def test_sleep_until_condition_already_fulfilled(self, condition, mock_sleep, mock_update_status):
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
+    def test_sleep_until_condition_already_fulfilled(self, condition, mock_listener, mock_poll_status):
         """
         Check if sleep_until behaves correctly if condition to wait for
         is already fulfilled.
@@ -168,7 +183,8 @@ class OpenStackServerTestCase(TestCase):
         # if server can not reach desired status because transition logic is broken:
         server.sleep_until(lambda: getattr(server.status, condition), timeout=5)
         self.assertEqual(server.status, ServerStatus.Ready)
-        self.assertEqual(mock_sleep.call_count, 0)
+        self.assertEqual(mock_poll_status.call_count, 1)
+        self.assertEqual(mock_listener.return_value.__enter__.return_value.wait.call_count, 0)
 
     @data(
         {
@@ -187,9 +203,9 @@ class OpenStackServerTestCase(TestCase):
             'expected_status': ServerStatus.Booting,
         },
     )
-    @patch('instance.models.server.OpenStackServer.update_status')
-    @patch('instance.models.server.time.sleep')
-    def test_sleep_until_state_changes(self, condition, mock_sleep, mock_update_status):
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
+    def test_sleep_until_state_changes(self, condition, mock_listener, mock_poll_status):
         """
         Check if sleep_until behaves correctly if condition to wait for
         is unfulfilled initially.
@@ -202,22 +218,66 @@ class OpenStackServerTestCase(TestCase):
         ]
         status_queue.reverse() # To be able to use pop()
 
-        def update_status():
+        def poll_status():
             """ Simulate status progression """
             status_queue.pop()()
 
-        mock_update_status.side_effect = update_status
+        mock_poll_status.side_effect = poll_status
 
         # Sleep until condition is fulfilled.
         # Use a small value for "timeout" to ensure that we can fail quickly
         # if server can not reach desired status because transition logic is broken:
         server.sleep_until(lambda: getattr(server.status, condition['name']), timeout=5)
         self.assertEqual(server.status, condition['expected_status'])
-        self.assertEqual(mock_sleep.call_count, condition['required_transitions'] - 1)
+        mock_wait = mock_listener.return_value.__enter__.return_value.wait
+        self.assertEqual(mock_wait.call_count, condition['required_transitions'] - 1)
+
+    @override_settings(SERVER_STATUS_WAIT_MIN_DELAY=1, SERVER_STATUS_WAIT_MAX_DELAY=8)
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
+    @patch('instance.utils.random.uniform', return_value=1)
+    def test_sleep_until_backoff(self, _mock_uniform, mock_listener, mock_poll_status):
+        """
+        Check that sleep_until waits for exponentially increasing delays, only listening for
+        notifications about the server it is waiting for.
+        """
+        server = OpenStackServerFactory()
+        mock_poll_status.side_effect = lambda: server.status
+        mock_wait = mock_listener.return_value.__enter__.return_value.wait
+        clock = self.mock_clock(mock_wait, lambda delay: delay)
+        with self.assertRaises(TimeoutError), patch('instance.models.server.time', Mock(monotonic=clock)):
+            server.sleep_until(lambda: server.status.accepts_ssh_commands, timeout=20)
 
-    @patch('instance.models.server.OpenStackServer.update_status')
+        mock_listener.assert_called_once_with('notification', server._is_update_notification)
+        self.assertEqual(mock_wait.mock_calls, [call(1), call(2), call(4), call(8), call(5)])
+        self.assertEqual(mock_poll_status.call_count, 6)
+
+        self.assertTrue(server._is_update_notification({'type': 'server_update', 'server_pk': server.pk}))
+        self.assertFalse(server._is_update_notification({'type': 'server_update', 'server_pk': server.pk + 1}))
+        self.assertFalse(server._is_update_notification({'type': 'instance_update', 'instance_id': server.pk}))
+
+    @override_settings(SERVER_STATUS_WAIT_MIN_DELAY=1, SERVER_STATUS_WAIT_MAX_DELAY=8)
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
+    @patch('instance.utils.random.uniform', return_value=1)
+    def test_sleep_until_woken_up(self, _mock_uniform, mock_listener, mock_poll_status):
+        """
+        Check that waking up early, e.g. on a notification about another status, doesn't shorten the timeout.
+        """
+        server = OpenStackServerFactory()
+        mock_poll_status.side_effect = lambda: server.status
+        mock_wait = mock_listener.return_value.__enter__.return_value.wait
+        clock = self.mock_clock(mock_wait, lambda delay: 0.5)
+        with self.assertRaises(TimeoutError), patch('instance.models.server.time', Mock(monotonic=clock)):
+            server.sleep_until(lambda: server.status.accepts_ssh_commands, timeout=2)
+
+        self.assertEqual(mock_wait.mock_calls, [call(1), call(1.5), call(1), call(0.5)])
+        self.assertEqual(clock(), 2)
+
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
     @patch('instance.models.server.Status.Building.is_steady_state')
-    def test_sleep_until_steady_state(self, mock_building_is_steady_state, mock_update_status):
+    def test_sleep_until_steady_state(self, mock_building_is_steady_state, mock_listener, mock_poll_status):
         """
         Check if sleep_until behaves correctly if condition to wait for
         can not be fulfilled because server is in a steady state
@@ -225,10 +285,10 @@ class OpenStackServerTestCase(TestCase):
         """
         server = OpenStackServerFactory()
 
-        def update_status():
+        def poll_status():
             """ Simulate status progression """
             server._status_to_building()
-        mock_update_status.side_effect = update_status
+        mock_poll_status.side_effect = poll_status
 
         # Pretend that Status.Building (which doesn't accept SSH commands) is a steady state
         mock_building_is_steady_state.return_value = True
@@ -239,23 +299,21 @@ class OpenStackServerTestCase(TestCase):
             # if server can not reach desired status because transition logic is broken:
             server.sleep_until(lambda: server.status.accepts_ssh_commands, timeout=5)
 
-    @patch('instance.models.server.OpenStackServer.update_status')
-    @patch('instance.models.server.time.sleep')
-    def test_sleep_until_timeout(self, mock_sleep, mock_update_status):
+    @patch('instance.models.server.OpenStackServer.poll_status')
+    @patch('instance.models.server.NotificationListener')
+    def test_sleep_until_timeout(self, mock_listener, mock_poll_status):
         """
         Check if sleep_until behaves correctly if condition to wait for
         is unfulfilled when timeout is reached.
         """
         server = OpenStackServerFactory()
+        server._status_to_building()
+        mock_poll_status.side_effect = lambda: server.status
+        clock = self.mock_clock(mock_listener.return_value.__enter__.return_value.wait, lambda delay: delay)
 
-        def update_status():
-            """ Simulate status progression """
-            server._status_to_building()
-        mock_update_status.side_effect = update_status
-
-        with self.assertRaises(TimeoutError):
+        with self.assertRaises(TimeoutError), patch('instance.models.server.time', Mock(monotonic=clock)):
             server.sleep_until(lambda: server.status.accepts_ssh_commands, timeout=1)
-            self.assertEqual(mock_sleep.call_count, 1)
+        self.assertTrue(mock_listener.return_value.__enter__.return_value.wait.called)
 
     def test_sleep_until_invalid_timeout(self):
         """
@@ -267,8 +325,7 @@ class OpenStackServerTestCase(TestCase):
             with self.assertRaises(AssertionError):
                 server.sleep_until(lambda: server.status.accepts_ssh_commands, timeout=value)
 
-    @patch('instance.models.server.time.sleep')
-    def test_reboot_booting_server(self, mock_sleep):
+    def test_reboot_booting_server(self):
         """
         Reboot a server that has status 'booting'
         """
@@ -276,18 +333,27 @@ class OpenStackServerTestCase(TestCase):
         server.reboot()
         self.assertEqual(server.status, ServerStatus.Booting)
         server.os_server.reboot.assert_not_called()
-        mock_sleep.assert_not_called()
 
-    @patch('instance.models.server.time.sleep')
-    def test_reboot_ready_server(self, mock_sleep):
+    def test_reboot_ready_server(self):
         """
         Reboot a server that has status 'ready'
         """
         server = ReadyOpenStackServerFactory()
+        # The server is only marked as booting once nova accepted the reboot
+        server.os_server.reboot.side_effect = lambda reboot_type: self.assertEqual(server.status, ServerStatus.Ready)
         server.reboot()
         self.assertEqual(server.status, ServerStatus.Booting)
         server.os_server.reboot.assert_called_once_with(reboot_type='SOFT')
-        mock_sleep.assert_called_once_with(30)
+
+    def test_reboot_ready_server_nova_error(self):
+        """
+        Reboot a server that has status 'ready', when nova fails to reboot it
+        """
+        server = ReadyOpenStackServerFactory()
+        server.os_server.reboot.side_effect = novaclient.exceptions.Conflict(409)
+        with self.assertRaises(novaclient.exceptions.Conflict):
+            server.reboot()
+        self.assertEqual(server.status, ServerStatus.Ready)
 
     @data(
         ServerStatus.Pending,
@@ -384,6 +450,51 @@ class OpenStackServerTestCase(TestCase):
         server.os_server.delete.assert_called_once_with()
         mock_logger.error.assert_called_once_with(AnyStringMatching('Error while attempting to terminate server'))
 
+    @patch('instance.models.server.publish_data')
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_terminate_queryset(self, mock_get_nova_client, mock_publish_data):
+        """
+        Terminate servers in bulk, deleting their VMs concurrently
+        """
+        pending_server = OpenStackServerFactory()
+        ready_server = ReadyOpenStackServerFactory(_public_ip='192.168.100.200')
+        vanished_server = ReadyOpenStackServerFactory()
+        failing_server = BootingOpenStackServerFactory()
+        terminated_server = OpenStackServerFactory(status=ServerStatus.Terminated)
+
+        def delete(openstack_id): #pylint: disable=missing-docstring
+            if openstack_id == vanished_server.openstack_id:
+                raise novaclient.exceptions.NotFound(404)
+            elif openstack_id == failing_server.openstack_id:
+                raise novaclient.exceptions.ClientException(500)
+        mock_delete = mock_get_nova_client.return_value.servers.delete
+        mock_delete.side_effect = delete
+        mock_publish_data.reset_mock()
+
+        OpenStackServer.objects.terminate(batch_size=2)
+        self.assertCountEqual(mock_delete.mock_calls, [
+            call(ready_server.openstack_id),
+            call(vanished_server.openstack_id),
+            call(failing_server.openstack_id),
+        ])
+
+        def reload(server):
+            """ Reload the given server from the database """
+            return OpenStackServer.objects.get(pk=server.pk)
+
+        for server in (pending_server, ready_server, vanished_server, terminated_server):
+            self.assertEqual(reload(server).status, ServerStatus.Terminated)
+        self.assertIsNone(reload(ready_server)._public_ip)
+        # The VM couldn't be deleted, so the server can be terminated again later
+        self.assertEqual(reload(failing_server).status, ServerStatus.Booting)
+
+        self.assertEqual(mock_publish_data.call_count, 1)
+        notification = mock_publish_data.call_args[0][1]
+        self.assertEqual(notification['type'], 'servers_update')
+        self.assertCountEqual(notification['server_pks'], [pending_server.pk, ready_server.pk, vanished_server.pk])
+        self.assertTrue(reload(ready_server)._is_update_notification(notification))
+        self.assertFalse(reload(failing_server)._is_update_notification(notification))
+
     def test_public_ip_new_server(self):
         """
         A new server doesn't have a public IP
@@ -405,6 +516,26 @@ class OpenStackServerTestCase(TestCase):
         server = BuildingOpenStackServerFactory(os_server_fixture='openstack/api_server_2_active.json')
         self.assertEqual(server.public_ip, '192.168.100.200')
 
+    def test_public_ip_stored(self):
+        """
+        The public IP of an available server is stored, and then read without querying nova
+        """
+        server = BootingOpenStackServerFactory(os_server_fixture='openstack/api_server_2_active.json')
+        self.assertEqual(server.public_ip, '192.168.100.200')
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk)._public_ip, '192.168.100.200')
+
+        server.nova.reset_mock()
+        self.assertEqual(server.public_ip, '192.168.100.200')
+        self.assertFalse(server.nova.mock_calls)
+
+    def test_public_ip_cleared_on_terminate(self):
+        """
+        The stored public IP is cleared when the server is terminated
+        """
+        server = ReadyOpenStackServerFactory(openstack_id='ready-server-id', _public_ip='192.168.100.200')
+        server.terminate()
+        self.assertIsNone(OpenStackServer.objects.get(pk=server.pk)._public_ip)
+
 
 @ddt
 class OpenStackServerStatusTestCase(TestCase):
@@ -551,6 +682,16 @@ class OpenStackServerStatusTestCase(TestCase):
         self.assertIsInstance(server.update_status(), ServerStatus.Building)
         self.assertEqual(server.status, ServerStatus.Building)
 
+    def test_update_status_checked_at(self):
+        """
+        The time of the last status check is recorded, even when the status doesn't change
+        """
+        server = BuildingOpenStackServerFactory(os_server_fixture='openstack/api_server_1_building.json')
+        self.assertIsNone(server.status_checked_at)
+        server.update_status()
+        self.assertIsNotNone(server.status_checked_at)
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk).status_checked_at, server.status_checked_at)
+
     def test_update_status_build_failed(self):
         """
         Update status while not being able to interact with the server
@@ -571,6 +712,7 @@ class OpenStackServerStatusTestCase(TestCase):
         self.assertEqual(server.status, ServerStatus.Building)
         self.assertIsInstance(server.update_status(), ServerStatus.Booting)
         self.assertEqual(server.status, ServerStatus.Booting)
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk)._public_ip, '192.168.100.200')
 
     @patch('instance.models.server.is_port_open')
     def test_update_status_booting_to_ready(self, mock_is_port_open):
@@ -587,8 +729,7 @@ class OpenStackServerStatusTestCase(TestCase):
         self.assertEqual(server.status, ServerStatus.Ready)
 
     @patch('instance.models.server.is_port_open')
-    @patch('instance.models.server.time.sleep')
-    def test_update_status_ready_to_booting(self, _mock_sleep, mock_is_port_open):
+    def test_update_status_ready_to_booting(self, mock_is_port_open):
         """
         Update status when the server is rebooted
         """
@@ -605,3 +746,130 @@ class OpenStackServerStatusTestCase(TestCase):
         self.assertEqual(server.status, ServerStatus.Booting)
         self.assertIsInstance(server.update_status(), ServerStatus.Booting)
         self.assertEqual(server.status, ServerStatus.Booting)
+
+    @data('REBOOT', 'HARD_REBOOT')
+    @patch('instance.models.server.is_port_open')
+    def test_update_status_reboot_in_progress(self, nova_status, mock_is_port_open):
+        """
+        The server doesn't become ready while nova is still rebooting it, even if SSH is still up
+        """
+        mock_is_port_open.return_value = True
+        server = ReadyOpenStackServerFactory(os_server_fixture='openstack/api_server_2_active.json')
+        server.reboot()
+        server.os_server.status = nova_status
+        self.assertIsInstance(server.update_status(), ServerStatus.Booting)
+        self.assertFalse(mock_is_port_open.called)
+
+        server.os_server.status = 'ACTIVE'
+        self.assertIsInstance(server.update_status(), ServerStatus.Ready)
+
+    @patch('instance.models.server.is_port_open')
+    @patch('instance.models.server.open_ports')
+    def test_update_status_queryset(self, mock_open_ports, mock_is_port_open):
+        """
+        Update the status of all servers at once, using a single nova request and a single SSH probe
+        """
+        mock_open_ports.side_effect = set
+        building_server = BuildingOpenStackServerFactory()
+        booting_server = BootingOpenStackServerFactory()
+        vanished_server = ReadyOpenStackServerFactory()
+        failed_server = BuildFailedOpenStackServerFactory()
+        pending_server = OpenStackServerFactory()
+
+        nova = Mock()
+        nova.servers.list.return_value = [
+            Mock(id=openstack_id, _loaded=True, status='ACTIVE', addresses={'Ext-Net': [{'addr': '1.1.1.1'}]})
+            for openstack_id in (building_server.openstack_id, booting_server.openstack_id)
+        ]
+        reconciliation = OpenStackServer.objects.update_status(nova=nova)
+        self.assertEqual(reconciliation, (3, 1, 2))
+        self.assertEqual(nova.servers.list.call_count, 1)
+        self.assertEqual(mock_open_ports.call_count, 1)
+        self.assertEqual(set(mock_open_ports.call_args[0][0]), {('1.1.1.1', 22)})
+        self.assertFalse(mock_is_port_open.called)
+
+        def get_status(server):
+            """ Reload the status of the given server from the database """
+            return OpenStackServer.objects.get(pk=server.pk).status
+
+        self.assertEqual(get_status(building_server), ServerStatus.Ready)
+        self.assertEqual(get_status(booting_server), ServerStatus.Ready)
+        self.assertEqual(get_status(vanished_server), ServerStatus.Unknown)
+        self.assertEqual(get_status(failed_server), ServerStatus.BuildFailed)
+        self.assertEqual(get_status(pending_server), ServerStatus.Pending)
+
+        # The time of the check is recorded for all the reconciled servers at once
+        checked_at = set(OpenStackServer.objects.values_list('status_checked_at', flat=True))
+        self.assertEqual(len(checked_at - {None}), 1)
+        self.assertIsNone(OpenStackServer.objects.get(pk=pending_server.pk).status_checked_at)
+
+    @patch('instance.models.server.open_ports', set)
+    def test_update_status_queryset_terminated_meanwhile(self):
+        """
+        The status of servers terminated while nova is being listed isn't overwritten
+        """
+        building_server = BuildingOpenStackServerFactory()
+        terminated_server = BuildingOpenStackServerFactory()
+
+        def list_servers(**unused_kwargs):
+            """ Terminate one of the servers while the nova servers are being listed """
+            OpenStackServer.objects.filter(pk=terminated_server.pk).update(_status=ServerStatus.Terminated.state_id)
+            return [
+                Mock(id=server.openstack_id, _loaded=True, status='ACTIVE', addresses={})
+                for server in (building_server, terminated_server)
+            ]
+        nova = Mock()
+        nova.servers.list.side_effect = list_servers
+
+        reconciliation = OpenStackServer.objects.update_status(nova=nova)
+        self.assertEqual(reconciliation.servers, 1)
+        self.assertEqual(OpenStackServer.objects.get(pk=building_server.pk).status, ServerStatus.Booting)
+        terminated_server.refresh_from_db()
+        self.assertEqual(terminated_server.status, ServerStatus.Terminated)
+        self.assertIsNone(terminated_server.status_checked_at)
+
+    def test_update_status_queryset_unreachable(self):
+        """
+        Update the status of all servers at once, while the OpenStack API is unreachable
+        """
+        building_server = BuildingOpenStackServerFactory()
+        pending_server = OpenStackServerFactory()
+        nova = Mock()
+        nova.servers.list.side_effect = novaclient.exceptions.ClientException(500)
+
+        reconciliation = OpenStackServer.objects.update_status(nova=nova)
+        self.assertEqual(reconciliation, (1, 0, 0))
+        self.assertEqual(OpenStackServer.objects.get(pk=building_server.pk).status, ServerStatus.Unknown)
+        self.assertEqual(OpenStackServer.objects.get(pk=pending_server.pk).status, ServerStatus.Pending)
+
+    @override_settings(OPENSTACK_STATUS_POLL_INTERVAL=0)
+    @patch('instance.models.server.OpenStackServerQuerySet.update_status')
+    def test_poll_status(self, mock_update_status):
+        """
+        Polling the status of a server refreshes the status of all servers at once,
+        and reloads the status of the server from the database
+        """
+        server = BuildingOpenStackServerFactory()
+
+        def update_status(nova):
+            """ Simulate another process updating the status of the server """
+            OpenStackServer.objects.filter(pk=server.pk).update(_status=ServerStatus.Booting.state_id)
+        mock_update_status.side_effect = update_status
+
+        self.assertIsInstance(server.poll_status(), ServerStatus.Booting)
+        self.assertEqual(server.status, ServerStatus.Booting)
+        mock_update_status.assert_called_once_with(nova=server.nova)
+
+    @override_settings(OPENSTACK_STATUS_POLL_INTERVAL=60)
+    @patch('instance.models.server.cache')
+    @patch('instance.models.server.OpenStackServerQuerySet.update_status')
+    def test_poll_status_shared(self, mock_update_status, mock_cache):
+        """
+        Only one process refreshes the status of all servers during each polling interval
+        """
+        server = BuildingOpenStackServerFactory()
+        mock_cache.add.side_effect = [True, False]
+        server.poll_status()
+        server.poll_status()
+        self.assertEqual(mock_update_status.call_count, 1)
+        self.assertEqual(mock_cache.add.mock_calls, [call('openstack_server_status_poll', True, 60)] * 2)
@@ -22,10 +22,20 @@ Ansible - Tests
 
 # Imports #####################################################################
 
+from datetime import datetime, timezone
+from importlib.machinery import SourceFileLoader
+import json
 import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from unittest import mock
 from unittest.mock import patch
 
+from django.test import override_settings
 import yaml
 
 from instance import ansible
@@ -97,12 +107,13 @@ class AnsibleTestCase(TestCase):
     """
     Test cases for ansible helper functions & wrappers
     """
+    @override_settings(ANSIBLE_VENV_CACHE_DIR='')
     def test_run_playbook(self):
         """
         Run the ansible-playbook command
         """
 
-        popen_result = object()
+        popen_result = mock.Mock()
 
         with patch('instance.ansible.render_sandbox_creation_command', return_value="ANSIBLE CMD") as mock_render, \
                 patch('instance.ansible.create_temp_dir') as mock_create_temp, \
@@ -128,15 +139,20 @@ class AnsibleTestCase(TestCase):
                 requirements_path='/tmp/requirements.txt',
                 playbook_name='playbook_name',
                 remote_username='root',
-                venv_path='/tmp/tempdir/venv'
+                venv_path='/tmp/tempdir/venv',
+                create_venv=True,
+                forks=None,
             )
 
             mock_popen.assert_called_once_with(
-                "ANSIBLE CMD", bufsize=1, stdout=-1, stderr=-1, cwd='/play/book', shell=True, env=mock.ANY
+                "ANSIBLE CMD", bufsize=0, stdout=-1, stderr=-1, cwd='/play/book', shell=True, env=mock.ANY,
+                pass_fds=mock.ANY,
             )
             call_kwargs = mock_popen.mock_calls[0][2]
             self.assertIn('env', call_kwargs)
             self.assertEqual(call_kwargs['env']['TMPDIR'], '/tmp/tempdir')
+            self.assertEqual(call_kwargs['env']['ANSIBLE_CALLBACK_PLUGINS'], ansible.CALLBACK_PLUGINS_DIR)
+            self.assertEqual(call_kwargs['pass_fds'], (int(call_kwargs['env']['OPENCRAFT_ANSIBLE_EVENTS_FD']), ))
 
     def test_render_command(self):
         """
@@ -154,12 +170,140 @@ class AnsibleTestCase(TestCase):
         expected = (
             'virtualenv -p /usr/bin/python /tmp/venv && '
             '/tmp/venv/bin/python -u /tmp/venv/bin/pip install -r /requirements/path.txt && '
+            'touch /tmp/venv/.ready && '
             '/tmp/venv/bin/python -u /tmp/venv/bin/ansible-playbook -i /tmp/inventory/path '
             '-e @/tmp/vars/path -u root playbook_name'
         )
 
         self.assertEqual(expected, run_playbook_command)
 
+    def test_render_command_existing_venv(self):
+        """
+        Run the render_sandbox_creation_command function with a venv that is ready to use
+        """
+        run_playbook_command = ansible.render_sandbox_creation_command(
+            requirements_path='/requirements/path.txt',
+            inventory_path="/tmp/inventory/path",
+            vars_path="/tmp/vars/path",
+            playbook_name='playbook_name',
+            remote_username="root",
+            venv_path='/tmp/venv',
+            create_venv=False,
+        )
+        self.assertEqual(
+            run_playbook_command,
+            '/tmp/venv/bin/python -u /tmp/venv/bin/ansible-playbook -i /tmp/inventory/path '
+            '-e @/tmp/vars/path -u root playbook_name'
+        )
+
+    def test_render_command_batch(self):
+        """
+        Run the render_sandbox_creation_command function for a playbook run against several hosts
+        """
+        run_playbook_command = ansible.render_sandbox_creation_command(
+            requirements_path='/requirements/path.txt',
+            inventory_path="/tmp/inventory/path",
+            vars_path="/tmp/vars/path",
+            playbook_name='playbook_name',
+            remote_username="root",
+            venv_path='/tmp/venv',
+            create_venv=False,
+            forks=10,
+        )
+        self.assertEqual(
+            run_playbook_command,
+            '/tmp/venv/bin/python -u /tmp/venv/bin/ansible-playbook -i /tmp/inventory/path '
+            '-e @/tmp/vars/path --forks 10 -u root playbook_name'
+        )
+
+    @override_settings(ANSIBLE_VENV_CACHE_DIR='')
+    @patch('subprocess.Popen')
+    def test_run_playbook_host_vars(self, mock_popen):
+        """
+        Run a playbook against several hosts, with the values of the variables of each host resolved
+        from the inventory by the extra vars
+        """
+        playbook_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, playbook_dir)
+
+        def check_inventory(cmd, **kwargs):
+            """ Check the inventory and extra vars files written for the playbook run """
+            inventory_path = cmd.split(' -i ')[1].split()[0]
+            with open(inventory_path) as inventory_file:
+                self.assertEqual(inventory_file.read(), '[app]\n10.0.0.1\n10.0.0.2')
+            inventory_dir = os.path.dirname(inventory_path)
+            for host, name in (('10.0.0.1', 'one'), ('10.0.0.2', 'two')):
+                with open(os.path.join(inventory_dir, 'host_vars', host + '.yml')) as host_vars_file:
+                    self.assertEqual(yaml.safe_load(host_vars_file), {'opencraft_batch_vars': {'NAME': name}})
+            with open(cmd.split(' -e @')[1].split()[0]) as vars_file:
+                self.assertEqual(yaml.safe_load(vars_file), {
+                    'NAME': '{{ opencraft_batch_vars["NAME"] }}',
+                    'PORT': 80,
+                })
+            self.assertIn(' --forks 5 ', cmd)
+            self.assertTrue(cmd.endswith(' playbook_name'))
+            return mock.Mock()
+        mock_popen.side_effect = check_inventory
+
+        with ansible.run_playbook(
+            requirements_path="/tmp/requirements.txt",
+            inventory_str="[app]\n10.0.0.1\n10.0.0.2",
+            vars_str=None,
+            playbook_path=playbook_dir,
+            playbook_name='playbook_name',
+            host_vars={'10.0.0.1': 'NAME: one\nPORT: 80', '10.0.0.2': 'NAME: two\nPORT: 80'},
+            forks=5,
+        ):
+            self.assertEqual(mock_popen.call_count, 1)
+        # Nothing is written in the playbook directory, which is shared by the checkout:
+        self.assertEqual(os.listdir(playbook_dir), [])
+
+    def test_get_batch_key(self):
+        """
+        Only hosts with the same variables, and the same numbers and nulls, can be batched together
+        """
+        key = ansible.get_batch_key('NAME: one\nENABLED: true\nPORT: 80\nHOSTS: [a]')
+        self.assertEqual(key, ansible.get_batch_key('NAME: two\nENABLED: false\nPORT: 80\nHOSTS: [b, c]'))
+        self.assertNotEqual(key, ansible.get_batch_key('NAME: one\nENABLED: true\nPORT: 8080\nHOSTS: [a]'))
+        self.assertNotEqual(key, ansible.get_batch_key('NAME: one\nENABLED: true\nPORT: 80'))
+        self.assertEqual(ansible.get_batch_key(''), ansible.get_batch_key('{}'))
+
+    @override_settings(ANSIBLE_VENV_CACHE_DIR='')
+    @patch('instance.ansible.render_sandbox_creation_command')
+    def test_run_playbook_events(self, mock_render):
+        """
+        The events written by the callback plugin are read from the `events` pipe of the process
+        """
+        event = json.dumps({
+            'task': 'Install', 'role': 'common', 'host': '10.0.0.1', 'status': 'changed',
+            'started': 1476698400.5, 'duration': 2.5, 'result': {},
+        })
+        write_event = 'import os, sys; os.write(int(os.environ["OPENCRAFT_ANSIBLE_EVENTS_FD"]), sys.argv[1].encode())'
+        mock_render.return_value = '{} -c {} {}; echo output'.format(
+            sys.executable, shlex.quote(write_event), shlex.quote(event + '\n'),
+        )
+        with ansible.run_playbook('/tmp/requirements.txt', 'INVENTORY', 'VARS', '/tmp', 'playbook_name') as process:
+            self.assertEqual(process.stdout.read(), b'output\n')
+            line = process.events.read()
+            process.wait()
+        self.assertTrue(process.events.closed)
+        self.assertEqual(ansible.parse_playbook_event(line), {
+            'task': 'Install',
+            'role': 'common',
+            'host': '10.0.0.1',
+            'status': 'changed',
+            'started': datetime(2016, 10, 17, 10, 0, 0, 500000, tzinfo=timezone.utc),
+            'duration': 2.5,
+            'result': {},
+        })
+
+    def test_parse_invalid_playbook_event(self):
+        """
+        Invalid events are ignored
+        """
+        for line in (b'{"task": "Install"}\n', b'not json\n', b'\xff\n'):
+            self.assertIsNone(ansible.parse_playbook_event(line))
+
     def test_create_temp_dir_ok(self):
         """
         Check if create_temp_dir behaves correctly when no exception is
@@ -201,3 +345,230 @@ class AnsibleTestCase(TestCase):
                 self.assertEqual("TEST ąęłźżó", f.read())
         finally:
             os.remove(file_path)
+
+
+class AnsibleVenvCacheTestCase(TestCase):
+    """
+    Test cases for the cache of ansible venvs
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        override = override_settings(ANSIBLE_VENV_CACHE_DIR=self.cache_dir, ANSIBLE_VENV_CACHE_MAX_SIZE=1000)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.requirements_path = os.path.join(self.cache_dir, 'requirements.txt')
+        with open(self.requirements_path, 'w') as requirements_file:
+            requirements_file.write('ansible==1.9.3\n')
+
+    def make_venv(self, name, size, last_used):
+        """
+        Create a fake cached venv of the given size, last used at the given timestamp
+        """
+        venv_path = os.path.join(self.cache_dir, name)
+        os.mkdir(venv_path)
+        with open(os.path.join(venv_path, 'lib'), 'wb') as lib_file:
+            lib_file.write(b'x' * size)
+        ready_marker_path = os.path.join(venv_path, ansible.VENV_READY_MARKER)
+        open(ready_marker_path, 'w').close()
+        os.utime(ready_marker_path, (last_used, last_used))
+        return venv_path
+
+    def test_venv_cache_key(self):
+        """
+        The venv cache key changes with the requirements and the Python interpreter
+        """
+        key = ansible.get_venv_cache_key(self.requirements_path)
+        self.assertEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+        with override_settings(ANSIBLE_PYTHON_PATH='/usr/bin/python2.7'):
+            self.assertNotEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+        with open(self.requirements_path, 'a') as requirements_file:
+            requirements_file.write('boto==2.38.0\n')
+        self.assertNotEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+
+    def assert_venv_locked(self, venv_path, exclusive):
+        """
+        Check that the given cached venv is locked by another open file, in exclusive or shared mode
+        """
+        with open(venv_path + '.lock') as lock_file:
+            with self.assertRaises(BlockingIOError):
+                ansible.fcntl.flock(lock_file, ansible.fcntl.LOCK_EX | ansible.fcntl.LOCK_NB)
+            if exclusive:
+                with self.assertRaises(BlockingIOError):
+                    ansible.fcntl.flock(lock_file, ansible.fcntl.LOCK_SH | ansible.fcntl.LOCK_NB)
+            else:
+                ansible.fcntl.flock(lock_file, ansible.fcntl.LOCK_SH | ansible.fcntl.LOCK_NB)
+
+    @patch('subprocess.check_output')
+    @patch('subprocess.Popen')
+    def test_run_playbook_cached_venv(self, mock_popen, mock_check_output):
+        """
+        The venv is built under an exclusive lock before the first playbook run, and reused afterwards
+        under a shared lock
+        """
+        venv_path = os.path.join(self.cache_dir, ansible.get_venv_cache_key(self.requirements_path))
+
+        def build_venv(cmd, **kwargs):
+            """ Build a fake venv """
+            self.assertEqual(cmd, 'virtualenv -p /usr/bin/python {0} && {0}/bin/python -u {0}/bin/pip install -r {1}'
+                             .format(venv_path, self.requirements_path))
+            self.assert_venv_locked(venv_path, exclusive=True)
+            os.makedirs(venv_path)
+            return b'Successfully installed ansible-1.9.3'
+        mock_check_output.side_effect = build_venv
+
+        def run_playbook(cmd, **kwargs):
+            """ Run a fake playbook """
+            self.assert_venv_locked(venv_path, exclusive=False)
+            return mock.Mock()
+        mock_popen.side_effect = run_playbook
+
+        for dummy in range(2):
+            with ansible.run_playbook(self.requirements_path, 'INVENTORY', 'VARS', '/play/book', 'playbook_name'):
+                pass
+            command = mock_popen.call_args[0][0]
+            self.assertTrue(command.startswith('{0}/bin/python -u {0}/bin/ansible-playbook'.format(venv_path)))
+        self.assertEqual(mock_check_output.call_count, 1)
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertTrue(os.path.exists(os.path.join(venv_path, ansible.VENV_READY_MARKER)))
+
+    @patch('subprocess.check_output')
+    @patch('subprocess.Popen')
+    def test_run_playbook_venv_build_failure(self, mock_popen, mock_check_output):
+        """
+        A venv which fails to build is removed, and the playbook isn't run
+        """
+        venv_path = os.path.join(self.cache_dir, ansible.get_venv_cache_key(self.requirements_path))
+
+        def build_venv(cmd, **kwargs):
+            """ Fail to build a venv """
+            os.makedirs(venv_path)
+            raise subprocess.CalledProcessError(1, cmd, output=b'No matching distribution found for ansible')
+        mock_check_output.side_effect = build_venv
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            with ansible.run_playbook(self.requirements_path, 'INVENTORY', 'VARS', '/play/book', 'playbook_name'):
+                pass
+        self.assertFalse(os.path.exists(venv_path))
+        self.assertEqual(mock_popen.call_count, 0)
+        # The venv isn't locked anymore:
+        with open(venv_path + '.lock') as lock_file:
+            ansible.fcntl.flock(lock_file, ansible.fcntl.LOCK_EX | ansible.fcntl.LOCK_NB)
+
+    def test_evict_venv_cache(self):
+        """
+        The least recently used venvs are evicted once the cache is full, unless they are in use
+        """
+        now = time.time()
+        oldest_venv_path = self.make_venv('oldest', 400, now - 300)
+        locked_venv_path = self.make_venv('locked', 400, now - 200)
+        old_venv_path = self.make_venv('old', 400, now - 100)
+        recent_venv_path = self.make_venv('recent', 400, now)
+        new_venv_path = self.make_venv('new', 400, 0)
+
+        with open(locked_venv_path + '.lock', 'a') as lock_file:
+            ansible.fcntl.flock(lock_file, ansible.fcntl.LOCK_SH)
+            ansible.evict_venv_cache(keep_path=new_venv_path)
+
+        self.assertFalse(os.path.exists(oldest_venv_path))
+        self.assertTrue(os.path.exists(locked_venv_path))
+        self.assertFalse(os.path.exists(old_venv_path))
+        self.assertTrue(os.path.exists(recent_venv_path))
+        self.assertTrue(os.path.exists(new_venv_path))
+
+
+class PlaybookOutputSplitterTestCase(TestCase):
+    """
+    Test cases for PlaybookOutputSplitter
+    """
+    def test_split(self):
+        """
+        Lines are attributed to the hosts they mention, and the others to all hosts
+        """
+        hosts = ['10.0.0.1', '10.0.0.2']
+        splitter = ansible.PlaybookOutputSplitter(hosts)
+        output = [
+            ('PLAY [all] *********', hosts),
+            ('TASK [common : Install packages] *********', hosts),
+            ('ok: [10.0.0.1]', ['10.0.0.1']),
+            ('changed: [10.0.0.2] => (item=git)', ['10.0.0.2']),
+            ('fatal: [10.0.0.1 -> localhost]: FAILED! => {"failed": true,', ['10.0.0.1']),
+            ('  "msg": "Error"}', ['10.0.0.1']),
+            ('RUNNING HANDLER [common : restart] *********', hosts),
+            ('Some warning', hosts),
+            ('PLAY RECAP *********', hosts),
+            ('10.0.0.1                   : ok=1    changed=0    unreachable=0    failed=1', ['10.0.0.1']),
+            ('10.0.0.2                   : ok=1    changed=1    unreachable=0    failed=0', ['10.0.0.2']),
+        ]
+        for line, expected_hosts in output:
+            self.assertEqual(splitter.split(line), expected_hosts, line)
+
+        self.assertEqual(splitter.get_returncode('10.0.0.1', 2), 2)
+        self.assertEqual(splitter.get_returncode('10.0.0.2', 2), 0)
+
+    def test_returncode_without_recap(self):
+        """
+        The exit code of the process is used for the hosts missing from the play recap
+        """
+        splitter = ansible.PlaybookOutputSplitter(['10.0.0.1'])
+        splitter.split('ERROR! the playbook could not be found')
+        self.assertEqual(splitter.get_returncode('10.0.0.1', 1), 1)
+        self.assertEqual(splitter.get_returncode('10.0.0.1', -15), -15)
+
+
+class CallbackPluginTestCase(TestCase):
+    """
+    Test cases for the `opencraft_events` callback plugin, which ansible loads outside of this app
+    """
+    def setUp(self):
+        super().setUp()
+        plugin_path = os.path.join(ansible.CALLBACK_PLUGINS_DIR, 'opencraft_events.py')
+        self.plugin = SourceFileLoader('opencraft_events', plugin_path).load_module()
+        read_fd, write_fd = os.pipe()
+        self.events = open(read_fd, 'rb')
+        self.addCleanup(self.events.close)
+        with patch.dict('os.environ', {'OPENCRAFT_ANSIBLE_EVENTS_FD': str(write_fd)}):
+            self.callback = self.plugin.CallbackModule()
+
+    def read_events(self):
+        """
+        Close the pipe, and return the events written by the plugin
+        """
+        os.close(self.callback.events_fd)
+        return [ansible.parse_playbook_event(line) for line in self.events]
+
+    def test_events(self):
+        """
+        An event is written for the result of each task on each host
+        """
+        self.callback.playbook_on_task_start('common | Install packages', False)
+        self.callback.runner_on_ok('10.0.0.1', {'changed': True})
+        self.callback.runner_on_failed('10.0.0.2', {'msg': 'No package matching', 'rc': 100, 'stdout': 'Output'})
+        self.callback.playbook_on_task_start('Check the server', False)
+        self.callback.runner_on_skipped('10.0.0.1')
+
+        events = self.read_events()
+        self.assertEqual(
+            [(event['role'], event['task'], event['host'], event['status'], event['result']) for event in events],
+            [
+                ('common', 'common | Install packages', '10.0.0.1', 'changed', {}),
+                ('common', 'common | Install packages', '10.0.0.2', 'failed',
+                 {'msg': 'No package matching', 'rc': 100}),
+                ('', 'Check the server', '10.0.0.1', 'skipped', {}),
+            ]
+        )
+        for event in events:
+            self.assertGreaterEqual(event['duration'], 0)
+
+    def test_event_size(self):
+        """
+        Events are small enough to be written atomically
+        """
+        self.callback.playbook_on_task_start('Install packages', False)
+        self.callback.runner_on_failed('10.0.0.1', {'msg': 'Error', 'stderr': 'x' * 10000})
+        self.callback.runner_on_failed('10.0.0.2', {'msg': 'E' * 10000, 'stderr': 'é' * 10000})
+
+        first_event, second_event = self.read_events()
+        self.assertEqual(first_event['result'], {'msg': 'Error', 'stderr': 'x' * 1000})
+        self.assertEqual(second_event['result'], {'truncated': True})
@@ -38,6 +38,7 @@ class BaseInstanceUpgradeTest(TestCase):
         super(BaseInstanceUpgradeTest, self).setUp()
         self.instance_objects_mock = self._apply_patch(OpenEdXInstance, patch_attribute='objects')
         self.spawn_appserver_mock = self._apply_patch("instance.instance_upgrade.spawn_appserver")
+        self.spawn_appservers_mock = self._apply_patch("instance.instance_upgrade.spawn_appservers")
 
     def _apply_patch(self, target, patch_attribute=None, **kwargs):
         """
@@ -180,6 +181,25 @@ class TestInstanceUpgrade(BaseInstanceUpgradeTest):
                 for instance in instances_collection
             ]
             self.assertEqual(self.spawn_appserver_mock.mock_calls, expected_spawn_calls)
+            self.assertEqual(self.spawn_appservers_mock.call_count, 0)
+
+    def test_upgrade_instances_batch(self):
+        """
+        Test upgrading multiple instances, spawning their appservers together
+        """
+        instances_collection = [self._make_instance_mock() for _ in range(3)]
+
+        with patch.object(self.upgrader, 'get_instances_to_upgrade') as patched_get_instances, \
+                patch.object(self.upgrader, 'upgrade_instance'):
+            patched_get_instances.return_value = instances_collection
+            self.upgrader.upgrade_instances(batch=True)
+
+            for instance in instances_collection:
+                instance.save.assert_called_once_with()
+            self.assertEqual(self.spawn_appserver_mock.call_count, 0)
+            self.spawn_appservers_mock.assert_called_once_with(
+                [instance.ref.pk for instance in instances_collection], mark_active_on_success=True
+            )
 
 
 class TestDogwoodToEucalyptus1(BaseInstanceUpgradeTest):
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Log archives - Tests
+"""
+
+# Imports #####################################################################
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from freezegun import freeze_time
+
+from instance.log_archive import append_to_log_archive, delete_log_archive, read_log_archive
+from instance.models.log_entry import LogEntry
+from instance.tests.base import TestCase
+
+
+# Tests #######################################################################
+
+class LogArchiveTestCase(TestCase):
+    """
+    Test cases for the log archive functions
+    """
+    def setUp(self):
+        super().setUp()
+        with freeze_time('2016-10-17 10:00:00'):
+            self.log_entries = [
+                LogEntry.objects.create(level='INFO', text='Line #1'),
+                LogEntry.objects.create(level='ERROR', text='Line #2 ✓'),
+            ]
+        with freeze_time('2016-10-17 11:00:00'):
+            self.new_log_entries = [LogEntry.objects.create(level='INFO', text='Line #3')]
+
+    def check_log_entries(self, log_entries, expected_log_entries):
+        """
+        Check that the given log entries match the ones stored in the archive
+        """
+        self.assertEqual(
+            [(entry.pk, entry.level, entry.text, entry.created) for entry in log_entries],
+            [(entry.pk, entry.level, entry.text, entry.created) for entry in expected_log_entries],
+        )
+
+    def test_local_storage(self):
+        """
+        Log entries are archived in a local directory, one chunk at a time
+        """
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        with override_settings(LOG_ARCHIVE_STORAGE='local', LOG_ARCHIVE_LOCAL_DIR=archive_dir):
+            url = append_to_log_archive('', 'appserver-1', self.log_entries)
+        path = os.path.join(archive_dir, 'appserver-1', '00000.jsonl.gz')
+        self.assertEqual(url, 'file://' + path)
+        with gzip.open(path) as archive_file:
+            self.assertEqual(len(archive_file.readlines()), 2)
+        # The archive can still be read, and appended to, once the storage setting changes:
+        self.check_log_entries(read_log_archive(url), self.log_entries)
+
+        new_url = append_to_log_archive(url, 'appserver-1', self.new_log_entries)
+        self.assertEqual(new_url, 'file://' + os.path.join(archive_dir, 'appserver-1', '00001.jsonl.gz'))
+        # The first chunk isn't rewritten:
+        with gzip.open(path) as archive_file:
+            self.assertEqual(len(archive_file.readlines()), 2)
+        self.check_log_entries(read_log_archive(new_url), self.log_entries + self.new_log_entries)
+
+        delete_log_archive(new_url)
+        self.assertFalse(os.path.exists(os.path.join(archive_dir, 'appserver-1')))
+
+    def test_read_sorted(self):
+        """
+        Log entries archived after newer ones are read in order
+        """
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        with override_settings(LOG_ARCHIVE_STORAGE='local', LOG_ARCHIVE_LOCAL_DIR=archive_dir):
+            url = append_to_log_archive('', 'appserver-1', self.new_log_entries)
+            url = append_to_log_archive(url, 'appserver-1', self.log_entries)
+        self.check_log_entries(read_log_archive(url), self.log_entries + self.new_log_entries)
+
+    @override_settings(LOG_ARCHIVE_STORAGE='swift', LOG_ARCHIVE_SWIFT_CONTAINER='logs')
+    @patch('instance.log_archive.openstack.delete_from_swift_container')
+    @patch('instance.log_archive.openstack.download_from_swift_container')
+    @patch('instance.log_archive.openstack.upload_to_swift_container')
+    def test_swift_storage(self, mock_upload, mock_download, mock_delete):
+        """
+        Log entries are archived in a Swift container, one chunk at a time
+        """
+        url = append_to_log_archive('', 'appserver-1', self.log_entries)
+        self.assertEqual(url, 'swift://logs/appserver-1/00000.jsonl.gz')
+        url = append_to_log_archive(url, 'appserver-1', self.new_log_entries)
+        self.assertEqual(url, 'swift://logs/appserver-1/00001.jsonl.gz')
+        self.assertEqual(mock_upload.call_count, 2)
+        chunks = {}
+        for (container_name, object_name, data), dummy in mock_upload.call_args_list:
+            self.assertEqual(container_name, 'logs')
+            chunks[object_name] = data
+        self.assertEqual(sorted(chunks), ['appserver-1/00000.jsonl.gz', 'appserver-1/00001.jsonl.gz'])
+
+        mock_download.side_effect = lambda container_name, object_name: chunks[object_name]
+        self.check_log_entries(read_log_archive(url), self.log_entries + self.new_log_entries)
+        self.assertEqual(mock_download.call_count, 2)
+
+        delete_log_archive(url)
+        mock_delete.assert_called_once_with('logs', ['appserver-1/00000.jsonl.gz', 'appserver-1/00001.jsonl.gz'])
+
+    @override_settings(LOG_ARCHIVE_STORAGE='ftp')
+    def test_unknown_storage(self):
+        """
+        An unknown storage is a configuration error
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            append_to_log_archive('', 'appserver-1', self.log_entries)
@@ -23,11 +23,15 @@ OpenStack - Tests
 # Imports #####################################################################
 
 from collections import namedtuple
+import threading
 from unittest import mock
 from unittest.mock import Mock, call, patch, MagicMock
 
 import ddt
+from django.test import override_settings
+import novaclient
 import requests
+from swiftclient.exceptions import ClientException
 from swiftclient.service import SwiftError
 
 from instance import openstack
@@ -62,6 +66,7 @@ def create_file_download_response(success=True, status_code=200, container=CONTA
 
 # Tests #######################################################################
 
+@ddt.ddt
 class OpenStackTestCase(TestCase):
     """
     Test cases for OpenStack helper functions
@@ -70,6 +75,10 @@ class OpenStackTestCase(TestCase):
         super().setUp()
 
         self.nova = Mock()
+        openstack.reset_nova_client_pool()
+        self.addCleanup(openstack.reset_nova_client_pool)
+        openstack.nova_resource_cache.invalidate()
+        self.addCleanup(openstack.nova_resource_cache.invalidate)
 
     def test_create_server(self):
         """
@@ -84,22 +93,253 @@ class OpenStackTestCase(TestCase):
             call.servers.create('test-vm', 'test-image', 'test-flavor', key_name=None)
         ])
 
+    def test_create_server_cached_resources(self):
+        """
+        Flavors and images are only looked up once when creating several VMs
+        """
+        self.nova.flavors.find.return_value = 'test-flavor'
+        self.nova.images.find.return_value = 'test-image'
+        hits, misses = openstack.nova_resource_cache.hits, openstack.nova_resource_cache.misses
+        for vm_name in ('test-vm-1', 'test-vm-2', 'test-vm-3'):
+            openstack.create_server(self.nova, vm_name, {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.assertEqual(self.nova.flavors.find.call_count, 1)
+        self.assertEqual(self.nova.images.find.call_count, 1)
+        self.assertEqual(self.nova.servers.create.call_count, 3)
+        self.assertEqual(openstack.nova_resource_cache.hits - hits, 4)
+        self.assertEqual(openstack.nova_resource_cache.misses - misses, 2)
+
+        # Other selectors are looked up separately
+        openstack.create_server(self.nova, 'test-vm-4', {"ram": 8192, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.assertEqual(self.nova.flavors.find.call_count, 2)
+        self.assertEqual(self.nova.images.find.call_count, 1)
+
+    def test_create_server_cache_expired(self):
+        """
+        Cached flavors and images are looked up again once they expire
+        """
+        with self.settings(OPENSTACK_RESOURCE_CACHE_TTL=0):
+            openstack.create_server(self.nova, 'test-vm-1', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+            openstack.create_server(self.nova, 'test-vm-2', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.assertEqual(self.nova.flavors.find.call_count, 2)
+        self.assertEqual(self.nova.images.find.call_count, 2)
+
+    def test_create_server_stale_cache(self):
+        """
+        When the cached image doesn't exist anymore, it is looked up again before retrying
+        """
+        flavor, old_image, new_image = Mock(id='test-flavor'), Mock(id='old-image'), Mock(id='new-image')
+        self.nova.flavors.find.return_value = flavor
+        self.nova.images.find.side_effect = [old_image, new_image]
+        openstack.create_server(self.nova, 'test-vm-1', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+
+        self.nova.servers.create.side_effect = [
+            novaclient.exceptions.BadRequest(400, message='Invalid imageRef provided.'),
+            'new-server',
+        ]
+        self.assertEqual(
+            openstack.create_server(self.nova, 'test-vm-2', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"}),
+            'new-server',
+        )
+        self.nova.servers.create.assert_called_with('test-vm-2', new_image, flavor, key_name=None)
+        # The flavor still resolves, so it isn't looked up again
+        self.nova.flavors.get.assert_called_once_with('test-flavor')
+        self.assertEqual(self.nova.flavors.find.call_count, 1)
+
+        # When the image didn't change, the error is raised
+        self.nova.images.find.side_effect = None
+        self.nova.images.find.return_value = new_image
+        self.nova.servers.create.side_effect = novaclient.exceptions.BadRequest(
+            400, message='Invalid imageRef provided.',
+        )
+        with self.assertRaises(novaclient.exceptions.BadRequest):
+            openstack.create_server(self.nova, 'test-vm-3', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+
+    def test_create_server_deleted_resource(self):
+        """
+        When nova's error doesn't name the flavor or the image, they are looked up again only if
+        their ID doesn't resolve anymore
+        """
+        old_flavor, new_flavor, image = Mock(id='old-flavor'), Mock(id='new-flavor'), Mock(id='test-image')
+        self.nova.flavors.find.side_effect = [old_flavor, new_flavor]
+        self.nova.flavors.get.side_effect = novaclient.exceptions.NotFound(404)
+        self.nova.images.find.return_value = image
+        self.nova.servers.create.side_effect = [novaclient.exceptions.NotFound(404), 'new-server']
+        self.assertEqual(
+            openstack.create_server(self.nova, 'test-vm', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"}),
+            'new-server',
+        )
+        self.nova.servers.create.assert_called_with('test-vm', image, new_flavor, key_name=None)
+        self.assertEqual(self.nova.images.find.call_count, 1)
+
+    def test_create_server_unrelated_error(self):
+        """
+        Errors unrelated to the flavor or the image are raised without looking them up again
+        """
+        self.nova.flavors.find.return_value = Mock(id='test-flavor')
+        self.nova.images.find.return_value = Mock(id='test-image')
+        self.nova.servers.create.side_effect = novaclient.exceptions.BadRequest(
+            400, message='Invalid key_name provided.',
+        )
+        with self.assertRaises(novaclient.exceptions.BadRequest):
+            openstack.create_server(self.nova, 'test-vm', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.assertEqual(self.nova.servers.create.call_count, 1)
+        self.assertEqual(self.nova.flavors.find.call_count, 1)
+        self.assertEqual(self.nova.images.find.call_count, 1)
+        # The cached flavor and image are kept
+        self.nova.servers.create.side_effect = None
+        openstack.create_server(self.nova, 'test-vm', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.assertEqual(self.nova.flavors.find.call_count, 1)
+
+    def test_find_resource_not_found(self):
+        """
+        A failed lookup doesn't leave a stale cache entry
+        """
+        self.nova.images.find.side_effect = novaclient.exceptions.NotFound(404)
+        with self.assertRaises(novaclient.exceptions.NotFound):
+            openstack.find_resource(self.nova.images, 'image', {"name": "Ubuntu 12.04"})
+        self.nova.images.find.side_effect = None
+        self.nova.images.find.return_value = 'test-image'
+        self.assertEqual(openstack.find_resource(self.nova.images, 'image', {"name": "Ubuntu 12.04"}), 'test-image')
+
+    @override_settings(OPENSTACK_SERVER_LIST_PAGE_SIZE=2)
+    def test_get_server_pages(self):
+        """
+        List all servers, following the pagination markers
+        """
+        server_class = namedtuple('server_class', 'id')
+        pages = [
+            [server_class(id='server-a'), server_class(id='server-b')],
+            [server_class(id='server-c')],
+        ]
+        self.nova.servers.list.side_effect = pages
+        self.assertEqual(list(openstack.get_server_pages(self.nova)), pages)
+        self.assertEqual(self.nova.mock_calls, [
+            call.servers.list(detailed=True, search_opts=None, marker=None, limit=2),
+            call.servers.list(detailed=True, search_opts=None, marker='server-b', limit=2),
+        ])
+
     def test_delete_servers_by_name(self):
         """
         Delete all servers with a given name
         """
-        server_class = namedtuple('server_class', 'name pk')
+        server_class = namedtuple('server_class', 'name id')
         self.nova.servers.list.return_value = [
-            server_class(name='server-a', pk=1),
-            server_class(name='server-a', pk=2),
-            server_class(name='server-b', pk=3),
+            server_class(name='server-a', id=1),
+            server_class(name='server-a', id=2),
+            server_class(name='server-a-2', id=3),
         ]
-        openstack.delete_servers_by_name(self.nova, 'server-a')
-        self.assertEqual(self.nova.mock_calls, [
-            call.servers.list(),
-            call.servers.delete(server_class(name='server-a', pk=1)),
-            call.servers.delete(server_class(name='server-a', pk=2)),
+        with patch('instance.openstack.get_nova_client', return_value=self.nova):
+            results = openstack.delete_servers_by_name('server-a')
+        self.assertEqual(self.nova.servers.list.mock_calls, [
+            call(detailed=False, search_opts={'name': '^(server-a)$'}, marker=None, limit=1000),
+        ])
+        self.assertCountEqual(self.nova.servers.delete.mock_calls, [
+            call(server_class(name='server-a', id=1)),
+            call(server_class(name='server-a', id=2)),
+        ])
+        self.assertCountEqual(results['server-a'], [
+            openstack.ServerDeletion(server_id=1, error=None),
+            openstack.ServerDeletion(server_id=2, error=None),
+        ])
+        self.assertEqual(list(results.keys()), ['server-a'])
+
+    def test_delete_servers_by_id(self):
+        """
+        Delete servers by OpenStack ID, reporting errors per server
+        """
+        error = novaclient.exceptions.NotFound(404)
+
+        def delete(server_id):
+            """ Simulate a server that disappears before it can be deleted """
+            if server_id == 'server-2':
+                raise error
+        self.nova.servers.delete.side_effect = delete
+
+        with patch('instance.openstack.get_nova_client', return_value=self.nova):
+            results = openstack.delete_servers_by_id(['server-1', 'server-2'])
+        self.assertCountEqual(self.nova.servers.delete.mock_calls, [call('server-1'), call('server-2')])
+        self.assertEqual(results, {'server-1': None, 'server-2': error})
+
+    def test_delete_servers(self):
+        """
+        Delete servers by name or name pattern, reporting errors per name
+        """
+        server_class = namedtuple('server_class', 'name id')
+        self.nova.servers.list.return_value = [
+            server_class(name='inst-1-vm', id=1),
+            server_class(name='inst-2-vm', id=2),
+            server_class(name='edxapp.vm', id=3),
+            server_class(name='inst-2-vm-old', id=4),
+        ]
+        error = novaclient.exceptions.NotFound(404)
+
+        def delete(server):
+            """ Simulate a server that disappears before it can be deleted """
+            if server.id == 2:
+                raise error
+        self.nova.servers.delete.side_effect = delete
+
+        with patch('instance.openstack.get_nova_client', return_value=self.nova):
+            results = openstack.delete_servers(names=['edxapp.vm', 'missing'], pattern='inst-*-vm')
+        self.assertEqual(self.nova.servers.list.mock_calls, [
+            call(detailed=False, search_opts={'name': r'^(edxapp\.vm|missing|inst-.*-vm)$'}, marker=None, limit=1000),
         ])
+        self.assertEqual(self.nova.servers.delete.call_count, 3)
+        self.assertEqual(results, {
+            'inst-1-vm': [openstack.ServerDeletion(server_id=1, error=None)],
+            'inst-2-vm': [openstack.ServerDeletion(server_id=2, error=error)],
+            'edxapp.vm': [openstack.ServerDeletion(server_id=3, error=None)],
+            'missing': [],
+        })
+
+    def test_delete_servers_client_per_thread(self):
+        """
+        Each thread deleting servers uses its own nova client
+        """
+        clients = {}
+        lock = threading.Lock()
+
+        def get_nova_client():
+            """ Return the client of the current thread """
+            with lock:
+                return clients.setdefault(threading.get_ident(), Mock())
+
+        with patch('instance.openstack.get_nova_client', side_effect=get_nova_client):
+            results = openstack.delete_servers_by_id(['server-{}'.format(i) for i in range(10)], max_workers=3)
+        self.assertEqual(len(results), 10)
+        self.assertNotIn(threading.get_ident(), clients)
+        self.assertLessEqual(len(clients), 3)
+        self.assertEqual(sum(client.servers.delete.call_count for client in clients.values()), 10)
+
+    @ddt.data(
+        ('inst-*-vm', r'^(inst-.*-vm)$'),
+        ('inst-?.vm', r'^(inst-.\.vm)$'),
+        ('inst-[0-9]-vm[!x]', r'^(inst-[0-9]-vm[^x])$'),
+        ('inst-[]!]-[!]^]', r'^(inst-[]!]-[^]^])$'),
+        ('inst-[-vm', r'^(inst-\[-vm)$'),
+    )
+    @ddt.unpack
+    def test_name_regex(self, pattern, regex):
+        """
+        Shell-style patterns are translated to regexes for nova, like fnmatch does
+        """
+        self.assertEqual(openstack._name_regex([], pattern), regex)
+
+    @ddt.data('inst-[\\d]-vm', 'inst-[[:digit:]]-vm', 'inst-[^a]-vm', 'inst-[9-0]-vm')
+    def test_name_regex_unsupported(self, pattern):
+        """
+        Bracket expressions which nova databases would read differently are rejected
+        """
+        with patch('instance.openstack.get_nova_client', return_value=self.nova), self.assertRaises(ValueError):
+            openstack.delete_servers(pattern=pattern)
+        self.assertFalse(self.nova.mock_calls)
+
+    def test_delete_servers_nothing_to_match(self):
+        """
+        Servers are not even listed when no name or pattern is given
+        """
+        self.assertEqual(openstack.delete_servers(), {})
+        self.assertFalse(self.nova.mock_calls)
 
     def test_get_server_public_address_none(self):
         """
@@ -109,6 +349,45 @@ class OpenStackTestCase(TestCase):
         server = server_class(addresses=[])
         self.assertEqual(openstack.get_server_public_address(server), None)
 
+    @patch('instance.openstack.NovaClient')
+    def test_get_nova_client_pooled(self, mock_nova_client_class):
+        """
+        The same nova client is reused by all the callers from a given thread
+        """
+        mock_nova_client_class.side_effect = lambda *args, **kwargs: Mock()
+        nova = openstack.get_nova_client()
+        self.assertIs(openstack.get_nova_client(), nova)
+        self.assertEqual(mock_nova_client_class.call_count, 1)
+        nova.client.open_session.assert_called_once_with()
+
+        # Each thread gets its own client
+        other_thread_clients = []
+        thread = threading.Thread(target=lambda: other_thread_clients.append(openstack.get_nova_client()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_thread_clients[0], nova)
+
+        # Other credentials or API versions get their own client
+        with self.settings(OPENSTACK_TENANT='other-tenant'):
+            self.assertIsNot(openstack.get_nova_client(), nova)
+        self.assertIsNot(openstack.get_nova_client(api_version=3), nova)
+        self.assertIs(openstack.get_nova_client(), nova)
+
+        openstack.reset_nova_client_pool()
+        self.assertIsNot(openstack.get_nova_client(), nova)
+
+    @patch('instance.openstack.os.getpid')
+    @patch('instance.openstack.NovaClient')
+    def test_get_nova_client_forked(self, mock_nova_client_class, mock_getpid):
+        """
+        A forked process doesn't reuse the nova clients of its parent
+        """
+        mock_nova_client_class.side_effect = lambda *args, **kwargs: Mock()
+        mock_getpid.return_value = 1000
+        nova = openstack.get_nova_client()
+        mock_getpid.return_value = 1001
+        self.assertIsNot(openstack.get_nova_client(), nova)
+
     @patch('requests.packages.urllib3.util.retry.Retry.sleep')
     @patch('http.client.HTTPConnection.getresponse')
     @patch('http.client.HTTPConnection.request')
@@ -195,6 +474,48 @@ class SwiftTestCase(TestCase):
         self.service.delete.assert_called_once_with(CONTAINER_NAME)
         self.basic_checks(auth)
 
+    def test_upload_to_swift_container(self):
+        """Test for upload_to_swift_container function."""
+        self.service.upload.return_value = [{'success': True}, {'success': True}]
+        openstack.upload_to_swift_container(CONTAINER_NAME, 'archive.gz', b'data')
+        self.assertEqual(self.service.upload.call_count, 1)
+        container_name, (upload, ) = self.service.upload.call_args[0]
+        self.assertEqual(container_name, CONTAINER_NAME)
+        self.assertEqual(upload.object_name, 'archive.gz')
+        self.assertEqual(upload.source.read(), b'data')
+        self.basic_checks()
+
+    def test_upload_to_swift_container_error(self):
+        """Test that upload_to_swift_container raises upload errors."""
+        self.service.upload.return_value = [{'success': False, 'error': SwiftError('Upload failed')}]
+        with self.assertRaises(SwiftError):
+            openstack.upload_to_swift_container(CONTAINER_NAME, 'archive.gz', b'data')
+
+    def test_download_from_swift_container(self):
+        """Test for download_from_swift_container function."""
+        self.service.download.return_value = iter([{'success': True, 'contents': [b'da', b'ta']}])
+        self.assertEqual(openstack.download_from_swift_container(CONTAINER_NAME, 'archive.gz'), b'data')
+        self.service.download.assert_called_once_with(CONTAINER_NAME, ['archive.gz'], options={'out_file': '-'})
+        self.basic_checks()
+
+    def test_delete_from_swift_container(self):
+        """Test for delete_from_swift_container function."""
+        self.service.delete.return_value = [
+            {'success': True},
+            {'success': False, 'error': ClientException('Not found', http_status=404)},
+        ]
+        openstack.delete_from_swift_container(CONTAINER_NAME, ['archive.gz', 'missing.gz'])
+        self.service.delete.assert_called_once_with(CONTAINER_NAME, ['archive.gz', 'missing.gz'])
+        self.basic_checks()
+
+    def test_delete_from_swift_container_error(self):
+        """Test that delete_from_swift_container raises deletion errors."""
+        self.service.delete.return_value = [
+            {'success': False, 'error': ClientException('Forbidden', http_status=403)},
+        ]
+        with self.assertRaises(ClientException):
+            openstack.delete_from_swift_container(CONTAINER_NAME, ['archive.gz'])
+
     @ddt.data(
         # Two files downloaded successfully, no errors
         ({}, [{'success': True}, {'success': True}, ], {}),
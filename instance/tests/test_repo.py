@@ -23,8 +23,12 @@ Git repository - Tests
 # Imports #####################################################################
 
 import os.path
+import shutil
+import tempfile
 from unittest.mock import call, patch
 
+from django.test import override_settings
+
 from instance import repo
 from instance.tests.base import TestCase
 
@@ -35,6 +39,7 @@ class RepoTestCase(TestCase):
     """
     Test cases for Git repository helper functions
     """
+    @override_settings(GIT_MIRROR_CACHE_DIR='')
     @patch('git.Git')
     @patch('git.repo.base.Repo.clone_from')
     def test_open_repository(self, mock_clone_from, mock_git_class):
@@ -48,3 +53,38 @@ class RepoTestCase(TestCase):
             self.assertTrue(os.path.isdir(tmp_dir_path))
             self.assertEqual(mock_repo.mock_calls, [call.checkout('test-branch')])
         self.assertFalse(os.path.isdir(tmp_dir_path))
+
+    @patch('git.Git')
+    @patch('git.repo.base.Repo.clone_from')
+    def test_open_repository_mirror(self, mock_clone_from, mock_git_class):
+        """
+        Clone the repository from a local mirror, which is created once and then fetched
+        """
+        mirror_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, mirror_dir)
+        repo_url = 'http://example.com/repo.git'
+        mock_clone_from.side_effect = lambda url, path, **kwargs: os.makedirs(path, exist_ok=True)
+
+        with override_settings(GIT_MIRROR_CACHE_DIR=mirror_dir):
+            with repo.open_repository(repo_url, ref='test-branch'):
+                mirror_path = mock_clone_from.mock_calls[0][1][1][:-len('.tmp')]
+                tmp_dir_path = mock_clone_from.mock_calls[1][1][1]
+                self.assertEqual(mock_clone_from.mock_calls, [
+                    call(repo_url, mirror_path + '.tmp', mirror=True),
+                    call(mirror_path, tmp_dir_path, shared=True),
+                ])
+                self.assertEqual(os.path.dirname(mirror_path), mirror_dir)
+                self.assertIn(call(mirror_path + '.tmp'), mock_git_class.mock_calls)
+                self.assertIn(call().config('gc.autoDetach', 'false'), mock_git_class.mock_calls)
+                self.assertIn(call().config('gc.pruneExpire', '2.weeks.ago'), mock_git_class.mock_calls)
+                self.assertTrue(os.path.isdir(mirror_path))
+
+            mock_clone_from.reset_mock()
+            mock_git_class.reset_mock()
+            with repo.open_repository(repo_url, ref='other-branch'):
+                tmp_dir_path = mock_clone_from.mock_calls[0][1][1]
+                mock_clone_from.assert_called_once_with(mirror_path, tmp_dir_path, shared=True)
+                self.assertEqual(mock_git_class.mock_calls[:2], [
+                    call(mirror_path),
+                    call().fetch('origin', prune=True),
+                ])
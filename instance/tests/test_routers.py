@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015-2016 OpenCraft <contact@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+SwampDragon routers - Tests
+"""
+
+# Imports #####################################################################
+
+from unittest.mock import Mock
+
+from instance.routers import LogRouter, NotificationRouter
+from instance.tests.base import TestCase
+
+
+# Tests #######################################################################
+
+class RoutersTestCase(TestCase):
+    """
+    Test cases for the channels the browser can subscribe to
+    """
+    def test_notification_channels(self):
+        """
+        Notifications are broadcasted to all subscribers, but log entries aren't
+        """
+        self.assertEqual(NotificationRouter(Mock()).get_subscription_channels(), ['notification'])
+
+    def test_log_channels(self):
+        """
+        Each object has its own log channel
+        """
+        router = LogRouter(Mock())
+        self.assertEqual(router.get_subscription_channels(object_type='instance', object_id=12), ['log:instance:12'])
+        self.assertEqual(router.get_subscription_channels(object_type='appserver', object_id='5'), ['log:appserver:5'])
+        self.assertEqual(router.get_subscription_channels(object_type='server', object_id=7), ['log:server:7'])
+
+    def test_log_channels_invalid(self):
+        """
+        Subscribing to the logs of an unknown type of object or an invalid ID doesn't subscribe to any channel
+        """
+        router = LogRouter(Mock())
+        self.assertEqual(router.get_subscription_channels(object_type='user', object_id=1), [])
+        self.assertEqual(router.get_subscription_channels(object_type='instance', object_id='*'), [])
+        self.assertEqual(router.get_subscription_channels(object_type='instance'), [])
@@ -25,10 +25,15 @@ Worker tasks - Tests
 from unittest.mock import patch
 
 import ddt
+from django.test import override_settings
+from freezegun import freeze_time
 
 from instance import tasks
+from instance.models.log_entry import LogEntry
 from instance.tests.base import TestCase
+from instance.tests.models.factories.openedx_appserver import make_test_appserver
 from instance.tests.models.factories.openedx_instance import OpenEdXInstanceFactory
+from instance.tests.models.factories.server import OpenStackServerFactory, ReadyOpenStackServerFactory
 
 
 # Tests #######################################################################
@@ -101,3 +106,162 @@ class SpawnAppServerTestCase(TestCase):
         tasks.spawn_appserver(instance.ref.pk)
         self.assertEqual(self.mock_spawn_appserver.call_count, 1)
         self.assertTrue(any("Spawning new AppServer, attempt 1 of 1" in log.text for log in instance.log_entries))
+
+
+class RefreshServerStatusTestCase(TestCase):
+    """
+    Test cases for tasks.refresh_server_status and tasks.refresh_server_statuses
+    """
+    @patch('instance.models.server.OpenStackServerQuerySet.update_status')
+    @patch('instance.models.server.OpenStackServer.update_status', autospec=True)
+    def test_refresh_server_status(self, mock_update_status, mock_reconcile):
+        """
+        Only the status of the given server is refreshed, without reconciling all the servers
+        """
+        server = ReadyOpenStackServerFactory(openstack_id='vm1')
+        OpenStackServerFactory()
+        tasks.refresh_server_status(server.pk)
+        self.assertEqual(mock_update_status.call_count, 1)
+        self.assertEqual(mock_update_status.call_args[0][0], server)
+        self.assertFalse(mock_reconcile.called)
+
+    @patch('instance.models.server.OpenStackServer.update_status')
+    def test_refresh_pending_server_status(self, mock_update_status):
+        """
+        The status of a pending server isn't refreshed, since that would start its VM
+        """
+        server = OpenStackServerFactory()
+        tasks.refresh_server_status(server.pk)
+        self.assertFalse(mock_update_status.called)
+
+    @patch('instance.models.server.OpenStackServerQuerySet.update_status', autospec=True)
+    def test_refresh_server_statuses(self, mock_update_status):
+        """
+        The statuses of the given servers are reconciled together
+        """
+        servers = [OpenStackServerFactory(), OpenStackServerFactory()]
+        OpenStackServerFactory()
+        tasks.refresh_server_statuses([server.pk for server in servers])
+        self.assertEqual(mock_update_status.call_count, 1)
+        queryset = mock_update_status.call_args[0][0]
+        self.assertCountEqual(queryset, servers)
+
+
+@override_settings(LOG_RETENTION_DAYS=30, LOG_ERROR_RETENTION_DAYS=365, LOG_RETENTION_CHUNK_SIZE=2)
+class DeleteExpiredLogEntriesTestCase(TestCase):
+    """
+    Test cases for tasks.delete_expired_log_entries
+    """
+    def make_log_entry(self, date, level):
+        """
+        Create a log entry at the given date
+        """
+        with freeze_time(date):
+            return LogEntry.objects.create(level=level, text='{} {}'.format(date, level))
+
+    def test_delete_expired_log_entries(self):
+        """
+        Warnings and errors are kept longer than the other log entries
+        """
+        kept = [
+            self.make_log_entry('2016-10-01', 'DEBUG'),
+            self.make_log_entry('2016-10-01', 'INFO'),
+            self.make_log_entry('2016-09-01', 'WARNING'),
+            self.make_log_entry('2016-01-01', 'WARNING'),
+            self.make_log_entry('2016-01-01', 'ERROR'),
+            self.make_log_entry('2016-01-01', 'CRITICAL'),
+        ]
+        for level in ('DEBUG', 'INFO', 'INFO'):
+            self.make_log_entry('2016-09-01', level)
+        for level in ('WARNING', 'ERROR'):
+            self.make_log_entry('2015-09-01', level)
+
+        with freeze_time('2016-10-17'), self.assertLogs('instance.tasks', 'INFO') as logs:
+            tasks.delete_expired_log_entries()
+        self.assertIn('Deleted 5 expired log entries', logs.output[0])
+        remaining = LogEntry.objects.exclude(text__contains='Deleted')
+        self.assertEqual(set(remaining), set(kept))
+
+    @override_settings(LOG_RETENTION_DAYS=0, LOG_ERROR_RETENTION_DAYS=0)
+    def test_keep_forever(self):
+        """
+        Log entries are kept forever when the retention periods are disabled
+        """
+        self.make_log_entry('2010-01-01', 'INFO')
+        self.make_log_entry('2010-01-01', 'ERROR')
+        with freeze_time('2016-10-17'):
+            tasks.delete_expired_log_entries()
+        self.assertEqual(LogEntry.objects.count(), 2)
+
+
+class ArchiveAppServerLogEntriesTestCase(TestCase):
+    """
+    Test cases for tasks.archive_appserver_log_entries
+    """
+    @patch('instance.models.appserver.AppServer.archive_log_entries', autospec=True)
+    def test_archive_appserver_log_entries(self, mock_archive_log_entries):
+        """
+        Only the older log entries of AppServers which are done are archived
+        """
+        mock_archive_log_entries.return_value = 1
+        with freeze_time('2016-10-16 10:00:00'):
+            terminated_app_server = make_test_appserver()
+            terminated_app_server._status_to_waiting_for_server()
+            terminated_app_server._status_to_configuring_server()
+            terminated_app_server._status_to_running()
+            terminated_app_server._status_to_terminated()
+            terminated_app_server.server.logger.info('Line on server')
+            running_app_server = make_test_appserver()
+            running_app_server._status_to_waiting_for_server()
+            running_app_server._status_to_configuring_server()
+            running_app_server._status_to_running()
+            running_app_server.logger.info('Line on AppServer')
+            provisioning_app_server = make_test_appserver()
+            provisioning_app_server._status_to_waiting_for_server()
+            provisioning_app_server.logger.info('Line on AppServer')
+        with freeze_time('2016-10-17 10:00:00'):
+            # Recent log entries aren't archived yet:
+            failed_app_server = make_test_appserver()
+            failed_app_server._status_to_waiting_for_server()
+            failed_app_server._status_to_configuring_server()
+            failed_app_server._status_to_configuration_failed()
+            failed_app_server.logger.info('Line on AppServer')
+
+        with override_settings(LOG_ARCHIVE_STORAGE='local', LOG_ARCHIVE_AFTER_HOURS=12), \
+                freeze_time('2016-10-17 12:00:00'):
+            tasks.archive_appserver_log_entries()
+        self.assertEqual(mock_archive_log_entries.call_count, 1)
+        app_server, before = mock_archive_log_entries.call_args[0]
+        self.assertEqual(app_server, terminated_app_server)
+        self.assertEqual(before.isoformat(), '2016-10-17T00:00:00+00:00')
+
+    @patch('instance.models.appserver.AppServer.archive_log_entries', autospec=True)
+    def test_archive_error(self, mock_archive_log_entries):
+        """
+        An error while archiving the log entries of an AppServer is logged, and the other AppServers are archived
+        """
+        with freeze_time('2016-10-16 10:00:00'):
+            app_servers = [make_test_appserver() for dummy in range(2)]
+            for app_server in app_servers:
+                app_server._status_to_waiting_for_server()
+                app_server._status_to_error()
+                app_server.logger.info('Line on AppServer')
+        mock_archive_log_entries.side_effect = [RuntimeError('Swift is down'), 1]
+
+        with override_settings(LOG_ARCHIVE_STORAGE='local'), freeze_time('2016-10-17 12:00:00'), \
+                self.assertLogs('instance.tasks') as logs:
+            tasks.archive_appserver_log_entries()
+        self.assertEqual(mock_archive_log_entries.call_count, 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(logs.records[0].levelname, 'ERROR')
+        self.assertIn('Could not archive the log entries of', logs.records[0].getMessage())
+        self.assertIn('Archived 1 log entries of', logs.records[1].getMessage())
+
+    @patch('instance.models.appserver.AppServer.archive_log_entries', autospec=True)
+    def test_archive_disabled(self, mock_archive_log_entries):
+        """
+        Log entries are not archived when LOG_ARCHIVE_STORAGE is not set
+        """
+        with override_settings(LOG_ARCHIVE_STORAGE=''):
+            tasks.archive_appserver_log_entries()
+        self.assertFalse(mock_archive_log_entries.called)
@@ -23,11 +23,15 @@ Utils module - Tests
 # Imports #####################################################################
 
 import itertools
+import json
+import socket
 import subprocess
 from unittest.mock import patch
 
 from instance.tests.base import TestCase
-from instance.utils import poll_streams, _line_timeout_generator
+from instance.utils import (
+    exponential_backoff, is_port_open, open_ports, poll_streams, NotificationListener, _line_timeout_generator
+)
 
 
 # Tests #######################################################################
@@ -62,6 +66,17 @@ class UtilsTestCase(TestCase):
 
         self.assertEqual(sorted(lines, key=key), sorted(expected, key=key))
 
+    def test_poll_streams_chunks(self):
+        """
+        Ensure that lines are reassembled from the chunks read, including a last line without a newline.
+        """
+        process = subprocess.Popen([
+            "printf 'first line\\nsecond, longer line\\nlast line'"
+        ], stdout=subprocess.PIPE, shell=True, bufsize=0)
+        lines = [line for dummy, line in poll_streams(process.stdout, chunk_size=4)]
+        self.assertEqual(lines, [b'first line\n', b'second, longer line\n', b'last line'])
+        process.wait()
+
     @patch('time.time')
     def test_line_timeout_generator(self, mock_time):
         """
@@ -79,3 +94,88 @@ class UtilsTestCase(TestCase):
         for actual, expected in zip(timeout, [3, 3, 3, 3, 3, 3]):
             self.assertEqual(actual, expected)
         self.assertFalse(mock_time.called)
+
+    @patch('random.uniform')
+    def test_exponential_backoff(self, mock_uniform):
+        """
+        Test the generator of exponentially increasing delays, with jitter.
+        """
+        mock_uniform.return_value = 1
+        delays = exponential_backoff(1, 10)
+        self.assertEqual(list(itertools.islice(delays, 6)), [1, 2, 4, 8, 10, 10])
+        mock_uniform.assert_called_with(0.8, 1.2)
+
+        delays = exponential_backoff(2, 10, factor=3, jitter=0.1)
+        self.assertEqual(list(itertools.islice(delays, 4)), [2, 6, 10, 10])
+        mock_uniform.assert_called_with(0.9, 1.1)
+
+    def test_open_ports(self):
+        """
+        Test probing several ports at once, with a listening port and closed ones.
+        """
+        with socket.socket() as listening_socket:
+            listening_socket.bind(('127.0.0.1', 0))
+            listening_socket.listen(5)
+            open_port = listening_socket.getsockname()[1]
+            with socket.socket() as unused_socket:
+                # Bound but not listening, so connections are refused
+                unused_socket.bind(('127.0.0.1', 0))
+                closed_port = unused_socket.getsockname()[1]
+
+                addresses = [('127.0.0.1', open_port), ('127.0.0.1', closed_port), ('invalid host name', 22)]
+                self.assertEqual(open_ports(addresses, timeout=5), {('127.0.0.1', open_port)})
+                self.assertTrue(is_port_open('127.0.0.1', open_port, timeout=5))
+                self.assertFalse(is_port_open('127.0.0.1', closed_port, timeout=5))
+
+    @patch('instance.utils._start_connection')
+    def test_open_ports_timeout(self, mock_start_connection):
+        """
+        Connections which are still pending after the timeout are abandoned and closed.
+        """
+        mock_start_connection.return_value = socket.socket()
+        with patch('instance.utils.time.time', side_effect=[0, 10]):
+            self.assertEqual(open_ports([('192.0.2.1', 22)], timeout=5), set())
+        self.assertEqual(mock_start_connection.return_value.fileno(), -1)
+
+
+class NotificationListenerTestCase(TestCase):
+    """
+    Test cases for NotificationListener
+    """
+    def setUp(self):
+        super().setUp()
+        patcher = patch('instance.utils.redis.StrictRedis')
+        self.addCleanup(patcher.stop)
+        self.mock_pubsub = patcher.start().return_value.pubsub.return_value
+
+    @staticmethod
+    def make_message(data):
+        """ Build a message as returned by redis for a JSON notification """
+        return {'type': 'message', 'channel': b'notification', 'data': json.dumps(data).encode('utf-8')}
+
+    def test_wait_notified(self):
+        """
+        Waiting returns as soon as a matching notification is received.
+        """
+        self.mock_pubsub.get_message.side_effect = [
+            None,
+            self.make_message({'type': 'server_update', 'server_pk': 2}),
+            {'type': 'message', 'channel': b'notification', 'data': b'not json'},
+            self.make_message({'type': 'server_update', 'server_pk': 1}),
+        ]
+        with NotificationListener('notification', lambda data: data['server_pk'] == 1) as listener:
+            self.assertTrue(listener.wait(10))
+        self.mock_pubsub.subscribe.assert_called_once_with('notification')
+        self.assertEqual(self.mock_pubsub.get_message.call_count, 4)
+        self.assertTrue(self.mock_pubsub.close.called)
+
+    @patch('time.time')
+    def test_wait_timeout(self, mock_time):
+        """
+        Waiting returns after the timeout when no matching notification is received.
+        """
+        mock_time.side_effect = itertools.count().__next__
+        self.mock_pubsub.get_message.return_value = None
+        with NotificationListener('notification') as listener:
+            self.assertFalse(listener.wait(3))
+        self.assertEqual(self.mock_pubsub.get_message.call_count, 2)
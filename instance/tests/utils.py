@@ -25,6 +25,8 @@ Test utils
 from contextlib import ExitStack
 from unittest.mock import Mock, patch
 
+from django.test import override_settings
+
 from instance.tests.models.factories.server import OSServerMockManager
 
 
@@ -48,23 +50,28 @@ def patch_services(func):
                 """ Add another patch to the context and return its mock """
                 return stack.enter_context(patch(*args, **kwargs))
 
-            mock_sleep = stack_patch('instance.models.server.time.sleep')
             mock_get_nova_client = stack_patch('instance.models.server.openstack.get_nova_client')
             mock_get_nova_client.return_value.servers.get = os_server_manager.get_os_server
+            mock_get_nova_client.return_value.servers.list = os_server_manager.list_os_servers
+            stack.enter_context(override_settings(OPENSTACK_STATUS_POLL_INTERVAL=0))
+
+            mock_notification_listener = stack_patch('instance.models.server.NotificationListener')
+            mock_wait = mock_notification_listener.return_value.__enter__.return_value.wait
 
-            def check_sleep_count(_delay):
-                """ Check that time.sleep() is not used in some sort of infinite loop """
-                self.assertLess(mock_sleep.call_count, 1000, "time.sleep() called too many times.")
-            mock_sleep.side_effect = check_sleep_count
+            def check_wait_count(_timeout):
+                """ Check that waiting for notifications is not done in some sort of infinite loop """
+                self.assertLess(mock_wait.call_count, 1000, "Waited for notifications too many times.")
+            mock_wait.side_effect = check_wait_count
 
             mocks = Mock(
                 os_server_manager=os_server_manager,
                 mock_get_nova_client=mock_get_nova_client,
                 mock_is_port_open=stack_patch('instance.models.server.is_port_open', return_value=True),
+                mock_open_ports=stack_patch('instance.models.server.open_ports', side_effect=set),
                 mock_create_server=stack_patch(
                     'instance.models.server.openstack.create_server', side_effect=new_servers,
                 ),
-                mock_sleep=mock_sleep,
+                mock_notification_listener=mock_notification_listener,
                 mock_set_dns_record=stack_patch('instance.models.openedx_instance.gandi.set_dns_record'),
                 mock_run_ansible_playbooks=stack_patch(
                     'instance.models.mixins.ansible.AnsibleAppServerMixin.run_ansible_playbooks',
@@ -22,24 +22,86 @@ Instance app - Util functions
 
 # Imports #####################################################################
 
+import errno
 import itertools
 import json
+import os
+import random
 import selectors
 import socket
 import time
 from unittest.mock import Mock
 
+from django.conf import settings
+import redis
 import requests
 
 
 # Functions ###################################################################
 
-def is_port_open(ip, port):
+def is_port_open(ip, port, timeout=None):
     """
     Check if the port is open on the provided ip
+
+    Gives up after `timeout` seconds (default: `settings.PORT_PROBE_TIMEOUT`).
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return sock.connect_ex((ip, port)) == 0
+    return (ip, port) in open_ports([(ip, port)], timeout=timeout)
+
+
+def _start_connection(ip, port):
+    """
+    Helper function for open_ports() to start a non-blocking TCP connection to ip:port.
+
+    Returns the socket, or None if the connection failed immediately.
+    """
+    try:
+        family, sock_type, proto, unused_canonname, sockaddr = socket.getaddrinfo(
+            ip, port, type=socket.SOCK_STREAM
+        )[0]
+        sock = socket.socket(family, sock_type, proto)
+    except OSError:
+        return None
+    sock.setblocking(False)
+    if sock.connect_ex(sockaddr) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        return None
+    return sock
+
+
+def open_ports(addresses, timeout=None):
+    """
+    Check concurrently which ports are open among the provided (ip, port) addresses.
+
+    All connections are started at once and polled with a selector, so probing hundreds of
+    addresses takes at most `timeout` seconds (default: `settings.PORT_PROBE_TIMEOUT`).
+    Returns the set of (ip, port) tuples which accepted a connection.
+    """
+    if timeout is None:
+        timeout = settings.PORT_PROBE_TIMEOUT
+    result = set()
+    selector = selectors.DefaultSelector()
+    try:
+        for address in set(addresses):
+            sock = _start_connection(*address)
+            if sock is not None:
+                selector.register(sock, selectors.EVENT_WRITE, data=address)
+
+        deadline = time.time() + timeout
+        while selector.get_map():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for key, unused_mask in selector.select(remaining):
+                # The socket becomes writable once the connection is either established or refused
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    result.add(key.data)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return result
 
 
 def to_json(obj):
@@ -77,6 +139,20 @@ def get_requests_retry(total=10, connect=10, read=10, redirect=10, backoff_facto
     )
 
 
+def exponential_backoff(initial_delay, max_delay, factor=2, jitter=0.2):
+    """
+    Generate an infinite sequence of delays (in seconds), growing exponentially from `initial_delay`
+    up to `max_delay`
+
+    Each delay is randomized by up to +/- `jitter` (a fraction of the delay), so that processes
+    started at the same time don't keep retrying in lockstep.
+    """
+    delay = initial_delay
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, max_delay)
+
+
 def _line_timeout_generator(line_timeout, global_timeout):
     """
     Helper function for poll_streams() to compute the timeout for a single line.
@@ -93,25 +169,30 @@ def _line_timeout_generator(line_timeout, global_timeout):
         yield from itertools.repeat(line_timeout)
 
 
-def poll_streams(*files, line_timeout=None, global_timeout=None):
+def poll_streams(*files, line_timeout=None, global_timeout=None, chunk_size=65536):
     """
     Poll a set of file objects for new data and return it line by line.
 
-    The file objects should be line-buffered or unbuffered.  Regular files won't
-    work on some systems (notably Linux, where DefaultSelector uses epoll() by
-    default; this function is pointless for regular files anyway, since they are
-    always ready for reading and writing).
+    Data is read from the file descriptors with os.read(), up to `chunk_size` bytes at a time as
+    soon as it is available, and split into lines here; so the file objects don't need to be
+    line-buffered, and should be unbuffered since their own buffers are bypassed.  Regular files
+    won't work on some systems (notably Linux, where DefaultSelector uses epoll() by default; this
+    function is pointless for regular files anyway, since they are always ready for reading and
+    writing).
 
     Each line returned is a 2-items tuple, with the first item being the object
-    implementing the file interface, and the second the text read.
+    implementing the file interface, and the second the bytes read, including the trailing newline
+    (except for a last line without one).
 
     The optional parameters line_timeout and global_timeout specify how long in
-    seconds to wait at most for a single line or for all lines.  If no timeout
+    seconds to wait at most for new data or for all lines.  If no timeout
     is specified, this function will block indefintely for each line.
     """
     selector = selectors.DefaultSelector()
+    partial_lines = {}
     for fileobj in files:
         selector.register(fileobj, selectors.EVENT_READ)
+        partial_lines[fileobj] = b''
     timeout = _line_timeout_generator(line_timeout, global_timeout)
     while selector.get_map():
         available = selector.select(next(timeout))
@@ -119,8 +200,61 @@ def poll_streams(*files, line_timeout=None, global_timeout=None):
             # TODO(smarnach): This can also mean that the process received a signal.
             raise TimeoutError
         for key, unused_mask in available:
-            line = key.fileobj.readline()
-            if line:
-                yield (key.fileobj, line)
-            else:
+            chunk = os.read(key.fd, chunk_size)
+            if not chunk:
                 selector.unregister(key.fileobj)
+                if partial_lines[key.fileobj]:
+                    yield (key.fileobj, partial_lines[key.fileobj])
+                continue
+            *lines, partial_lines[key.fileobj] = (partial_lines[key.fileobj] + chunk).split(b'\n')
+            for line in lines:
+                yield (key.fileobj, line + b'\n')
+
+
+# Classes #####################################################################
+
+class NotificationListener:
+    """
+    Listen for the JSON notifications published on a redis pub/sub channel, such as the ones
+    sent to the browser via swampdragon's `publish_data()`
+
+    Use as a context manager, to only subscribe to the channel while it is needed:
+
+        with NotificationListener('notification', lambda data: data['type'] == 'server_update') as listener:
+            listener.wait(timeout=10)
+    """
+    def __init__(self, channel, predicate=None):
+        self.channel = channel
+        self.predicate = predicate
+        self.pubsub = None
+
+    def __enter__(self):
+        client = redis.StrictRedis(host=settings.SWAMP_DRAGON_REDIS_HOST, port=settings.SWAMP_DRAGON_REDIS_PORT)
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.channel)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pubsub.close()
+
+    def wait(self, timeout):
+        """
+        Block until a notification matching the predicate is received, or until `timeout` seconds
+        have elapsed
+
+        Returns True if a matching notification was received, False otherwise.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            message = self.pubsub.get_message(timeout=remaining)
+            if message is None or message['type'] != 'message':
+                continue
+            try:
+                data = json.loads(message['data'].decode('utf-8'))
+            except ValueError:
+                continue
+            if self.predicate is None or self.predicate(data):
+                return True
@@ -246,6 +246,28 @@ OPENSTACK_SANDBOX_BASE_IMAGE = env.json('OPENSTACK_SANDBOX_BASE_IMAGE', default=
 OPENSTACK_SANDBOX_SSH_KEYNAME = env('OPENSTACK_SANDBOX_SSH_KEYNAME', default='opencraft')
 OPENSTACK_SANDBOX_SSH_USERNAME = env('OPENSTACK_SANDBOX_SSH_USERNAME', default='ubuntu')
 
+# Number of servers to request per page when listing all the servers of the tenant.
+# Should not be higher than the `osapi_max_limit` of the OpenStack provider (1000 by default).
+OPENSTACK_SERVER_LIST_PAGE_SIZE = env.int('OPENSTACK_SERVER_LIST_PAGE_SIZE', default=1000)
+
+# Maximum number of servers deleted concurrently when cleaning up servers in bulk
+OPENSTACK_DELETE_MAX_WORKERS = env.int('OPENSTACK_DELETE_MAX_WORKERS', default=8)
+
+# Time in seconds during which flavors and images found via nova are cached
+OPENSTACK_RESOURCE_CACHE_TTL = env.int('OPENSTACK_RESOURCE_CACHE_TTL', default=3600)
+
+# Minimum interval in seconds between two refreshes of the status of all servers from nova,
+# when servers are being waited on. Set to 0 to refresh the status every time it is needed.
+OPENSTACK_STATUS_POLL_INTERVAL = env.int('OPENSTACK_STATUS_POLL_INTERVAL', default=5)
+
+# Delay in seconds between two status checks of a server that is being waited on.
+# It grows exponentially from the minimum to the maximum value.
+SERVER_STATUS_WAIT_MIN_DELAY = env.int('SERVER_STATUS_WAIT_MIN_DELAY', default=1)
+SERVER_STATUS_WAIT_MAX_DELAY = env.int('SERVER_STATUS_WAIT_MAX_DELAY', default=30)
+
+# Timeout in seconds when checking whether a port of a server is open, e.g. to know if SSH is up
+PORT_PROBE_TIMEOUT = env.int('PORT_PROBE_TIMEOUT', default=5)
+
 # Separate credentials for Swift.  These credentials are currently passed on to each instance
 # when Swift is enabled and INSTANCE_EPHEMERAL_DATABASES is disabled.
 
@@ -339,6 +361,30 @@ ANSIBLE_LINE_TIMEOUT = env.int('ANSIBLE_LINE_TIMEOUT', default=1500)  # 25 minut
 # Timeout in seconds for an entire Ansible playbook.
 ANSIBLE_GLOBAL_TIMEOUT = env.int('ANSIBLE_GLOBAL_TIMEOUT', default=9000)  # 2.5 hours
 
+# Size in bytes of the playbook output kept in memory (e.g. for failure emails), beyond which it is
+# spooled to a temporary file
+ANSIBLE_LOG_SPOOL_SIZE = env.int('ANSIBLE_LOG_SPOOL_SIZE', default=1024 * 1024)  # 1 MB
+
+# Number of servers configured in parallel when a playbook runs against several AppServers at once
+ANSIBLE_FORKS = env.int('ANSIBLE_FORKS', default=10)
+
+# Directory where the Ansible venvs are cached, one per requirements file & Python interpreter.
+# It is outside of build/, which `make clean` deletes before each run.
+# Set to an empty string to build a new venv for each playbook run.
+ANSIBLE_VENV_CACHE_DIR = env('ANSIBLE_VENV_CACHE_DIR', default=root('cache', 'ansible-venvs'))
+
+# Size in bytes above which the least recently used venvs are removed from the cache
+ANSIBLE_VENV_CACHE_MAX_SIZE = env.int('ANSIBLE_VENV_CACHE_MAX_SIZE', default=5 * 1024 ** 3)  # 5 GB
+
+# Directory where local mirrors of the playbook repositories are kept, to clone them without downloading
+# them again. It is outside of build/, which `make clean` deletes before each run.
+# Set to an empty string to clone the repositories from their remote URL each time.
+GIT_MIRROR_CACHE_DIR = env('GIT_MIRROR_CACHE_DIR', default=root('cache', 'git-mirrors'))
+
+# Age after which the objects of the mirrors which are no longer referenced are deleted, when the
+# mirrors are garbage-collected. It must be longer than the clones of the mirrors are used.
+GIT_MIRROR_PRUNE_EXPIRE = env('GIT_MIRROR_PRUNE_EXPIRE', default='2.weeks.ago')
+
 # Emails ######################################################################
 
 EMAIL_BACKEND = env('EMAIL_BACKEND',
@@ -368,6 +414,21 @@ BASE_HANDLERS = env.json('BASE_HANDLERS', default=["file", "console"])
 HANDLERS = BASE_HANDLERS + ['db']
 LOGGING_ROTATE_MAX_KBYTES = env.json('LOGGING_ROTATE_MAX_KBYTES', default=10 * 1024)
 LOGGING_ROTATE_MAX_FILES = env.json('LOGGING_ROTATE_MAX_FILES', default=60)
+# Log entries are written to the database in batches of up to LOG_DB_BUFFER_SIZE entries, buffered
+# for LOG_DB_FLUSH_INTERVAL seconds at most (warnings and errors are written right away). Without
+# LOG_DB_ASYNC, the interval is only checked when the next entry is logged.
+# Each batch is then published to the browsers with one websocket message per object.
+LOG_DB_BUFFER_SIZE = env.int('LOG_DB_BUFFER_SIZE', default=100)
+LOG_DB_FLUSH_INTERVAL = env.float('LOG_DB_FLUSH_INTERVAL', default=0.2)
+# Write log entries from a background thread, through a queue holding at most LOG_DB_QUEUE_SIZE entries.
+# When the database can't keep up, debug entries are dropped first, then info entries. Debug entries
+# are only stored if LOG_DB_LEVEL is DEBUG.
+LOG_DB_ASYNC = env.bool('LOG_DB_ASYNC', default=True)
+LOG_DB_QUEUE_SIZE = env.int('LOG_DB_QUEUE_SIZE', default=10000)
+LOG_DB_LEVEL = env('LOG_DB_LEVEL', default='INFO')
+# The numbers of log entries written and dropped by each process are logged every LOG_DB_STATS_INTERVAL
+# seconds at most
+LOG_DB_STATS_INTERVAL = env.int('LOG_DB_STATS_INTERVAL', default=300)
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -390,9 +451,14 @@ LOGGING = {
             'formatter': 'verbose'
         },
         'db': {
-            'level': 'INFO',
+            'level': LOG_DB_LEVEL,
             'class': 'instance.logging.DBHandler',
-            'formatter': 'db'
+            'formatter': 'db',
+            'capacity': LOG_DB_BUFFER_SIZE,
+            'flush_interval': LOG_DB_FLUSH_INTERVAL,
+            'asynchronous': LOG_DB_ASYNC,
+            'queue_size': LOG_DB_QUEUE_SIZE,
+            'stats_interval': LOG_DB_STATS_INTERVAL,
         },
     },
     'loggers': {
@@ -420,7 +486,13 @@ LOGGING = {
             'handlers': HANDLERS,
             'propagate': False,
             'level': 'WARNING',
-        }
+        },
+        # Errors of the db handler itself, which would be queued to it again
+        'instance.logging': {
+            'handlers': BASE_HANDLERS,
+            'propagate': False,
+            'level': 'INFO',
+        },
     }
 }
 
@@ -450,6 +522,28 @@ INSTANCE_MONGO_URL_OBJ = urlparse(INSTANCE_MONGO_URL) if INSTANCE_MONGO_URL else
 # Limit the number of log entries fetched for each instance, for performance
 LOG_LIMIT = env.int('LOG_LIMIT', default=10000)
 
+# Number of log entries returned per page by the log APIs, and embedded in instance/appserver details.
+# Older entries are fetched on demand, using the `before` cursor returned with each page.
+LOG_PAGE_SIZE = env.int('LOG_PAGE_SIZE', default=200)
+
+# Log entries older than LOG_RETENTION_DAYS are deleted every night, except for warnings and errors, which
+# are kept for LOG_ERROR_RETENTION_DAYS. This applies to the logs of all objects, including active instances
+# and running AppServers, so log entries are kept forever by default (0). Deletions are done
+# LOG_RETENTION_CHUNK_SIZE rows at a time, so that the log table is never locked for long.
+LOG_RETENTION_DAYS = env.int('LOG_RETENTION_DAYS', default=0)
+LOG_ERROR_RETENTION_DAYS = env.int('LOG_ERROR_RETENTION_DAYS', default=0)
+LOG_RETENTION_CHUNK_SIZE = env.int('LOG_RETENTION_CHUNK_SIZE', default=1000)
+
+# The log entries of AppServers which failed or are terminated are moved to one compressed archive per
+# AppServer once they are LOG_ARCHIVE_AFTER_HOURS old, in chunks appended by each run of the archiving task.
+# Archives are stored in the LOG_ARCHIVE_SWIFT_CONTAINER Swift container when LOG_ARCHIVE_STORAGE is 'swift',
+# or in LOG_ARCHIVE_LOCAL_DIR when it is 'local'. They are deleted along with their AppServer.
+# Leave LOG_ARCHIVE_STORAGE empty to keep all log entries in the database.
+LOG_ARCHIVE_STORAGE = env('LOG_ARCHIVE_STORAGE', default='')
+LOG_ARCHIVE_SWIFT_CONTAINER = env('LOG_ARCHIVE_SWIFT_CONTAINER', default='opencraft-logs')
+LOG_ARCHIVE_LOCAL_DIR = env('LOG_ARCHIVE_LOCAL_DIR', default=root('log', 'archive'))
+LOG_ARCHIVE_AFTER_HOURS = env.int('LOG_ARCHIVE_AFTER_HOURS', default=24)
+
 # When configured, email sent from instances is relayed via external SMTP provider.
 INSTANCE_SMTP_RELAY_HOST = env('INSTANCE_SMTP_RELAY_HOST', default=None)
 INSTANCE_SMTP_RELAY_PORT = env.int('INSTANCE_SMTP_RELAY_PORT', default=587)